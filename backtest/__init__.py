@@ -0,0 +1,3 @@
+# encoding: UTF-8
+
+from __future__ import division
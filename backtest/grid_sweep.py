@@ -0,0 +1,93 @@
+# encoding: UTF-8
+# parameter sweep of GridStrategy over a process pool, prices are shared through SharedPrices.
+# author email: szy@tsinghua.org.cn
+
+import os
+import sys
+import argparse
+import itertools
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from strategy.grid_strategy import GridStrategy
+from strategy.grid_kernel import *
+from backtest.sweep_pool import *
+
+
+def grid_sweep_combos(gridcounts, gridtypes, georatios, arithdeltas, needrepositions):
+    # GeoRatio is only used by Geo/GeoArith and ArithDelta by Arith/GeoArith, other types keep the first value
+    combos = []
+    for gridcount, gridtype, georatio, arithdelta, needreposition in \
+            itertools.product(gridcounts, gridtypes, georatios, arithdeltas, needrepositions):
+        if gridtype not in [GridStrategy.TYPE_GEO, GridStrategy.TYPE_GEOARITH] and georatio != georatios[0]:
+            continue
+        if gridtype not in [GridStrategy.TYPE_ARITH, GridStrategy.TYPE_GEOARITH] and arithdelta != arithdeltas[0]:
+            continue
+        if gridtype in GridStrategy.GRID_TYPES_NOBAND and needreposition != needrepositions[0]:
+            continue
+        combos.append({'GridCount': gridcount, 'GridType': gridtype, 'GeoRatio': georatio,
+                       'ArithDelta': arithdelta, 'NeedRePosition': needreposition})
+    return combos
+
+
+def _run_chunk(combos, kernelargs):
+    result = grid_kernel(worker_prices(),
+                         gridcount=[c['GridCount'] for c in combos],
+                         gridtype=[c['GridType'] for c in combos],
+                         georatio=[c['GeoRatio'] for c in combos],
+                         arithdelta=[c['ArithDelta'] for c in combos],
+                         needreposition=[c['NeedRePosition'] for c in combos],
+                         record=False, **kernelargs)
+    return [result['final_equity'] / result['init_equity'] - 1, result['max_drawdown'],
+            result['trades'], result['repositions']]
+
+
+def grid_sweep(prices, gridminprice, gridmaxprice, gridcounts=(6, 10, 16, 20, 30, 40), gridtypes=GridStrategy.GRID_TYPES,
+               georatios=(0.6,), arithdeltas=(-0.12,), needrepositions=(False, True),
+               workers=None, chunksize=256, **kernelargs):
+    # kernelargs are passed to grid_kernel: initbalance, initstocks, lotsize, maxfees, feerate
+    combos = grid_sweep_combos(list(gridcounts), list(gridtypes), list(georatios), list(arithdeltas),
+                               list(needrepositions))
+    kernelargs.update({'gridminprice': gridminprice, 'gridmaxprice': gridmaxprice})
+    chunks = split_chunks(combos, chunksize, workers)
+
+    results = []
+    for chunk, ret in zip(chunks, map_chunks(prices, _run_chunk, chunks, workers, kernelargs)):
+        returns, drawdowns, trades, repositions = ret
+        for i, combo in enumerate(chunk):
+            r = dict(combo)
+            r.update({'return': float(returns[i]), 'max_drawdown': float(drawdowns[i]),
+                      'trades': int(trades[i]), 'repositions': int(repositions[i])})
+            results.append(r)
+    return rank_results(results)
+
+
+if __name__ == '__main__':
+    cmdLineParser = argparse.ArgumentParser("grid_sweep")
+    cmdLineParser.description = "GridStrategy parameter sweep over the prices of a data file of TradeEngineBacktest"
+    cmdLineParser.add_argument("-f", "--file", type=str, required=True, help="csv data file")
+    cmdLineParser.add_argument("--column", type=str, default='close', help="price column, default is close")
+    cmdLineParser.add_argument("--minprice", type=float, default=None, help="GridMinPrice, default is the lowest price")
+    cmdLineParser.add_argument("--maxprice", type=float, default=None, help="GridMaxPrice, default is the highest price")
+    cmdLineParser.add_argument("--gridcounts", type=str, default="6,10,16,20,30,40", help="GridCount list")
+    cmdLineParser.add_argument("--gridtypes", type=str, default=",".join(GridStrategy.GRID_TYPES), help="GridType list")
+    cmdLineParser.add_argument("--georatios", type=str, default="0.6", help="GeoRatio list")
+    cmdLineParser.add_argument("--arithdeltas", type=str, default="-0.12", help="ArithDelta list")
+    cmdLineParser.add_argument("--invest", type=float, default=10000, help="initial balance")
+    cmdLineParser.add_argument("--lotsize", type=float, default=0, help="lot size, 0 for fractional volume")
+    cmdLineParser.add_argument("--feerate", type=float, default=0, help="fee rate of the dealt value")
+    cmdLineParser.add_argument("-w", "--workers", type=int, default=None, help="worker processes, default is cpu count")
+    cmdLineParser.add_argument("-t", "--top", type=int, default=20, help="results to print")
+    args = cmdLineParser.parse_args()
+
+    prices = load_prices(args.file, args.column)
+    results = grid_sweep(prices,
+                         args.minprice if args.minprice else float(prices.min()),
+                         args.maxprice if args.maxprice else float(prices.max()),
+                         gridcounts=[int(v) for v in args.gridcounts.split(',')],
+                         gridtypes=args.gridtypes.split(','),
+                         georatios=[float(v) for v in args.georatios.split(',')],
+                         arithdeltas=[float(v) for v in args.arithdeltas.split(',')],
+                         workers=args.workers, initbalance=args.invest, lotsize=args.lotsize, feerate=args.feerate)
+    print("grid_sweep,combos=", len(results), flush=True)
+    for r in results[:args.top]:
+        print(r, flush=True)
+    exit(0)
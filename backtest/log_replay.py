@@ -0,0 +1,403 @@
+# encoding: UTF-8
+# replays the strategy lines of SQLog files into fresh strategy objects and reports the first divergence.
+# author email: szy@tsinghua.org.cn
+
+import os
+import sys
+import re
+import ast
+import glob
+import logging
+import argparse
+import collections
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.sq_log import *
+from strategy.grid_strategy import *
+from strategy.shannon_strategy import *
+
+_LINE_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})\s+(\w+): \[([^\]]+)\] (\w+):(\d+): (.*)$')
+_MSG_RE = re.compile(r'^\[([^\]]+)\] (\w+):(\d+): (.*)$')
+_NUMBER_RE = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+_STRATEGY_CLASSES = {'shannon_strategy.py': ShannonStrategy, 'grid_strategy.py': GridStrategy}
+# order volumes of begin_transact, compared with a tolerance of VStocks
+_VOLUME_KEYS = ['Buy', 'Sell']
+# counters of the ticks which the frame skips inside the trigger band of ShannonStrategy, nothing is logged
+# for them, so the replayed counters may only be lower
+_SKIPPED_TICK_KEYS = ['_timesOnTick', '_timesRatioLtThreshold']
+_DICT_KEY = 'self.__dict__='
+# numpy scalars in the logged dict, np.float64(1.5) -> 1.5
+_NUMPY_SCALAR_RE = re.compile(r'\b(?:np|numpy)\.\w+\(([^()]*)\)')
+
+
+def log_files(marketname, strategyname):
+    # the current file and its TimedRotatingFileHandler backups <strategy>.log.<date>, oldest first
+    logfile = os.path.join(SQSetting.get_savedata_dir(marketname), strategyname + '.log')
+    return sorted(glob.glob(logfile + '.*')) + [logfile]
+
+
+def read_lines(filepaths):
+    for filepath in filepaths:
+        if not os.path.exists(filepath):
+            continue
+        with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                yield line.rstrip('\r\n')
+
+
+def _parse_value(text):
+    if text in ['True', 'False']:
+        return text == 'True'
+    if _NUMBER_RE.match(text):
+        return float(text) if ('.' in text or 'e' in text or 'E' in text) else int(text)
+    return text
+
+
+def _parse_body(record, body):
+    body = body.strip()
+    head = body.split('  ')[0]
+    record['head'] = head
+    record['stockcode'] = re.split(r'[:,]', head)[-1].strip()
+    if _DICT_KEY in body:
+        body, record['dict'] = body.split(_DICT_KEY, 1)
+    record['tokens'] = body.split()
+    record['fields'] = {}
+    for key, value in re.findall(r'([^\s=]+)=\s*(\S+)', body):
+        record['fields'].setdefault(key, _parse_value(value))
+    return record
+
+
+def parse_records(lines):
+    # SQLog lines of the strategy files, other lines and DataFrame continuation lines are skipped
+    for line in lines:
+        m = _LINE_RE.match(line)
+        if m is None or m.group(3) not in _STRATEGY_CLASSES:
+            continue
+        yield _parse_body({'time': m.group(1), 'level': m.group(2), 'file': m.group(3), 'func': m.group(4),
+                           'line': line}, m.group(6))
+
+
+def parse_message(message):
+    m = _MSG_RE.match(message)
+    if m is None:
+        return None
+    return _parse_body({'time': None, 'level': None, 'file': m.group(1), 'func': m.group(2), 'line': message},
+                       m.group(4))
+
+
+class _CaptureHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def _round_unit(v):
+    # SQLog.__to_string rounds floats to 2, 4 or 6 digits, negative values keep 6
+    return 0.005 if v > 100 else (0.00005 if v > 1 else 0.0000005)
+
+
+def _values_close(a, b, reltol, abstol=0.0):
+    return abs(a - b) <= 2 * max(_round_unit(a), _round_unit(b)) + reltol * max(abs(a), abs(b)) + abstol
+
+
+def _skipped_ticks_match(expected, replayed):
+    return bool(_NUMBER_RE.match(expected) and _NUMBER_RE.match(replayed)) and float(replayed) <= float(expected)
+
+
+def _tokens_match(a, b, reltol, abstol, volumetol):
+    if a == b:
+        return True
+    ka, _, va = a.rpartition('=')
+    kb, _, vb = b.rpartition('=')
+    if ka != kb:
+        return False
+    if ka in _VOLUME_KEYS:
+        abstol = max(abstol, volumetol)
+    va = va.lstrip('@/[')
+    vb = vb.lstrip('@/[')
+    if va == vb:
+        return True
+    if ka in _SKIPPED_TICK_KEYS:
+        return _skipped_ticks_match(va, vb)
+    if not (_NUMBER_RE.match(va) and _NUMBER_RE.match(vb)):
+        return False
+    return _values_close(float(va), float(vb), reltol, abstol)
+
+
+def records_match(expected, replayed, reltol=1e-3, abstol=1e-4, volumetol=0.0):
+    # [matched, reason], line numbers and timestamps are not compared. the inputs of a replayed call are rebuilt
+    # from rounded values, so derived values like ratio or VBalance differ a little even with the same code.
+    if replayed is None:
+        return [False, "replay emitted fewer lines"]
+    if expected['file'] != replayed['file'] or expected['func'] != replayed['func']:
+        return [False, "different function"]
+    if len(expected['tokens']) != len(replayed['tokens']):
+        return [False, "different fields"]
+    prev = ''
+    for a, b in zip(expected['tokens'], replayed['tokens']):
+        # 'key= value' is logged as two tokens
+        skipped = any(prev.endswith(key + '=') for key in _SKIPPED_TICK_KEYS)
+        prev = a
+        if skipped and _skipped_ticks_match(a, b):
+            continue
+        if not _tokens_match(a, b, reltol, abstol, volumetol):
+            return [False, "different value,expected=" + a + ",replayed=" + b]
+    return [True, None]
+
+
+class LogReplay(object):
+
+    def __init__(self, reltol=1e-3, abstol=1e-4, lookahead=16):
+        self._reltol = reltol
+        self._abstol = abstol
+        self._lookahead = lookahead
+        self._strategies = {}
+        # snapshots taken when the strategies were closed, SunquantFrame saves them just before closing
+        self._snapshots = {}
+        self._buffer = collections.deque()
+        self._records = None
+        self._capture = _CaptureHandler()
+        self.times_records = 0
+        self.times_calls = 0
+        self.times_skipped = 0
+        self.times_threshold = 0
+
+    def __next_record(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return next(self._records, None)
+
+    def __find_record(self, record, keys):
+        # the line of the current call which carries its inputs, the first line itself or one of the next lines
+        if all([k in record['fields'] for k in keys]):
+            return record
+        stockcode = record['stockcode']
+        i = 0
+        while i < self._lookahead:
+            if i >= len(self._buffer):
+                record = next(self._records, None)
+                if record is None:
+                    return None
+                self._buffer.append(record)
+            record = self._buffer[i]
+            if record['stockcode'] == stockcode and all([k in record['fields'] for k in keys]):
+                return record
+            i += 1
+        return None
+
+    def __state_input(self, logged, state):
+        # logged values are rounded, the exact state is used when it is what was logged
+        if isinstance(logged, (int, float)) and _values_close(logged, state, self._reltol):
+            return state
+        return logged
+
+    def __construct(self, record):
+        cls = _STRATEGY_CLASSES[record['file']]
+        stg = cls.__new__(cls)
+        # the runtime state in slots is not in the logged dict, it starts from zero as in __init__
+        for name, code in cls._STATE_FIELDS:
+            setattr(stg, name, False if code == '?' else 0)
+        for key, value in ast.literal_eval(_NUMPY_SCALAR_RE.sub(r'\1', record['dict'].strip())).items():
+            setattr(stg, key, value)
+        if cls is ShannonStrategy:
+            for key in ['BeLurker', 'BeMaker', 'MaxWaitsecsTaker', 'MaxWaitsecsMaker', 'MaxWaitsecsLurker']:
+                if key in record['fields']:
+                    setattr(ShannonStrategy, key, record['fields'][key])
+        self._strategies[record['stockcode']] = stg
+
+    def __call_of(self, stg, record):
+        # the strategy call which logged this first line, with its inputs rebuilt from the logged fields
+        f = record['fields']
+        func = record['func']
+        if func == 'open':
+            if 'halfopen' in record['head']:
+                return [stg.open, [f['lastprice'], f['nowbalance'], f['nowstocks']]]
+            anchor = self.__find_record(record, ['_initprice', '_initbalance', '_initstocks'])
+            if anchor is None:
+                return [stg.open, [0, stg.get_nowbalance(), stg.get_nowstocks()]]
+            a = anchor['fields']
+            return [stg.open, [a['_initprice'], a['_initbalance'], a['_initstocks']]]
+        if func == 'close':
+            if stg.is_open():
+                self._snapshots[record['stockcode']] = stg.snapshot()
+            return [stg.close, []]
+        if func == 'restore':
+            if record['stockcode'] not in self._snapshots:
+                return None
+            return [stg.restore, [self._snapshots[record['stockcode']]]]
+        if func == 'adapt_threshold':
+            return [stg.adapt_threshold, [f['volatility']]]
+        if func == 'end_transact':
+            if isinstance(stg, GridStrategy):
+                anchor = self.__find_record(record, ['diffbalance', 'diffstocks', 'cursorstep', 'dealprice'])
+                if anchor is None:
+                    return [stg.end_transact, [0, 0, 0, 0, 0, 1]]
+                a = anchor['fields']
+                return [stg.end_transact, [a['dealprice'], a['diffbalance'], a['diffstocks'], a['cursorstep'],
+                                           a['dealprice'], 1]]
+            anchor = self.__find_record(record, ['lastprice', 'diffbalance', 'diffstocks', 'minstocks'])
+            if anchor is None:
+                return [stg.end_transact, [0, 0, 0, 0, 0, 1]]
+            a = anchor['fields']
+            return [stg.end_transact, [a['lastprice'], a['diffbalance'], a['diffstocks'], 0, a['lastprice'],
+                                       a['minstocks']]]
+        if func == '__re_position':
+            # logged by GridStrategy.begin_transact before its own line, which follows when an order was needed
+            anchor = self.__find_record(record, ['nowalance'])
+            if anchor is None or anchor is not self._buffer[0] or anchor['func'] != 'begin_transact':
+                anchor = record
+            a = anchor['fields']
+            return [stg.begin_transact, [a['lastprice'], self.__state_input(a.get('nowalance'), stg.get_nowbalance()),
+                                         self.__state_input(a.get('nowstocks'), stg.get_nowstocks()),
+                                         a['lastprice'], a['lastprice'], 0, 1, False, False]]
+        if func != 'begin_transact':
+            return None
+        if 'nowalance' in f:
+            return [stg.begin_transact, [f['lastprice'], self.__state_input(f['nowalance'], stg.get_nowbalance()),
+                                         self.__state_input(f['nowstocks'], stg.get_nowstocks()),
+                                         f['lastprice'], f['lastprice'], 0, 1, False, False]]
+        if 'priceToBuy' in f:
+            # ratio less than Threshold, bid/ask rebuilt from the prices the strategy used
+            if stg.BeMaker:
+                bidprice, askprice = f['priceToBuy'], f['priceToSell']
+            else:
+                bidprice, askprice = f['priceToSell'], f['priceToBuy']
+            return [stg.begin_transact, [f['lastprice'], stg.get_nowbalance(), stg.get_nowstocks(),
+                                         bidprice, askprice, 0, 1, False, False]]
+        if 'bidprice' in f:
+            return [stg.begin_transact, [f['lastprice'], self.__state_input(f['nowbalance'], stg.get_nowbalance()),
+                                         self.__state_input(f['nowstocks'], stg.get_nowstocks()),
+                                         f['bidprice'], f['askprice'], f['spread'], f['minstocks'],
+                                         f['forcelurker'], f['blind']]]
+        # not match or something wrong, minstocks is only known from the nested end_transact
+        nested = self.__find_record(record, ['diffbalance', 'minstocks'])
+        minstocks = nested['fields']['minstocks'] if nested else 1
+        return [stg.begin_transact, [f['lastprice'], f['nowbalance'], f['nowstocks'],
+                                     f['lastprice'], f['lastprice'], 0, minstocks, False, False]]
+
+    def __resync(self, stg, record):
+        # VBalance/VStocks of a matched line replace the replayed ones, so that the rounding of the inputs
+        # does not accumulate over the calls, and so do the counters of the skipped ticks
+        f = record['fields']
+        if isinstance(stg, ShannonStrategy) and 'VBalance' in f and 'VStocks' in f:
+            stg._virtualBalance = f['VBalance']
+            stg._virtualStocks = f['VStocks']
+        for key in _SKIPPED_TICK_KEYS:
+            if isinstance(stg, ShannonStrategy) and key in f:
+                setattr(stg, key, f[key])
+
+    def __at_threshold(self, stg, expected, replayed):
+        # a shannon tick whose abs(ratio) is Threshold within the rounding of the logged prices and states,
+        # logged on one side of it and replayed on the other
+        if not isinstance(stg, ShannonStrategy) or expected['func'] != 'begin_transact' or replayed is None:
+            return False
+        expected_less = 'Threshold' in expected['fields'] and 'ratio' in expected['fields']
+        replayed_less = 'Threshold' in replayed['fields'] and 'ratio' in replayed['fields']
+        if expected_less == replayed_less:
+            return False
+        fields = (expected if expected_less else replayed)['fields']
+        ratio = fields['ratio']
+        return isinstance(ratio, float) and abs(abs(ratio) - stg.Threshold) <= self.__threshold_tol(stg, fields)
+
+    def __threshold_tol(self, stg, fields):
+        # how far abs(ratio) may be off by the rounding of the logged price and virtual assets: the ratio
+        # (VB - VS*P) / (VB + VS*P) moves by at most (1 - ratio^2)/2 of the sum of their relative errors
+        ratio = fields['ratio']
+        price = fields.get('priceToBuy' if ratio > 0 else 'priceToSell', fields.get('lastprice'))
+        rel = 0.0
+        for v in [price, stg._virtualBalance, stg._virtualStocks]:
+            if isinstance(v, (int, float)) and v > 0:
+                rel += 2 * _round_unit(v) / v
+        return max(self._reltol * stg.Threshold, (1 - ratio * ratio) / 2 * rel)
+
+    def __replay_call(self, call):
+        self._capture.messages = []
+        call[0](*call[1])
+        return [parse_message(m) for m in self._capture.messages]
+
+    def __divergence(self, record, replayed, reason):
+        return {'time': record['time'], 'stockcode': record['stockcode'], 'reason': reason,
+                'expected': record['line'], 'replayed': replayed['line'] if replayed else None}
+
+    def replay(self, lines):
+        # returns None when every call matches, or the first divergence
+        self._records = parse_records(lines)
+        logger = SQLog.instance()._logger
+        logger.addHandler(self._capture)
+        try:
+            while True:
+                record = self.__next_record()
+                if record is None:
+                    return None
+                self.times_records += 1
+                if record['func'] == '__init__' and 'dict' in record:
+                    self.__construct(record)
+                    continue
+                stg = self._strategies.get(record['stockcode'])
+                call = self.__call_of(stg, record) if stg else None
+                if call is None:
+                    self.times_skipped += 1
+                    continue
+
+                volumetol = self._reltol * abs(getattr(stg, '_virtualStocks', 0))
+                before = stg.snapshot() if record['func'] == 'begin_transact' else None
+                replayed = self.__replay_call(call)
+                self.times_calls += 1
+                if replayed and self.__at_threshold(stg, record, replayed[0]):
+                    # replayed again with Threshold moved to the side the logged call took
+                    threshold = stg.Threshold
+                    fields = record['fields'] if 'ratio' in record['fields'] else replayed[0]['fields']
+                    tol = self.__threshold_tol(stg, fields)
+                    stg.restore(before)
+                    stg.Threshold = threshold + tol if 'ratio' in record['fields'] else threshold - tol
+                    try:
+                        replayed = self.__replay_call(call)
+                    finally:
+                        stg.Threshold = threshold
+                    self.times_threshold += 1
+                expected = record
+                for i, r in enumerate(replayed):
+                    if i > 0:
+                        expected = self.__next_record()
+                        if expected is None:
+                            return self.__divergence(record, r, "log ends inside a call")
+                        self.times_records += 1
+                    matched, reason = records_match(expected, r, self._reltol, self._abstol, volumetol)
+                    if not matched:
+                        return self.__divergence(expected, r, reason)
+                    self.__resync(stg, expected)
+                if not replayed:
+                    return self.__divergence(record, None, "replay emitted no lines")
+        finally:
+            logger.removeHandler(self._capture)
+
+
+if __name__ == '__main__':
+    cmdLineParser = argparse.ArgumentParser("log_replay")
+    cmdLineParser.description = "replays ~/sunquant/<market>/<strategy>.log and its backups into the current strategy code"
+    cmdLineParser.add_argument("-m", "--market", type=str, default='futu-sun', help="marketname, log directory name")
+    cmdLineParser.add_argument("-s", "--strategy", type=str, default='shannon', help="strategyname, log file name")
+    cmdLineParser.add_argument("-f", "--files", type=str, nargs='*', default=None, help="log files, oldest first")
+    cmdLineParser.add_argument("--reltol", type=float, default=1e-3, help="relative tolerance of the values")
+    cmdLineParser.add_argument("--abstol", type=float, default=1e-4, help="absolute tolerance of the values")
+    args = cmdLineParser.parse_args()
+
+    # the replayed strategies log into memory only
+    SQLog.init_default(args.market, args.strategy + "_log_replay", 'critical', 'critical', 0, 0)
+
+    files = args.files if args.files else log_files(args.market, args.strategy)
+    logreplay = LogReplay(args.reltol, args.abstol)
+    divergence = logreplay.replay(read_lines(files))
+    print("log_replay,files=", files, "records=", logreplay.times_records, "calls=", logreplay.times_calls,
+          "skipped=", logreplay.times_skipped, "threshold=", logreplay.times_threshold, flush=True)
+    if divergence:
+        print("log_replay,DIVERGENCE:", flush=True)
+        for key, value in divergence.items():
+            print("    ", key, "=", value, flush=True)
+        exit(1)
+    print("log_replay,no divergence", flush=True)
+    exit(0)
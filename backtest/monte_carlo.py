@@ -0,0 +1,114 @@
+# encoding: UTF-8
+# Monte Carlo price paths (GBM, block bootstrap) run through the Shannon and Grid kernels, all paths at once.
+# author email: szy@tsinghua.org.cn
+
+import os
+import sys
+import argparse
+import numpy
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from strategy.grid_kernel import *
+from strategy.shannon_kernel import *
+from backtest.sweep_pool import *
+
+MODEL_GBM = 'gbm'
+MODEL_BOOTSTRAP = 'bootstrap'
+MODELS = [MODEL_GBM, MODEL_BOOTSTRAP]
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def gbm_paths(s0, mu, sigma, nsteps, npaths, seed=None):
+    # (nsteps+1, npaths), mu and sigma are the mean and the std of the log return of one step
+    rng = numpy.random.default_rng(seed)
+    logreturns = rng.normal(mu - 0.5 * sigma * sigma, sigma, (nsteps, npaths))
+    return s0 * numpy.exp(numpy.vstack([numpy.zeros((1, npaths)), numpy.cumsum(logreturns, axis=0)]))
+
+
+def bootstrap_paths(prices, nsteps, npaths, blocksize=60, s0=None, seed=None):
+    # (nsteps+1, npaths), blocks of consecutive log returns of the real prices, which keeps the intraday
+    # autocorrelation and volatility clustering inside a block
+    rng = numpy.random.default_rng(seed)
+    logreturns = numpy.diff(numpy.log(numpy.asarray(prices, dtype=numpy.float64)))
+    blocksize = max(1, min(blocksize, len(logreturns)))
+    nblocks = -(-nsteps // blocksize)
+    starts = rng.integers(0, len(logreturns) - blocksize + 1, (nblocks, npaths))
+    idx = (starts[:, None, :] + numpy.arange(blocksize)[None, :, None]).reshape(nblocks * blocksize, npaths)[:nsteps]
+    s0 = s0 if s0 else prices[0]
+    return s0 * numpy.exp(numpy.vstack([numpy.zeros((1, npaths)), numpy.cumsum(logreturns[idx], axis=0)]))
+
+
+def _run_paths(columns, strategyname, kernelargs):
+    c0, c1 = columns[0], columns[-1] + 1
+    paths = worker_prices()[:, c0:c1]
+    if strategyname == 'grid':
+        result = grid_kernel(paths, record=False, **kernelargs)
+    else:
+        result = shannon_kernel(paths, record=False, **kernelargs)
+    return numpy.stack([result['final_equity'] / result['init_equity'] - 1, result['max_drawdown'], result['trades']])
+
+
+def run_paths(paths, strategyname, workers=None, chunksize=512, **kernelargs):
+    # kernelargs are scalars passed to grid_kernel or shannon_kernel, every path is one column
+    chunks = split_chunks(list(range(paths.shape[1])), chunksize, workers)
+    rets = map_chunks(paths, _run_paths, chunks, workers, strategyname, kernelargs)
+    returns, drawdowns, trades = [numpy.concatenate(v) for v in zip(*rets)]
+    return {'returns': returns, 'max_drawdowns': drawdowns, 'trades': trades}
+
+
+def distribution_summary(result):
+    returns = result['returns']
+    drawdowns = result['max_drawdowns']
+    return {'paths': len(returns),
+            'mean_return': float(returns.mean()),
+            'prob_loss': float((returns < 0).mean()),
+            'return_percentiles': dict(zip(PERCENTILES, [float(v) for v in numpy.percentile(returns, PERCENTILES)])),
+            'drawdown_percentiles': dict(zip(PERCENTILES, [float(v) for v in numpy.percentile(drawdowns, PERCENTILES)])),
+            'mean_trades': float(result['trades'].mean())}
+
+
+if __name__ == '__main__':
+    cmdLineParser = argparse.ArgumentParser("monte_carlo")
+    cmdLineParser.description = "return and drawdown distributions of ShannonStrategy/GridStrategy over simulated price paths"
+    cmdLineParser.add_argument("-f", "--file", type=str, required=True, help="csv data file, source of the returns")
+    cmdLineParser.add_argument("--column", type=str, default='close', help="price column, default is close")
+    cmdLineParser.add_argument("-s", "--strategy", type=str, default='shannon', help="strategyname, grid or shannon")
+    cmdLineParser.add_argument("--model", type=str, default=MODEL_BOOTSTRAP, help="path model: gbm or bootstrap")
+    cmdLineParser.add_argument("--paths", type=int, default=1000, help="number of paths")
+    cmdLineParser.add_argument("--steps", type=int, default=None, help="steps of every path, default is the data length")
+    cmdLineParser.add_argument("--block", type=int, default=60, help="block size of the bootstrap")
+    cmdLineParser.add_argument("--seed", type=int, default=None, help="random seed")
+    cmdLineParser.add_argument("--leverages", type=str, default="4,8,20", help="BaseLeverage list, shannon only")
+    cmdLineParser.add_argument("--threshold", type=float, default=0.01, help="Threshold, shannon only")
+    cmdLineParser.add_argument("--gridcounts", type=str, default="10,20", help="GridCount list, grid only")
+    cmdLineParser.add_argument("--gridtype", type=str, default='Normal', help="GridType, grid only")
+    cmdLineParser.add_argument("--band", type=float, default=0.2, help="GridMinPrice/GridMaxPrice = start price * (1 -/+ band)")
+    cmdLineParser.add_argument("--invest", type=float, default=10000, help="initial balance")
+    cmdLineParser.add_argument("--spread", type=float, default=0.01, help="price spread of the taker orders, shannon only")
+    cmdLineParser.add_argument("--feerate", type=float, default=0, help="fee rate of the dealt value")
+    cmdLineParser.add_argument("-w", "--workers", type=int, default=None, help="worker processes, default is cpu count")
+    args = cmdLineParser.parse_args()
+
+    prices = load_prices(args.file, args.column)
+    steps = args.steps if args.steps else len(prices) - 1
+    if args.model == MODEL_GBM:
+        logreturns = numpy.diff(numpy.log(prices))
+        paths = gbm_paths(prices[0], logreturns.mean(), logreturns.std(), steps, args.paths, args.seed)
+    elif args.model == MODEL_BOOTSTRAP:
+        paths = bootstrap_paths(prices, steps, args.paths, args.block, seed=args.seed)
+    else:
+        raise Exception("monte_carlo,model not supported,model=" + args.model)
+    print("monte_carlo,model=", args.model, "paths=", paths.shape[1], "steps=", steps, flush=True)
+
+    if args.strategy == 'grid':
+        for gridcount in [int(v) for v in args.gridcounts.split(',')]:
+            result = run_paths(paths, 'grid', args.workers, gridminprice=prices[0] * (1 - args.band),
+                               gridmaxprice=prices[0] * (1 + args.band), gridcount=gridcount, gridtype=args.gridtype,
+                               initbalance=args.invest, feerate=args.feerate)
+            print("GridCount=", gridcount, distribution_summary(result), flush=True)
+    else:
+        for leverage in [float(v) for v in args.leverages.split(',')]:
+            result = run_paths(paths, 'shannon', args.workers, threshold=args.threshold, leverage=leverage,
+                               initbalance=args.invest, spread=args.spread, feerate=args.feerate)
+            print("BaseLeverage=", leverage, distribution_summary(result), flush=True)
+    exit(0)
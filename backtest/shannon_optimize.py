@@ -0,0 +1,117 @@
+# encoding: UTF-8
+# Threshold/BaseLeverage/MidPosition optimizer of ShannonStrategy over a process pool, prices are shared through SharedPrices.
+# author email: szy@tsinghua.org.cn
+
+import os
+import sys
+import argparse
+import itertools
+import numpy
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from strategy.shannon_kernel import *
+from backtest.sweep_pool import *
+
+MODE_TAKER = 'Taker'
+MODE_MAKER = 'Maker'
+MODE_LURKER = 'Lurker'
+MODES = [MODE_TAKER, MODE_MAKER, MODE_LURKER]
+
+# Threshold = volatility * SELFADAPTION_T_RATIO, as ShannonStrategy.__init__ with SelfAdaptionT
+SELFADAPTION_T_RATIO = 0.618 * 0.618 * 0.618
+
+
+def shannon_optimize_combos(thresholds, baseleverages, midpositions, useoptimalleverages, modes):
+    return [{'Threshold': threshold, 'BaseLeverage': baseleverage, 'MidPosition': midposition,
+             'UseOptimalLeverage': useoptimalleverage, 'Mode': mode}
+            for threshold, baseleverage, midposition, useoptimalleverage, mode in
+            itertools.product(thresholds, baseleverages, midpositions, useoptimalleverages, modes)]
+
+
+def _run_chunk(combos, midprice, minprice, maxprice, kernelargs):
+    baseleverage = numpy.array([c['BaseLeverage'] for c in combos], dtype=numpy.float64)
+    baseprice, minprice, maxprice = shannon_base_prices(midprice, [c['MidPosition'] for c in combos],
+                                                        baseleverage, minprice, maxprice)
+    optimal = shannon_optimal_leverage(baseleverage, baseprice, minprice, maxprice)
+    leverage = numpy.where([c['UseOptimalLeverage'] for c in combos], optimal, baseleverage)
+    result = shannon_kernel(worker_prices(),
+                            threshold=[c['Threshold'] for c in combos],
+                            leverage=leverage,
+                            baseprice=baseprice,
+                            belurker=[c['Mode'] == MODE_LURKER for c in combos],
+                            bemaker=[c['Mode'] == MODE_MAKER for c in combos],
+                            record=False, **kernelargs)
+    return numpy.stack([result['final_equity'] / result['init_equity'] - 1, result['max_drawdown'],
+                        result['trades'], leverage])
+
+
+def shannon_optimize(prices, midprice=None, thresholds=(0.002, 0.005, 0.01, 0.02), baseleverages=(4, 8, 12, 20),
+                     midpositions=(0.5,), useoptimalleverages=(False,), modes=(MODE_TAKER,),
+                     minprice=None, maxprice=None, volatility=None, workers=None, chunksize=1024, **kernelargs):
+    # kernelargs are passed to shannon_kernel: initbalance, initstocks, spread, lotsize, maxfees, needreposition, feerate.
+    # minprice/maxprice are MinPrice/MaxPrice of the setting, UseOptimalLeverage only differs from BaseLeverage with them.
+    midprice = midprice if midprice else float(prices[0])
+    combos = shannon_optimize_combos(list(thresholds), list(baseleverages), list(midpositions),
+                                     list(useoptimalleverages), list(modes))
+    chunks = split_chunks(combos, chunksize, workers)
+
+    results = []
+    for chunk, ret in zip(chunks, map_chunks(prices, _run_chunk, chunks, workers,
+                                             midprice, minprice, maxprice, kernelargs)):
+        for i, combo in enumerate(chunk):
+            r = dict(combo)
+            r.update({'return': float(ret[0][i]), 'max_drawdown': float(ret[1][i]), 'trades': int(ret[2][i]),
+                      'Leverage': float(ret[3][i])})
+            if volatility:
+                r['ThresholdRatio'] = round(r['Threshold'] / volatility, 6)
+            results.append(r)
+    return rank_results(results)
+
+
+if __name__ == '__main__':
+    cmdLineParser = argparse.ArgumentParser("shannon_optimize")
+    cmdLineParser.description = "ShannonStrategy parameter optimizer over the prices of a data file of TradeEngineBacktest"
+    cmdLineParser.add_argument("-f", "--file", type=str, required=True, help="csv data file")
+    cmdLineParser.add_argument("--column", type=str, default='close', help="price column, default is close")
+    cmdLineParser.add_argument("--midprice", type=float, default=None, help="MidPrice, default is the average of the first days")
+    cmdLineParser.add_argument("--minprice", type=float, default=None, help="MinPrice")
+    cmdLineParser.add_argument("--maxprice", type=float, default=None, help="MaxPrice")
+    cmdLineParser.add_argument("--thresholds", type=str, default=None, help="Threshold list")
+    cmdLineParser.add_argument("--tratios", type=str, default="0.1,0.146,0.236,0.382,0.618,1",
+                               help="Threshold list as ratios of the volatility of the first days, used without --thresholds")
+    cmdLineParser.add_argument("--leverages", type=str, default="4,8,12,20", help="BaseLeverage list")
+    cmdLineParser.add_argument("--midpositions", type=str, default="0.5", help="MidPosition list")
+    cmdLineParser.add_argument("--optimal", action="store_true", default=False, help="also try UseOptimalLeverage")
+    cmdLineParser.add_argument("--modes", type=str, default=",".join(MODES), help="order modes: Taker,Maker,Lurker")
+    cmdLineParser.add_argument("--invest", type=float, default=10000, help="initial balance")
+    cmdLineParser.add_argument("--spread", type=float, default=0.01, help="price spread of the taker orders")
+    cmdLineParser.add_argument("--lotsize", type=float, default=0, help="lot size, 0 for fractional volume")
+    cmdLineParser.add_argument("--feerate", type=float, default=0, help="fee rate of the dealt value")
+    cmdLineParser.add_argument("-w", "--workers", type=int, default=None, help="worker processes, default is cpu count")
+    cmdLineParser.add_argument("-t", "--top", type=int, default=20, help="results to print")
+    args = cmdLineParser.parse_args()
+
+    times, prices = load_prices(args.file, args.column, True)
+    # the estimate SelfAdaptionT would see when the strategy starts
+    firstdays = times < times[0] + 10 * 86400
+    average, volatility = daily_average_volatility(times[firstdays], prices[firstdays])
+    if args.thresholds:
+        thresholds = [float(v) for v in args.thresholds.split(',')]
+    elif volatility:
+        thresholds = [round(float(v) * volatility, 6) for v in args.tratios.split(',')]
+    else:
+        raise Exception("shannon_optimize,not enough days to estimate volatility,use --thresholds")
+
+    results = shannon_optimize(prices, args.midprice if args.midprice else average,
+                               thresholds=thresholds,
+                               baseleverages=[float(v) for v in args.leverages.split(',')],
+                               midpositions=[float(v) for v in args.midpositions.split(',')],
+                               useoptimalleverages=[False, True] if args.optimal else [False],
+                               modes=args.modes.split(','),
+                               minprice=args.minprice, maxprice=args.maxprice, volatility=volatility,
+                               workers=args.workers, initbalance=args.invest, spread=args.spread,
+                               lotsize=args.lotsize, feerate=args.feerate)
+    print("shannon_optimize,combos=", len(results), "average=", average, "volatility=", volatility,
+          "SelfAdaptionT Threshold=", round(volatility * SELFADAPTION_T_RATIO, 6), flush=True)
+    for r in results[:args.top]:
+        print(r, flush=True)
+    exit(0)
@@ -0,0 +1,82 @@
+# encoding: UTF-8
+# price history placed once in shared memory, pool workers attach to it by name instead of unpickling a copy.
+# author email: szy@tsinghua.org.cn
+
+import os
+import numpy
+import pandas
+from multiprocessing import shared_memory
+
+_attached = {}
+
+
+class SharedPrices(object):
+
+    def __init__(self, prices):
+        prices = numpy.ascontiguousarray(prices, dtype=numpy.float64)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(prices.nbytes, 1))
+        self.array = numpy.ndarray(prices.shape, dtype=numpy.float64, buffer=self._shm.buf)
+        self.array[...] = prices
+        # picklable description handed to the workers, see attach_shared_prices
+        self.spec = [self._shm.name, prices.shape]
+
+    def close(self):
+        if self._shm is not None:
+            self.array = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def attach_shared_prices(spec):
+    # called in the workers, the segment stays mapped for the life of the process
+    name, shape = spec
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = [shm, numpy.ndarray(tuple(shape), dtype=numpy.float64, buffer=shm.buf)]
+    return _attached[name][1]
+
+
+def load_prices(filepath, column='close', withtimes=False):
+    # first column is the time, same layout as the data files of TradeEngineBacktest
+    if not os.path.exists(filepath):
+        raise Exception("load_prices failed,no data file,filepath=" + filepath)
+    df = pandas.read_csv(filepath)
+    if column not in df.columns:
+        column = 'close' if 'close' in df.columns else 'price'
+    timecol = df.columns[0]
+    df = df.sort_values(timecol)
+    prices = df[column].values.astype(numpy.float64)
+    if not withtimes:
+        return prices
+    if pandas.api.types.is_numeric_dtype(df[timecol]):
+        times = df[timecol].values.astype(numpy.float64)
+    else:
+        dt = pandas.to_datetime(df[timecol])
+        if dt.dt.tz is None:
+            dt = dt.dt.tz_localize('UTC')
+        times = ((dt - pandas.Timestamp(0, tz='UTC')) / pandas.Timedelta(seconds=1)).values
+    return [times, prices]
+
+
+def daily_average_volatility(times, prices, period=5):
+    # same formula as call_get_average_volatility of TradeEngineFutu, on daily bars aggregated from the prices
+    days = pandas.DataFrame({'day': numpy.asarray(times) // 86400, 'price': prices})
+    days = days.groupby('day')['price'].agg(['max', 'min', 'last'])
+    if len(days) < max(period, 6):
+        return [0, 0]
+    closes = days['last'].values
+    highs = days['max'].values
+    lows = days['min'].values
+    average = sum(closes[-period:]) / period
+    sumv = 0.0
+    for i in range(-1, -6, -1):
+        sumv += abs(highs[i] / lows[i] - 1) if lows[i] > 0 else 0
+        sumv += abs(closes[i] / closes[i-1] - 1) if closes[i-1] > 0 else 0
+    return [float(average), round(float(sumv) / 10, 6)]
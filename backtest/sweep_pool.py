@@ -0,0 +1,45 @@
+# encoding: UTF-8
+# process pool shared by the parameter sweeps, every task is one vectorized kernel call over a chunk of combinations.
+# author email: szy@tsinghua.org.cn
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from backtest.shared_prices import *
+
+_worker_spec = None
+
+
+def _init_worker(spec):
+    global _worker_spec
+    _worker_spec = spec
+
+
+def worker_prices():
+    # the shared price array inside a task started by map_chunks
+    return attach_shared_prices(_worker_spec)
+
+
+def split_chunks(items, chunksize, workers=None):
+    # at least one chunk per worker so that a small sweep still uses every core
+    workers = workers if workers else os.cpu_count()
+    chunksize = max(1, min(chunksize, -(-len(items) // workers)))
+    return [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+
+
+def map_chunks(prices, func, chunks, workers=None, *args):
+    # func(chunk, *args) runs in the workers and reads the prices through worker_prices()
+    with SharedPrices(prices) as shared:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared.spec,)) as executor:
+            return list(executor.map(func, chunks, *[[a] * len(chunks) for a in args]))
+
+
+def rank_results(results, keys=(('return', True), ('max_drawdown', False), ('trades', False))):
+    # each metric is ranked on its own (True for higher is better), then the results are ordered
+    # by the sum of the ranks, ties by the first metric.
+    for key, reverse in keys:
+        ordered = sorted(results, key=lambda r: r[key], reverse=reverse)
+        for i, r in enumerate(ordered):
+            r['rank_' + key] = i + 1
+    first, firstreverse = keys[0]
+    return sorted(results, key=lambda r: (sum([r['rank_' + k] for k, rev in keys]),
+                                          -r[first] if firstreverse else r[first]))
@@ -0,0 +1,156 @@
+# encoding: UTF-8
+# walk-forward replay of the SelfAdaptionMP/SelfAdaptionT re-estimation, rolling windows evaluated in parallel.
+# author email: szy@tsinghua.org.cn
+
+import os
+import sys
+import argparse
+import random
+import datetime
+import pytz
+import numpy
+import pandas
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.sq_log import *
+from strategy.grid_strategy import *
+from strategy.shannon_strategy import *
+from strategy.grid_kernel import *
+from strategy.shannon_kernel import *
+from backtest.sweep_pool import *
+
+# average and volatility passed to the strategy constructor of every variant
+VARIANT_FIXED = 'Fixed'
+VARIANT_ADAPT_MP = 'AdaptMP'
+VARIANT_ADAPT_T = 'AdaptT'
+VARIANT_ADAPT = 'Adapt'
+VARIANTS = [VARIANT_FIXED, VARIANT_ADAPT_MP, VARIANT_ADAPT_T, VARIANT_ADAPT]
+
+
+def strategy_kernel_params(marketname, strategyname, stockcode, invest_total, average, volatility):
+    # the parameters derived by the strategy constructor, as SunquantFrame.init does after load_savequote_data
+    if strategyname == 'grid':
+        stg = GridStrategy(stockcode, marketname, strategyname, invest_total, average, volatility)
+        return {'gridminprice': stg.GridMinPrice, 'gridmaxprice': stg.GridMaxPrice, 'gridcount': stg.GridCount,
+                'gridtype': stg.GridType, 'georatio': stg.GeoRatio, 'arithdelta': stg.ArithDelta,
+                'needreposition': stg.NeedRePosition, 'maxfees': stg.MaxFees, 'initbalance': stg.get_invest()}
+    elif strategyname == 'shannon':
+        stg = ShannonStrategy(stockcode, marketname, strategyname, invest_total, average, volatility)
+        leverage = stg.BaseLeverage
+        if stg.UseOptimalLeverage:
+            leverage = float(shannon_optimal_leverage(stg.BaseLeverage, stg.BasePrice, stg.MinPrice, stg.MaxPrice))
+        return {'threshold': stg.Threshold, 'leverage': leverage, 'baseprice': stg.BasePrice,
+                'belurker': ShannonStrategy.BeLurker, 'bemaker': ShannonStrategy.BeMaker,
+                'needreposition': stg.NeedRePosition, 'maxfees': stg.MaxFees, 'initbalance': stg.get_invest()}
+    raise Exception("strategy_kernel_params,strategy not supported,strategyname=" + strategyname)
+
+
+def walk_forward_windows(times, windowsecs=86400, lookbackdays=30):
+    # [start index, end index, start time], a window starts where the frame re-inits the strategies
+    windows = []
+    start = times[0] + lookbackdays * 86400
+    while start < times[-1]:
+        i0 = int(numpy.searchsorted(times, start))
+        i1 = int(numpy.searchsorted(times, start + windowsecs))
+        if i1 - i0 > 1:
+            windows.append([i0, i1, start])
+        start += windowsecs
+    return windows
+
+
+def _run_windows(tasks, strategyname, kernelargs):
+    prices = worker_prices()
+    results = []
+    for i0, i1, params in tasks:
+        args = dict(kernelargs)
+        args.update(params)
+        if strategyname == 'grid':
+            result = grid_kernel(prices[i0:i1], record=False, **args)
+        else:
+            result = shannon_kernel(prices[i0:i1], record=False, **args)
+        results.append(numpy.stack([result['final_equity'] / result['init_equity'] - 1, result['max_drawdown'],
+                                    result['trades']]))
+    return results
+
+
+def walk_forward(times, prices, marketname, strategyname, stockcode, invest_total, windowsecs=86400,
+                 lookbackdays=30, workers=None, chunksize=16, **kernelargs):
+    # every window starts from cash with the parameters derived from the days before it, so the windows
+    # are independent of each other; the variants are the columns of one kernel call per window.
+    times = numpy.asarray(times, dtype=numpy.float64)
+    tasks = []
+    rows = []
+    for wi, [i0, i1, start] in enumerate(walk_forward_windows(times, windowsecs, lookbackdays)):
+        history = (times >= start - lookbackdays * 86400) & (times < start)
+        average, volatility = daily_average_volatility(times[history], prices[history])
+        if not volatility:
+            continue
+        estimates = {VARIANT_FIXED: [0, 0], VARIANT_ADAPT_MP: [average, 0],
+                     VARIANT_ADAPT_T: [0, volatility], VARIANT_ADAPT: [average, volatility]}
+        columns = []
+        for variant in VARIANTS:
+            # same MidPrice jitter for every variant of a window
+            random.seed(wi)
+            columns.append(strategy_kernel_params(marketname, strategyname, stockcode, invest_total,
+                                                  estimates[variant][0], estimates[variant][1]))
+        params = {k: [c[k] for c in columns] for k in columns[0].keys()}
+        tasks.append([i0, i1, params])
+        rows.append({'start': datetime.datetime.fromtimestamp(start, pytz.utc).isoformat(),
+                     'ticks': i1 - i0, 'average': average, 'volatility': volatility})
+
+    chunks = split_chunks(tasks, chunksize, workers)
+    rets = []
+    for ret in map_chunks(prices, _run_windows, chunks, workers, strategyname, kernelargs):
+        rets.extend(ret)
+    for row, ret in zip(rows, rets):
+        for vi, variant in enumerate(VARIANTS):
+            row[variant + '_return'] = float(ret[0][vi])
+            row[variant + '_max_drawdown'] = float(ret[1][vi])
+            row[variant + '_trades'] = int(ret[2][vi])
+    return pandas.DataFrame(rows)
+
+
+def walk_forward_summary(windows):
+    summary = {}
+    for variant in VARIANTS:
+        returns = windows[variant + '_return']
+        summary[variant] = {'compound_return': float((1 + returns).prod() - 1),
+                            'mean_return': float(returns.mean()),
+                            'worst_drawdown': float(windows[variant + '_max_drawdown'].max()),
+                            'trades': int(windows[variant + '_trades'].sum()),
+                            'beats_fixed': float((returns > windows[VARIANT_FIXED + '_return']).mean())}
+    return summary
+
+
+if __name__ == '__main__':
+    cmdLineParser = argparse.ArgumentParser("walk_forward")
+    cmdLineParser.description = "walk-forward replay of SelfAdaptionMP/SelfAdaptionT, strategy parameters from setting.json"
+    cmdLineParser.add_argument("-m", "--market", type=str, default='backtest-sun', help="marketname, setting section name")
+    cmdLineParser.add_argument("-s", "--strategy", type=str, default='shannon', help="strategyname, grid or shannon")
+    cmdLineParser.add_argument("-c", "--stockcode", type=str, required=True, help="stockcode, setting section name")
+    cmdLineParser.add_argument("-f", "--file", type=str, required=True, help="csv data file")
+    cmdLineParser.add_argument("--column", type=str, default='close', help="price column, default is close")
+    cmdLineParser.add_argument("--invest", type=float, default=10000, help="invest total of the engine")
+    cmdLineParser.add_argument("--window", type=float, default=24, help="hours between two re-estimations")
+    cmdLineParser.add_argument("--lookback", type=int, default=30, help="days of history before the first window")
+    cmdLineParser.add_argument("--spread", type=float, default=0.01, help="price spread of the taker orders, shannon only")
+    cmdLineParser.add_argument("--lotsize", type=float, default=0, help="lot size, 0 for fractional volume")
+    cmdLineParser.add_argument("--feerate", type=float, default=0, help="fee rate of the dealt value")
+    cmdLineParser.add_argument("-w", "--workers", type=int, default=None, help="worker processes, default is cpu count")
+    cmdLineParser.add_argument("-o", "--output", type=str, default=None, help="csv file of the windows")
+    args = cmdLineParser.parse_args()
+
+    SQLog.init_default(args.market, args.strategy + "_walk_forward", 'warn', 'info', 1, 1)
+
+    times, prices = load_prices(args.file, args.column, True)
+    kernelargs = {'lotsize': args.lotsize, 'feerate': args.feerate}
+    if args.strategy == 'shannon':
+        kernelargs['spread'] = args.spread
+    windows = walk_forward(times, prices, args.market, args.strategy, args.stockcode, args.invest,
+                           windowsecs=args.window * 3600, lookbackdays=args.lookback, workers=args.workers,
+                           **kernelargs)
+    if args.output:
+        windows.to_csv(args.output, index=False)
+    print("walk_forward,windows=", len(windows), flush=True)
+    for variant, summary in walk_forward_summary(windows).items():
+        print(variant, summary, flush=True)
+    exit(0)
@@ -0,0 +1,210 @@
+# encoding: UTF-8
+# batch version of GridStrategy.open/begin_transact/end_transact over whole price arrays.
+# author email: szy@tsinghua.org.cn
+
+import numpy
+
+from strategy.grid_strategy import GridStrategy
+
+_KTABLE = numpy.array(GridStrategy._ktable)
+_NOBAND_CODES = [GridStrategy.GRID_TYPES.index(t) for t in GridStrategy.GRID_TYPES_NOBAND]
+CODE_NORMAL, CODE_KTABLE, CODE_GEO, CODE_ARITH, CODE_GEOARITH, CODE_BLIND = \
+    [GridStrategy.GRID_TYPES.index(t) for t in [GridStrategy.TYPE_NORMAL, GridStrategy.TYPE_KTABLE,
+                                                 GridStrategy.TYPE_GEO, GridStrategy.TYPE_ARITH,
+                                                 GridStrategy.TYPE_GEOARITH, GridStrategy.TYPE_BLIND]]
+
+
+def grid_type_codes(gridtypes):
+    # GridType names to indexes of GridStrategy.GRID_TYPES, integer codes are passed through
+    codes = []
+    for t in numpy.atleast_1d(gridtypes).tolist():
+        if isinstance(t, str):
+            if t not in GridStrategy.GRID_TYPES:
+                raise Exception("grid_type_codes,GridType not supported,GridType=" + t)
+            t = GridStrategy.GRID_TYPES.index(t)
+        codes.append(int(t))
+    return numpy.array(codes, dtype=numpy.int64)
+
+
+def _geo_weight_balance(cursor, gridcount, georatio):
+    # closed form of the while loops in GridStrategy.__get_geo_weight_balance
+    ratio = georatio * 0.5 * gridcount
+    gcur = numpy.round(cursor - 0.5 * gridcount)
+    q = (ratio - 1) / numpy.where(ratio > 1, ratio, 1)
+    geo = 0.5 + numpy.sign(gcur) * 0.5 * (1 - numpy.power(numpy.abs(q), numpy.abs(gcur)))
+    return numpy.where(ratio > 1, geo, cursor / gridcount)
+
+
+def _arith_weight_balance(cursor, gridcount, arithdelta):
+    high = 0.5 * gridcount
+    sum_weight = 2 * 0.5 * (1 + arithdelta + (1 + high * arithdelta)) * high
+    gnow = cursor - 0.5 * gridcount
+    tri = 0.5 * (1 + arithdelta + (1 + numpy.abs(gnow) * arithdelta)) * gnow
+    return (0.5 * sum_weight + tri) / sum_weight
+
+
+def _ktable_weight_balance(cursor, gridcount):
+    step = numpy.clip(numpy.round(len(_KTABLE) / (0.5 * gridcount)), 1, len(_KTABLE) - 1)
+    gnow = numpy.round(cursor - 0.5 * gridcount)
+    w = _KTABLE[numpy.minimum(numpy.abs(gnow) * step, len(_KTABLE) - 1).astype(numpy.int64)]
+    return numpy.where(gnow < 0, (1 - w) / 2, (1 + w) / 2)
+
+
+def grid_weight_balance(cursor, gridcount, gridtype, georatio=0.6, arithdelta=-0.12):
+    # same as GridStrategy.__get_*_weight_balance, vectorized over columns with mixed GridType codes.
+    # Blind has no weight curve, it is handled by grid_want_balance.
+    cursor, gridcount, gridtype, georatio, arithdelta = numpy.broadcast_arrays(
+        numpy.asarray(cursor, dtype=numpy.float64), numpy.asarray(gridcount, dtype=numpy.float64),
+        numpy.asarray(gridtype), numpy.asarray(georatio, dtype=numpy.float64),
+        numpy.asarray(arithdelta, dtype=numpy.float64))
+    normal = cursor / gridcount
+    geo = _geo_weight_balance(cursor, gridcount, georatio)
+    arith = _arith_weight_balance(cursor, gridcount, arithdelta)
+    ktable = _ktable_weight_balance(cursor, gridcount)
+    inarith = (cursor >= gridcount / 6) & (cursor <= 5 * gridcount / 6)
+    return numpy.select([gridtype == CODE_KTABLE, gridtype == CODE_GEOARITH, gridtype == CODE_GEO,
+                         gridtype == CODE_ARITH],
+                        [ktable, numpy.where(inarith, arith, geo), geo, arith], normal)
+
+
+def grid_want_balance(cursor, totalvalue, gridcount, gridtype, georatio, arithdelta, nowcursor, nowbalance):
+    # same as GridStrategy.__get_want_balance
+    blind = nowbalance + (cursor - nowcursor) * totalvalue / gridcount
+    weighted = totalvalue * grid_weight_balance(cursor, gridcount, gridtype, georatio, arithdelta)
+    return numpy.where(gridtype == CODE_BLIND, blind, weighted)
+
+
+class _WeightTable(object):
+    # grid_weight_balance of every column for cursors -pad..GridCount+pad, noband cursors outside fall back to the formula
+
+    def __init__(self, gridcount, gridtype, georatio, arithdelta):
+        self._params = [gridcount, gridtype, georatio, arithdelta]
+        self._pad = int(gridcount.max()) + 2
+        cursors = numpy.arange(-self._pad, int(gridcount.max()) + self._pad + 1, dtype=numpy.float64)
+        self._table = grid_weight_balance(cursors[None, :], gridcount[:, None], gridtype[:, None],
+                                          georatio[:, None], arithdelta[:, None])
+        self._rows = numpy.arange(len(gridcount))
+
+    def lookup(self, cursor):
+        idx = cursor.astype(numpy.int64) + self._pad
+        inside = (idx >= 0) & (idx < self._table.shape[1])
+        weight = self._table[self._rows, numpy.minimum(numpy.maximum(idx, 0), self._table.shape[1] - 1)]
+        if not inside.all():
+            weight = numpy.where(inside, weight, grid_weight_balance(cursor, *self._params))
+        return weight
+
+    def want_balance(self, cursor, totalvalue, gridcount, gridtype, nowcursor, nowbalance):
+        blind = nowbalance + (cursor - nowcursor) * totalvalue / gridcount
+        return numpy.where(gridtype == CODE_BLIND, blind, totalvalue * self.lookup(cursor))
+
+
+def grid_kernel(prices, gridminprice, gridmaxprice, gridcount=10, gridtype=CODE_NORMAL, georatio=0.6,
+                arithdelta=-0.12, needreposition=0, initbalance=1.0, initstocks=0.0, lotsize=0.0,
+                maxfees=1.0, feerate=0.0, record=True):
+    # prices: 1-D array (T,) shared by all columns, or 2-D array (T, N) of N paths.
+    # every parameter is a scalar or an array of N columns, gridtype is a name or a code from grid_type_codes.
+    # the buy and sell orders from begin_transact rest at lower/higher until the next tick,
+    # and are filled at their limit price when that tick crosses them.
+    prices = numpy.asarray(prices, dtype=numpy.float64)
+    gridtype = grid_type_codes(gridtype)
+    params = [numpy.asarray(v, dtype=numpy.float64) for v in
+              [gridminprice, gridmaxprice, gridcount, georatio, arithdelta, needreposition,
+               initbalance, initstocks, lotsize, maxfees, feerate]]
+    ncols = max([prices.shape[1] if prices.ndim == 2 else 1, gridtype.size] + [v.size for v in params])
+    gmin, gmax, GC, georatio, arithdelta, needreposition, B, S, lotsize, maxfees, feerate = \
+        [numpy.broadcast_to(v, (ncols,)).copy() for v in params]
+    gridtype = numpy.broadcast_to(gridtype, (ncols,)).copy()
+    needreposition = needreposition > 0
+    noband = numpy.isin(gridtype, _NOBAND_CODES)
+    GC = numpy.maximum(GC, 1)
+    weights = _WeightTable(GC, gridtype, georatio, arithdelta)
+
+    # open()
+    nticks = prices.shape[0]
+    p = numpy.broadcast_to(prices[0], (ncols,))
+    step = (gmax - gmin) / GC
+    cursor = numpy.round((p - gmin) / step)
+    cursor = numpy.where(noband, cursor, numpy.clip(cursor, 0, GC))
+    lastdealvalue = B + (gmin + cursor * step) * S
+    want = grid_want_balance(cursor, lastdealvalue, GC, gridtype, georatio, arithdelta, cursor, B)
+    balance_step = lastdealvalue / GC
+    down = (cursor > 0) & (0.5 * balance_step < want - B) & (want - B < 1.5 * balance_step)
+    up = ~down & (cursor < GC) & (-1.5 * balance_step < want - B) & (want - B < -0.5 * balance_step)
+    cursor = cursor - down + up
+
+    trades = numpy.zeros(ncols, dtype=numpy.int64)
+    repositions = numpy.zeros(ncols, dtype=numpy.int64)
+    initequity = B + S * p
+    peak = initequity.copy()
+    maxdrawdown = numpy.zeros(ncols)
+    if record:
+        fills = numpy.zeros((nticks, ncols))
+        fillprices = numpy.zeros((nticks, ncols))
+        balances = numpy.zeros((nticks, ncols))
+        stocks = numpy.zeros((nticks, ncols))
+        equities = numpy.zeros((nticks, ncols))
+
+    buyprice = numpy.zeros(ncols)
+    buyvolume = numpy.zeros(ncols)
+    sellprice = numpy.full(ncols, numpy.inf)
+    sellvolume = numpy.zeros(ncols)
+    lot = lotsize > 0
+    safelot = numpy.where(lot, lotsize, 1)
+    for t in range(nticks):
+        p = prices[t]
+
+        # end_transact for the orders resting since the last tick
+        dobuy = (buyvolume > 0) & (p <= buyprice)
+        dosell = ~dobuy & (sellvolume > 0) & (p >= sellprice)
+        qty = numpy.where(dobuy, buyvolume, 0) - numpy.where(dosell, sellvolume, 0)
+        dealprice = numpy.where(dobuy, buyprice, numpy.where(dosell, sellprice, 0))
+        diffbalance = - qty * dealprice
+        B = B + diffbalance - numpy.abs(diffbalance) * feerate
+        S = S + qty
+        cursor = cursor - dobuy + dosell
+        cursor = numpy.where(noband, cursor, numpy.minimum(numpy.maximum(cursor, 0), GC))
+        trades += dobuy | dosell
+
+        # __re_position, only for banded grids sitting at either end
+        atend = needreposition & ~noband & ((cursor <= 0) | (cursor >= GC))
+        repdown = atend & (p < gmin - step)
+        repup = atend & ~repdown & (p > gmax + step)
+        gmin = numpy.where(repdown, gmin - step, numpy.where(repup, gmax + step - GC * step, gmin))
+        gmax = gmin + GC * step
+        cursor = numpy.where(repdown, 0, numpy.where(repup, GC, cursor))
+        repositions += repdown | repup
+
+        # begin_transact
+        higher = gmin + cursor * step + step
+        lower = gmin + cursor * step - step
+        nowvalue = B + S * p
+        balance_step = nowvalue / GC
+        safelower = numpy.where(lower > 0, lower, 1)
+        wantlower = weights.want_balance(cursor - 1, B + S * lower, GC, gridtype, cursor, B)
+        buyvolume = numpy.minimum(numpy.minimum((B - wantlower) / (maxfees * safelower), B / (maxfees * safelower)),
+                                  2 * balance_step / safelower)
+        buyvolume = numpy.where(lot, numpy.round(buyvolume / safelot) * safelot, buyvolume)
+        buyvolume = numpy.where(((cursor > 0) | noband) & (lower > 0), buyvolume, 0)
+        wanthigher = weights.want_balance(cursor + 1, B + S * higher, GC, gridtype, cursor, B)
+        sellvolume = numpy.minimum(numpy.minimum((wanthigher - B) / higher, S), 2 * balance_step / higher)
+        sellvolume = numpy.where(lot, numpy.minimum(numpy.round(sellvolume / safelot) * safelot, S), sellvolume)
+        sellvolume = numpy.where((cursor < GC) | noband, sellvolume, 0)
+        buyprice = lower
+        sellprice = higher
+
+        equity = B + S * p
+        peak = numpy.maximum(peak, equity)
+        maxdrawdown = numpy.maximum(maxdrawdown, 1 - equity / peak)
+        if record:
+            fills[t] = qty
+            fillprices[t] = dealprice
+            balances[t] = B
+            stocks[t] = S
+            equities[t] = equity
+
+    result = {'final_equity': B + S * p, 'init_equity': initequity, 'max_drawdown': maxdrawdown, 'trades': trades,
+              'final_balance': B, 'final_stocks': S, 'final_cursor': cursor, 'repositions': repositions}
+    if record:
+        result.update({'fills': fills, 'fillprices': fillprices, 'balances': balances,
+                       'stocks': stocks, 'equities': equities})
+    return result
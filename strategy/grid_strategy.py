@@ -5,9 +5,22 @@ import random
 
 from utils.sq_log import *
 from utils.sq_setting import *
+from utils.sq_state import *
 
 
 class GridStrategy(object):
+    # the runtime state is kept in slots, the settings and the weights table stay in __dict__
+    _STATE_FIELDS = [['_gridCursor', 'q'], ['_gridStep', 'd'], ['_gridLastDealPrice', 'd'],
+                     ['_initprice', 'd'], ['_initbalance', 'd'], ['_initstocks', 'd'],
+                     ['_nowbalance', 'd'], ['_nowstocks', 'd'], ['_nowprice', 'd'], ['_timesRePosition', 'q'],
+                     ['_ishalfopen', '?'], ['_isopen', '?']]
+    __slots__ = ['__dict__'] + [field[0] for field in _STATE_FIELDS]
+    # settings which __init__ and __re_position derive or move, a snapshot keeps them with the runtime state
+    _DERIVED_SETTINGS = [['GridMinPrice', 'd'], ['GridMaxPrice', 'd'], ['GridCount', 'q'], ['MidPrice', 'd'],
+                         ['StartPrice', 'd'], ['Invest', 'd']]
+    STATE_VERSION = 1
+    _STATE_LAYOUT = SQStateLayout(b'SQSG', STATE_VERSION, _STATE_FIELDS + _DERIVED_SETTINGS)
+
     _ktable = (0,
             0.005932, 0.011865, 0.017799, 0.023735, 0.029672, 0.035609, 0.041546, 0.047484, 0.053421, 0.059358,
             0.065294, 0.071230, 0.077163, 0.083096, 0.089027, 0.094955, 0.100882, 0.106805, 0.112726, 0.118644,
@@ -57,6 +70,7 @@ class GridStrategy(object):
         self.SelfAdaptionMP = 1
         self.MidPriceMaxDeviation = 5.0
         self.SelfAdaptionT = 1
+        self.LadderLevels = 1
 
         self._gridCursor = 0
         self._gridStep = 0
@@ -68,6 +82,10 @@ class GridStrategy(object):
         self._nowstocks = 0
         self._nowprice = 0
         self._timesRePosition = 0
+        # target balance weights of the cursors from -_weightsBase on, see __build_weights
+        self._weights = []
+        self._weightsBase = 0
+        self._weightsKey = None
 
         self._stockcode = stockcode  # same as it is in setting.xml
         self._marketname = marketname
@@ -129,6 +147,47 @@ class GridStrategy(object):
     def get_startprice(self):
         return self.StartPrice
 
+    def get_ladderlevels(self):
+        return self.LadderLevels
+
+    def snapshot(self):
+        # fixed size binary record of the state, restore() on a strategy constructed with the same settings
+        # gives back this strategy without open()
+        return self._STATE_LAYOUT.pack(self)
+
+    def restore(self, data):
+        self._STATE_LAYOUT.unpack(self, data)
+        if self.GridCount >= 1:
+            self._weightsKey = None
+            self.__build_weights()
+        SQLog.info("restore:", self._stockcode, "_isopen=", self._isopen, "_nowbalance=", self._nowbalance,
+                   "_nowstocks=", self._nowstocks, "_gridCursor=", self._gridCursor, "/", self.GridCount,
+                   "GridMinPrice=", self.GridMinPrice, "GridMaxPrice=", self.GridMaxPrice)
+        return True
+
+    def get_book_state(self):
+        # the columns of StrategyBook, weights of the cursors next to the current one are None for Normal and Blind
+        weighted = self.GridType not in [self.TYPE_NORMAL, self.TYPE_BLIND] and self._isopen
+        return {'isopen': self._isopen, 'nowbalance': self._nowbalance, 'nowstocks': self._nowstocks,
+                'cursor': self._gridCursor, 'step': self._gridStep, 'minprice': self.GridMinPrice,
+                'maxprice': self.GridMaxPrice, 'gridcount': self.GridCount,
+                'gridtype': self.GRID_TYPES.index(self.GridType), 'maxfees': self.MaxFees,
+                'needreposition': self.NeedRePosition,
+                'weightlower': self.__get_cursor_weight(self._gridCursor-1) if weighted else None,
+                'weighthigher': self.__get_cursor_weight(self._gridCursor+1) if weighted else None}
+
+    def get_trigger_band(self):
+        # [lower, higher], the grid prices next to the cursor. between them a tick repositions nothing and the
+        # orders of begin_transact stay at these prices; [0, 0] when not open
+        if not self._isopen or not self._gridStep:
+            return [0, 0]
+        lower = self.GridMinPrice + self._gridCursor * self._gridStep - self._gridStep
+        return [lower, lower + 2 * self._gridStep]
+
+    def skip_transact(self, lastprice):
+        # StrategyBook found no order and no reposition for this tick
+        self._nowprice = lastprice
+
     def __get_ktable_weight_balance(self, cursor):
         step = round(len(self._ktable) / (0.5 * self.GridCount))
         if step < 1:
@@ -181,21 +240,68 @@ class GridStrategy(object):
         else:
             return self.__get_geo_weight_balance(cursor)
 
-    def __get_want_balance(self, cursor, totalValue):
-        wantBalance = totalValue * cursor / self.GridCount
+    def __get_weight_balance(self, cursor):
         if self.GridType == self.TYPE_KTABLE:
-            wantBalance = totalValue * self.__get_ktable_weight_balance(cursor)
+            return self.__get_ktable_weight_balance(cursor)
         elif self.GridType == self.TYPE_GEOARITH:
-            wantBalance = totalValue * self.__get_arithgeo_weight_balance(cursor)
+            return self.__get_arithgeo_weight_balance(cursor)
         elif self.GridType == self.TYPE_GEO:
-            wantBalance = totalValue * self.__get_geo_weight_balance(cursor)
+            return self.__get_geo_weight_balance(cursor)
         elif self.GridType == self.TYPE_ARITH:
-            wantBalance = totalValue * self.__get_arith_weight_balance(cursor)
-        elif self.GridType == self.TYPE_BLIND:
+            return self.__get_arith_weight_balance(cursor)
+        return None
+
+    def __build_weights(self):
+        # the weights only depend on the cursor, so they are computed once for cursors 0..GridCount, and for
+        # Geo/GeoArith also GridCount cursors beyond each end of the band; Normal and Blind need no table
+        key = (self.GridType, self.GridCount, self.GeoRatio, self.ArithDelta)
+        if key == self._weightsKey:
+            return
+        self._weightsKey = key
+        self._weights = []
+        self._weightsBase = 0
+        if self.GridType in [self.TYPE_NORMAL, self.TYPE_BLIND]:
+            return
+        if self.GridType in self.GRID_TYPES_NOBAND:
+            self._weightsBase = self.GridCount
+        cursors = range(-self._weightsBase, self.GridCount + self._weightsBase + 1)
+
+        geoweights = {}
+        georatio = self.GeoRatio * 0.5 * self.GridCount
+        if self.GridType in [self.TYPE_GEO, self.TYPE_GEOARITH] and georatio > 1:
+            # __get_geo_weight_balance walks |gcur| steps from the middle, all the walks share their steps
+            gcurs = [round(cursor - 0.5 * self.GridCount) for cursor in cursors]
+            for sign in [1, -1]:
+                geo = 0.5
+                weight = geo
+                geoweights[0] = weight
+                for i in range(1, max([sign * g for g in gcurs] + [0]) + 1):
+                    weight += sign * geo / georatio
+                    geo = geo * (georatio-1) / georatio
+                    geoweights[sign * i] = weight
+
+        for cursor in cursors:
+            if geoweights and (self.GridType == self.TYPE_GEO or
+                               not (self.GridCount/6 <= cursor <= 5 * self.GridCount/6)):
+                self._weights.append(geoweights[round(cursor - 0.5 * self.GridCount)])
+            else:
+                self._weights.append(self.__get_weight_balance(cursor))
+
+    def __get_want_balance(self, cursor, totalValue):
+        wantBalance = totalValue * cursor / self.GridCount
+        if self.GridType == self.TYPE_BLIND:
             diff = cursor - self._gridCursor
             wantBalance = self._nowbalance + diff * totalValue/self.GridCount
+        elif self.GridType != self.TYPE_NORMAL:
+            wantBalance = totalValue * self.__get_cursor_weight(cursor)
         return wantBalance
 
+    def __get_cursor_weight(self, cursor):
+        i = cursor + self._weightsBase
+        if 0 <= i < len(self._weights):
+            return self._weights[i]
+        return self.__get_weight_balance(cursor)
+
     def __re_position(self, lastprice):
         if not self.NeedRePosition:
             return False
@@ -210,6 +316,7 @@ class GridStrategy(object):
             self._gridCursor = 0
             self._gridLastDealPrice = self.GridMinPrice
             self._timesRePosition += 1
+            self.__build_weights()
             SQLog.info("__re_position:", self._stockcode, "_gridCursor=", self._gridCursor, "/", self.GridCount,
                        "_gridLastDealPrice=", self._gridLastDealPrice,
                        "GridMinPrice=", self.GridMinPrice, "GridMaxPrice=", self.GridMaxPrice,
@@ -222,6 +329,7 @@ class GridStrategy(object):
             self._gridCursor = self.GridCount
             self._gridLastDealPrice = self.GridMaxPrice
             self._timesRePosition += 1
+            self.__build_weights()
             SQLog.info("__re_position:", self._stockcode, "_gridCursor=", self._gridCursor, "/", self.GridCount,
                        "_gridLastDealPrice=", self._gridLastDealPrice,
                        "GridMinPrice=", self.GridMinPrice, "GridMaxPrice=", self.GridMaxPrice,
@@ -255,6 +363,8 @@ class GridStrategy(object):
         self._nowprice = lastprice
 
         self._gridStep = (self.GridMaxPrice - self.GridMinPrice) / self.GridCount
+        self._weightsKey = None
+        self.__build_weights()
 
         self._gridCursor = int(round((lastprice - self.GridMinPrice) / self._gridStep))
         if not (self.GridType in self.GRID_TYPES_NOBAND):
@@ -342,6 +452,62 @@ class GridStrategy(object):
 
         return [needbuy, buyprice, buyvolume, needsell, sellprice, sellvolume]
     
+    def begin_ladder(self, lastprice, nowbalance, nowstocks, bidprice, askprice, spread, minstocks, forcelurker, blind):
+        # [[isbuy, price, volume], ...], the orders of begin_transact and behind each of them up to LadderLevels-1
+        # more levels, every level as begin_transact would return it once the levels before it were dealt
+        needbuy, buyprice, buyvolume, needsell, sellprice, sellvolume = \
+            self.begin_transact(lastprice, nowbalance, nowstocks, bidprice, askprice, spread, minstocks, forcelurker, blind)
+        levels = []
+        if needbuy:
+            levels += self.__ladder_side(True, buyprice, buyvolume)
+        if needsell:
+            levels += self.__ladder_side(False, sellprice, sellvolume)
+        if len(levels) > int(needbuy) + int(needsell):
+            SQLog.info("begin_ladder:", self._stockcode, "_gridCursor=", self._gridCursor, "/", self.GridCount,
+                       "levels=", [[isbuy, round(float(price), self.PricePrecision), round(float(volume), 4)]
+                                   for isbuy, price, volume in levels])
+        return levels
+
+    def __ladder_side(self, isbuy, price, volume):
+        levels = [[isbuy, price, volume]]
+        balance = self._nowbalance
+        stocks = self._nowstocks
+        cursor = self._gridCursor
+        for i in range(1, self.LadderLevels):
+            # the level before is dealt and the cursor moved onto its price
+            if isbuy:
+                balance -= volume * price
+                stocks += volume
+                cursor -= 1
+            else:
+                balance += volume * price
+                stocks -= volume
+                cursor += 1
+            if self.GridType not in self.GRID_TYPES_NOBAND and (cursor <= 0 if isbuy else cursor >= self.GridCount):
+                break
+            balance_step = (balance + stocks * price) / self.GridCount
+            if isbuy:
+                price = self.GridMinPrice + cursor * self._gridStep - self._gridStep
+                value = balance + stocks * price
+                if self.GridType == self.TYPE_BLIND:
+                    wantBalance = balance - value/self.GridCount
+                else:
+                    wantBalance = self.__get_want_balance(cursor-1, value)
+                volume = min((balance - wantBalance)/(self.MaxFees * price), balance/(self.MaxFees * price),
+                             2*balance_step/price) if price > 0 else 0
+            else:
+                price = self.GridMinPrice + cursor * self._gridStep + self._gridStep
+                value = balance + stocks * price
+                if self.GridType == self.TYPE_BLIND:
+                    wantBalance = balance + value/self.GridCount
+                else:
+                    wantBalance = self.__get_want_balance(cursor+1, value)
+                volume = min((wantBalance - balance) / price, stocks, 2*balance_step/price)
+            if volume <= 0:
+                break
+            levels.append([isbuy, price, volume])
+        return levels
+
     def end_transact(self, lastprice, diffbalance, diffstocks, cursorstep, dealprice, minstocks):
         if not self._isopen:
             SQLog.error("end_transact:not opened,", self._stockcode)
@@ -0,0 +1,164 @@
+# encoding: UTF-8
+# batch version of ShannonStrategy.open/begin_transact/end_transact over whole price arrays.
+# author email: szy@tsinghua.org.cn
+
+import numpy
+
+
+def shannon_base_prices(midprice, midposition, baseleverage, minprice=None, maxprice=None):
+    # same derivation as ShannonStrategy.__init__ when MinPrice/MaxPrice are not configured, without rounding
+    midprice, midposition, baseleverage = numpy.broadcast_arrays(numpy.asarray(midprice, dtype=numpy.float64),
+                                                                 numpy.asarray(midposition, dtype=numpy.float64),
+                                                                 numpy.asarray(baseleverage, dtype=numpy.float64))
+    hl = 0.5 * baseleverage
+    valid = (hl - (1 - midposition) > 0) & (hl - midposition > 0)
+    baseprice = numpy.where(valid, midprice * (hl - (1 - midposition)) / numpy.where(valid, hl - midposition, 1), midprice)
+
+    big = baseleverage > 2.0001
+    lev = numpy.where(big, baseleverage, 4)
+    minprice_auto = numpy.where(big, baseprice * (lev - 2) / lev, baseprice * 0.0001)
+    maxprice_auto = numpy.where(big, baseprice * lev / (lev - 2), baseprice * 10000)
+    if minprice is None or maxprice is None:
+        return [baseprice, minprice_auto, maxprice_auto]
+
+    minprice, maxprice = numpy.broadcast_arrays(numpy.asarray(minprice, dtype=numpy.float64),
+                                                numpy.asarray(maxprice, dtype=numpy.float64))
+    configured = (minprice > 0) & (maxprice > 0)
+    baseprice = numpy.where(configured, numpy.sqrt(numpy.abs(minprice * maxprice)), baseprice)
+    return [baseprice, numpy.where(configured, minprice, minprice_auto), numpy.where(configured, maxprice, maxprice_auto)]
+
+
+def shannon_optimal_leverage(baseleverage, baseprice, minprice, maxprice):
+    # same as ShannonStrategy.open with UseOptimalLeverage, falls back to BaseLeverage when prices are not set properly
+    valid = (baseprice > 0) & (minprice >= 0) & (maxprice > 0) & (minprice < baseprice) & (maxprice > baseprice)
+    lmax_minprice = 2 * baseprice / numpy.where(valid, baseprice - minprice, 1)
+    lmax_maxprice = 2 * maxprice / numpy.where(valid, maxprice - baseprice, 1)
+    return numpy.where(valid, numpy.minimum(lmax_minprice, lmax_maxprice), baseleverage)
+
+
+def shannon_kernel(prices, threshold=0.005, leverage=20, baseprice=None, initbalance=1.0, initstocks=0.0,
+                   belurker=0, bemaker=0, spread=0.0, lotsize=0.0, maxfees=1.0, needreposition=0,
+                   feerate=0.0, record=True):
+    # prices: 1-D array (T,) shared by all columns, or 2-D array (T, N) of N paths.
+    # every parameter is a scalar or an array of N columns, e.g. a parameter grid.
+    # orders are filled at the tick they are placed for taker/maker, and when the price crosses for lurker.
+    prices = numpy.asarray(prices, dtype=numpy.float64)
+    params = [numpy.asarray(v, dtype=numpy.float64) for v in
+              [threshold, leverage, prices[0] if baseprice is None else baseprice, initbalance, initstocks,
+               belurker, bemaker, spread, lotsize, maxfees, needreposition, feerate]]
+    ncols = prices.shape[1] if prices.ndim == 2 else 1
+    for v in params:
+        ncols = max(ncols, v.size)
+    T, L, Pbase, initbalance, initstocks, belurker, bemaker, spread, lotsize, maxfees, needreposition, feerate = \
+        [numpy.broadcast_to(v, (ncols,)).copy() for v in params]
+    belurker = belurker > 0
+    bemaker = bemaker > 0
+    needreposition = needreposition > 0
+
+    T = numpy.where((T <= 0) | (T >= 1), 0.01, T)
+    L = numpy.where(L <= 0, 1.0, L)
+
+    nticks = prices.shape[0]
+    p = numpy.broadcast_to(prices[0], (ncols,))
+    Pbase = numpy.where(Pbase > 0, Pbase, p)
+    B = initbalance.copy()
+    S = initstocks.copy()
+    A = B + S * p
+    Bwant = (Pbase - 0.5 * L * Pbase + 0.5 * L * p) * A / (Pbase + p)
+    vB = 0.5 * L * A + B - Bwant
+    vS = (0.5 * L * A - B + Bwant) / p
+
+    trades = numpy.zeros(ncols, dtype=numpy.int64)
+    initequity = A.copy()
+    peak = A.copy()
+    maxdrawdown = numpy.zeros(ncols)
+    if record:
+        fills = numpy.zeros((nticks, ncols))
+        fillprices = numpy.zeros((nticks, ncols))
+        balances = numpy.zeros((nticks, ncols))
+        stocks = numpy.zeros((nticks, ncols))
+        equities = numpy.zeros((nticks, ncols))
+
+    for t in range(nticks):
+        p = numpy.broadcast_to(prices[t], (ncols,))
+        nowvalue = B + S * p
+        step2 = nowvalue * L * T
+
+        # lurker orders resting at the Threshold band edges, placed with the state of the last deal
+        vSpos = vS > 0
+        lurkbuy = numpy.where(vSpos, vB * (1 - T) / numpy.where(vSpos, vS * (1 + T), 1), 0)
+        lurksell = numpy.where(vSpos, vB * (1 + T) / numpy.where(vSpos, vS * (1 - T), 1), numpy.inf)
+
+        # taker or maker prices, bid/ask default to lastprice -/+ spread as in SunquantFrame.run
+        pbuy = numpy.where(bemaker, p, p + spread)
+        psell = numpy.where(bemaker, p, p - spread)
+        diffbuy = 0.5 * (vB - vS * pbuy)
+        diffsell = 0.5 * (vB - vS * psell)
+        ratiobuy = numpy.where(diffbuy > 0, diffbuy / (0.5 * (vB + vS * pbuy)), 0)
+        ratiosell = numpy.where((diffbuy <= 0) & (diffsell < 0), diffsell / (0.5 * (vB + vS * psell)), 0)
+
+        takebuy = ratiobuy >= T
+        takesell = (ratiosell <= -T) & ~takebuy
+        lurkerfillbuy = belurker & vSpos & ~takebuy & ~takesell & (p <= lurkbuy)
+        lurkerfillsell = belurker & vSpos & ~takebuy & ~takesell & (p >= lurksell)
+
+        buyprice = numpy.where(lurkerfillbuy, lurkbuy, pbuy)
+        sellprice = numpy.where(lurkerfillsell, lurksell, psell)
+        buydiff = numpy.where(lurkerfillbuy, vB * T / (1 + T), diffbuy)
+        selldiff = numpy.where(lurkerfillsell, vB * T / (1 - T), -diffsell)
+        isbuy = takebuy | lurkerfillbuy
+        issell = takesell | lurkerfillsell
+
+        safebuy = numpy.where(buyprice > 0, buyprice, 1)
+        safesell = numpy.where(sellprice > 0, sellprice, 1)
+        buyvolume = numpy.minimum(numpy.minimum(buydiff / safebuy, B / (maxfees * safebuy)), step2 / safebuy)
+        sellvolume = numpy.minimum(numpy.minimum(selldiff / safesell, S), step2 / safesell)
+        lot = lotsize > 0
+        safelot = numpy.where(lot, lotsize, 1)
+        buyvolume = numpy.where(lot, numpy.round(buyvolume / safelot) * safelot, buyvolume)
+        sellvolume = numpy.where(lot, numpy.minimum(numpy.round(sellvolume / safelot) * safelot, S - lotsize), sellvolume)
+        # lurker orders were checked against the price range when they were placed
+        buyinrange = lurkerfillbuy | ((-4 * T < (buyprice - p) / p) & ((buyprice - p) / p < 0.005))
+        sellinrange = lurkerfillsell | ((-0.005 < (sellprice - p) / p) & ((sellprice - p) / p < 4 * T))
+        dobuy = isbuy & (buyvolume > 0) & buyinrange
+        dosell = issell & (sellvolume > 0) & sellinrange
+
+        qty = numpy.where(dobuy, buyvolume, 0) - numpy.where(dosell, sellvolume, 0)
+        dealprice = numpy.where(dobuy, buyprice, numpy.where(dosell, sellprice, 0))
+        diffbalance = - qty * dealprice
+        vB = vB + diffbalance
+        vS = vS + qty
+        B = B + diffbalance - numpy.abs(diffbalance) * feerate
+        S = S + qty
+        dealt = dobuy | dosell
+        trades += dealt
+
+        # end_transact re-positioning, also run by begin_transact when an order was wanted but not placed
+        checkrepos = needreposition & (dealt | takebuy | takesell)
+        if checkrepos.any():
+            nowvalue = B + S * p
+            position = S * p / nowvalue
+            Bpos = 1 - position
+            up = checkrepos & (S < lotsize)
+            down = checkrepos & ~up & (B < lotsize * p * maxfees)
+            Bwant = numpy.where(up, numpy.maximum(1 - 0.5 * T * L, 0.5), numpy.minimum(0.5 * T * L, 0.5))
+            repos = up | down
+            vB = numpy.where(repos, nowvalue * (0.5 * L + Bpos - Bwant), vB)
+            vS = numpy.where(repos, nowvalue * (0.5 * L - Bpos + Bwant) / p, vS)
+
+        equity = B + S * p
+        peak = numpy.maximum(peak, equity)
+        maxdrawdown = numpy.maximum(maxdrawdown, 1 - equity / peak)
+        if record:
+            fills[t] = qty
+            fillprices[t] = dealprice
+            balances[t] = B
+            stocks[t] = S
+            equities[t] = equity
+
+    result = {'final_equity': B + S * p, 'init_equity': initequity, 'max_drawdown': maxdrawdown, 'trades': trades,
+              'final_balance': B, 'final_stocks': S, 'final_vbalance': vB, 'final_vstocks': vS}
+    if record:
+        result.update({'fills': fills, 'fillprices': fillprices, 'balances': balances,
+                       'stocks': stocks, 'equities': equities})
+    return result
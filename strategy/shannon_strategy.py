@@ -5,9 +5,27 @@ import random
 
 from utils.sq_log import *
 from utils.sq_setting import *
+from utils.sq_state import *
 
 
 class ShannonStrategy(object):
+    # the runtime state is kept in slots, the settings stay in __dict__ for SQSetting.fill_dict_from_settings
+    _STATE_FIELDS = [['_leverage', 'd'], ['_initprice', 'd'], ['_initbalance', 'd'], ['_initstocks', 'd'],
+                     ['_nowbalance', 'd'], ['_nowstocks', 'd'], ['_nowprice', 'd'],
+                     ['_virtualBalance', 'd'], ['_virtualStocks', 'd'], ['_triggerBuyPrice', 'd'], ['_triggerSellPrice', 'd'],
+                     ['_timesRePosition', 'q'], ['_timesReLeverage', 'q'], ['_timesOnTick', 'q'],
+                     ['_timesRatioLtThreshold', 'q'], ['_timesRatioMtThreshold', 'q'], ['_sumRatioMtThreshold', 'd'],
+                     ['_timesLurker', 'q'], ['_timesPlaceOrder', 'q'], ['_timesDeal', 'q'], ['_timesNotDeal', 'q'],
+                     ['_totalMoneyBuyDeal', 'd'], ['_totalMoneySellDeal', 'd'],
+                     ['_totalStocksBuyDeal', 'd'], ['_totalStocksSellDeal', 'd'],
+                     ['_ishalfopen', '?'], ['_isopen', '?']]
+    __slots__ = ['__dict__'] + [field[0] for field in _STATE_FIELDS]
+    # settings which __init__ and open() derive or adjust, a snapshot keeps them with the runtime state
+    _DERIVED_SETTINGS = [['Threshold', 'd'], ['BaseLeverage', 'd'], ['BasePrice', 'd'], ['MinPrice', 'd'],
+                         ['MaxPrice', 'd'], ['MidPrice', 'd'], ['StartPrice', 'd'], ['Invest', 'd']]
+    STATE_VERSION = 1
+    _STATE_LAYOUT = SQStateLayout(b'SQSS', STATE_VERSION, _STATE_FIELDS + _DERIVED_SETTINGS)
+
     BeLurker = 0
     BeMaker = 0
     MaxWaitsecsTaker = 300
@@ -43,6 +61,9 @@ class ShannonStrategy(object):
         self._nowprice = 0
         self._virtualBalance = 0
         self._virtualStocks = 0
+        # order prices at which abs(ratio) reaches Threshold, see __update_trigger_band
+        self._triggerBuyPrice = 0
+        self._triggerSellPrice = 0
         self._timesRePosition = 0
         self._timesReLeverage = 0
         self._timesOnTick = 0
@@ -83,7 +104,11 @@ class ShannonStrategy(object):
                 self.MidPrice = midprice_auto
             self.MidPrice = round(self.MidPrice * (0.999 + 0.002*random.random()), self.PricePrecision)
 
-        if self.SelfAdaptionT and volatility:
+        # the configured Threshold, adapt_threshold derives from it again
+        self._thresholdSetting = self.Threshold
+        # whether Threshold is derived from the volatility of today, restore() keeps it then
+        self._thresholdAdapted = bool(self.SelfAdaptionT and volatility)
+        if self._thresholdAdapted:
             self.Threshold = max(self.Threshold, round(volatility*0.618*0.618*0.618, 6))
 
         if not self.Invest:
@@ -137,6 +162,66 @@ class ShannonStrategy(object):
     def get_startprice(self):
         return self.StartPrice
 
+    def snapshot(self):
+        # fixed size binary record of the state, restore() on a strategy constructed with the same settings
+        # gives back this strategy without open()
+        return self._STATE_LAYOUT.pack(self)
+
+    def restore(self, data):
+        threshold = self.Threshold
+        self._STATE_LAYOUT.unpack(self, data)
+        if self._thresholdAdapted:
+            # with SelfAdaptionT the Threshold of the snapshot is not restored, the virtual position does not
+            # depend on it, the one derived from the volatility of today applies
+            self.Threshold = threshold
+            self.__update_trigger_band()
+        SQLog.info("restore:", self._stockcode, "_isopen=", self._isopen, "_nowbalance=", self._nowbalance,
+                   "_nowstocks=", self._nowstocks, "VBalance=", self._virtualBalance, "VStocks=", self._virtualStocks,
+                   "Threshold=", self.Threshold, "Leverage=", self._leverage, "/", self.BaseLeverage)
+        return True
+
+    def adapt_threshold(self, volatility):
+        # with SelfAdaptionT, derives Threshold again from the volatility estimated meanwhile. True if it changed
+        if not self.SelfAdaptionT or not volatility or not self._isopen:
+            return False
+        threshold = max(self._thresholdSetting, round(volatility*0.618*0.618*0.618, 6))
+        if threshold == self.Threshold or threshold >= 1:
+            return False
+        SQLog.info("adapt_threshold:", self._stockcode, "volatility=", volatility,
+                   "Threshold=", threshold, "prevThreshold=", self.Threshold)
+        self.Threshold = threshold
+        self._thresholdAdapted = True
+        self.__update_trigger_band()
+        return True
+
+    def get_book_state(self):
+        # the columns of StrategyBook
+        return {'isopen': self._isopen, 'nowbalance': self._nowbalance, 'nowstocks': self._nowstocks,
+                'vbalance': self._virtualBalance, 'vstocks': self._virtualStocks,
+                'threshold': self.Threshold, 'leverage': self._leverage}
+
+    def get_trigger_band(self):
+        # [buyprice, sellprice], a tick whose price to buy is above buyprice and price to sell is below sellprice
+        # has abs(ratio) < Threshold and is a no-op unless lurking; [0, 0] when there is no band
+        return [self._triggerBuyPrice, self._triggerSellPrice]
+
+    def __update_trigger_band(self):
+        # ratio = (VB - VS*P) / (VB + VS*P), so abs(ratio) < Threshold for VB*(1-T)/(VS*(1+T)) < P < VB*(1+T)/(VS*(1-T)).
+        # the band is narrowed a little, prices at its edges are still evaluated by begin_transact
+        if self._virtualStocks > 0 and self._virtualBalance > 0 and 0 < self.Threshold < 1:
+            self._triggerBuyPrice = self._virtualBalance * (1-self.Threshold) / (self._virtualStocks*(1+self.Threshold)) * (1 + 1e-9)
+            self._triggerSellPrice = self._virtualBalance * (1+self.Threshold) / (self._virtualStocks*(1-self.Threshold)) * (1 - 1e-9)
+        else:
+            self._triggerBuyPrice = 0
+            self._triggerSellPrice = 0
+
+    def skip_transact(self, lastprice):
+        # the tick is inside the trigger band (or StrategyBook found abs(ratio) < Threshold), counted as
+        # begin_transact would count it
+        self._timesOnTick += 1
+        self._timesRatioLtThreshold += 1
+        self._nowprice = lastprice
+
     def open(self, lastprice, nowbalance, nowstocks):
         if self._isopen:
             SQLog.error("open:already opened,", self._stockcode)
@@ -186,6 +271,7 @@ class ShannonStrategy(object):
         Bwant = (Pbase-0.5*self._leverage*Pbase+0.5*self._leverage*Pnow) * Anow / (Pbase+Pnow)
         self._virtualBalance = 0.5 * self._leverage * Anow + B - Bwant
         self._virtualStocks = (0.5 * self._leverage * Anow - B + Bwant) / Pnow
+        self.__update_trigger_band()
 
         openValue = self._initbalance + self._initstocks * self._initprice
         SQLog.info("open:", self._stockcode, "openValue=", openValue, "_initbalance=", self._initbalance,
@@ -351,6 +437,8 @@ class ShannonStrategy(object):
                 SQLog.info("end_transact,reposition down,", self._stockcode,
                            "_timesRePosition=", self._timesRePosition)
 
+        self.__update_trigger_band()
+
         #nowLeverage = (self._virtualBalance+self._virtualStocks*lastprice) / nowValue
         #if nowLeverage < self._leverage*0.8 or nowLeverage > self._leverage*1.2:
         #    self._virtualBalance = self._virtualBalance * self._leverage / nowLeverage
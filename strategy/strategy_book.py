@@ -0,0 +1,117 @@
+# encoding: UTF-8
+# struct of arrays over the strategies of a stock pool, evaluates the no-op test of begin_transact for all of them at once.
+# author email: szy@tsinghua.org.cn
+
+import numpy
+
+from strategy.grid_kernel import CODE_NORMAL, CODE_BLIND, _NOBAND_CODES
+
+SHANNON_COLUMNS = ['vbalance', 'vstocks', 'threshold', 'leverage']
+GRID_COLUMNS = ['cursor', 'step', 'minprice', 'maxprice', 'gridcount', 'gridtype', 'maxfees', 'needreposition',
+                'weightlower', 'weighthigher']
+
+
+class StrategyBook(object):
+    # one row per stockcode, the columns are copies of get_book_state() of the strategy objects, which stay
+    # the owners of the state. the frame calls update() after every call into a strategy which may change it.
+    #
+    # evaluate() repeats the arithmetic of begin_transact elementwise in float64, so a row is reported idle
+    # exactly when begin_transact would return no order and change nothing but the price. rows which are not
+    # open, do not match the account or have prices begin_transact treats specially are never idle.
+
+    def __init__(self, strategyname, stockcodes):
+        if strategyname not in ['grid', 'shannon']:
+            raise Exception("StrategyBook,strategy not supported,strategyname=" + strategyname)
+        self._strategyname = strategyname
+        self._stockcodes = list(stockcodes)
+        self._index = {stockcode: i for i, stockcode in enumerate(self._stockcodes)}
+        n = len(self._stockcodes)
+        self.isopen = numpy.zeros(n, dtype=bool)
+        self.nowbalance = numpy.zeros(n)
+        self.nowstocks = numpy.zeros(n)
+        self._columns = SHANNON_COLUMNS if strategyname == 'shannon' else GRID_COLUMNS
+        for column in self._columns:
+            setattr(self, column, numpy.zeros(n))
+
+    def get_stockcodes(self):
+        return self._stockcodes
+
+    def load(self, strategies):
+        for stockcode in self._stockcodes:
+            self.update(stockcode, strategies.get(stockcode))
+
+    def update(self, stockcode, stg):
+        i = self._index.get(stockcode)
+        if i is None:
+            return
+        if stg is None:
+            self.isopen[i] = False
+            return
+        state = stg.get_book_state()
+        self.isopen[i] = state['isopen']
+        self.nowbalance[i] = state['nowbalance']
+        self.nowstocks[i] = state['nowstocks']
+        for column in self._columns:
+            value = state[column]
+            getattr(self, column)[i] = numpy.nan if value is None else value
+
+    def evaluate(self, lastprices, bidprices, askprices, spreads, nowstocks, bemaker=False):
+        # arrays in the order of get_stockcodes(), nowstocks from the account and bid/ask 0 where unknown.
+        # returns the stockcodes which need begin_transact, i.e. the rows which are not idle
+        lastprices, bidprices, askprices, spreads, nowstocks = [numpy.asarray(v, dtype=numpy.float64) for v in
+                                                                [lastprices, bidprices, askprices, spreads, nowstocks]]
+        ready = self.isopen & (numpy.abs(nowstocks - self.nowstocks) <= 0.000001) & (lastprices != 0)\
+            & ~((self.nowbalance == 0) & (self.nowstocks == 0))
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            if self._strategyname == 'shannon':
+                idle = ready & self.__shannon_idle(lastprices, bidprices, askprices, spreads, bemaker)
+            else:
+                idle = ready & self.__grid_idle(lastprices)
+        return [self._stockcodes[i] for i in numpy.flatnonzero(~idle)]
+
+    def __shannon_idle(self, lastprices, bidprices, askprices, spreads, bemaker):
+        # abs(ratio) < Threshold of ShannonStrategy.begin_transact, the caller leaves lurkers to begin_transact
+        askprices = numpy.where(askprices < 0.01, lastprices, askprices)
+        bidprices = numpy.where(bidprices < 0.01, lastprices, bidprices)
+        if bemaker:
+            pricetobuy, pricetosell = bidprices + spreads, askprices - spreads
+        else:
+            pricetobuy, pricetosell = askprices, bidprices
+        vb, vs = self.vbalance, self.vstocks
+        buy = vb - vs * pricetobuy > 0
+        sell = ~buy & (vb - (vs * pricetosell) < 0)
+        ratio = numpy.zeros(len(vb))
+        ratio = numpy.where(buy, 0.5 * (vb - vs * pricetobuy) / (0.5*(vb + (vs * pricetobuy))), ratio)
+        ratio = numpy.where(sell, 0.5 * (vb - vs * pricetosell) / (0.5*(vb + vs * pricetosell)), ratio)
+        return numpy.abs(ratio) < self.threshold
+
+    def __grid_idle(self, lastprices):
+        # no reposition, needbuy and needsell False in GridStrategy.begin_transact
+        cursor, step, count, balance, stocks = self.cursor, self.step, self.gridcount, self.nowbalance, self.nowstocks
+        noband = numpy.isin(self.gridtype, _NOBAND_CODES)
+        normal = self.gridtype == CODE_NORMAL
+        blind = self.gridtype == CODE_BLIND
+
+        edge = (cursor <= 0) | (cursor >= count)
+        outside = (lastprices < self.minprice - step) | (lastprices > self.maxprice + step)
+        reposition = (self.needreposition > 0) & ~noband & edge & outside
+
+        higher = self.minprice + cursor * step + step
+        lower = self.minprice + cursor * step - step
+        lowervalue = balance + stocks * lower
+        highervalue = balance + stocks * higher
+        balance_step = (balance + stocks * lastprices) / count
+
+        wantlower = numpy.where(normal, lowervalue * (cursor-1) / count,
+                                numpy.where(blind, balance + (-1) * lowervalue / count, lowervalue * self.weightlower))
+        buyvolume = numpy.minimum(numpy.minimum((balance - wantlower) / (self.maxfees * lower),
+                                                balance / (self.maxfees * lower)), 2*balance_step/lower)
+        needbuy = ((cursor > 0) | noband) & ~(buyvolume <= 0)
+
+        wanthigher = numpy.where(normal, highervalue * (cursor+1) / count,
+                                 numpy.where(blind, balance + 1 * highervalue / count, highervalue * self.weighthigher))
+        sellvolume = numpy.minimum(numpy.minimum((wanthigher - balance) / higher, stocks), 2*balance_step/higher)
+        needsell = ((cursor < count) | noband) & ~(sellvolume <= 0)
+
+        # prices at or below zero raise or flip signs in begin_transact, they are left to it
+        return ~reposition & ~needbuy & ~needsell & (lower > 0) & (higher > 0)
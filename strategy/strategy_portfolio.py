@@ -0,0 +1,87 @@
+# encoding: UTF-8
+# running totals of the virtual assets of the strategies of a stock pool, updated per stock instead of rescanning the pool.
+# author email: szy@tsinghua.org.cn
+
+
+class StrategyPortfolio(object):
+    # one row per stockcode: [counted, invest, nowbalance, nowstocks] of its strategy, the last price of its quote
+    # and the qty of the account. a strategy is counted while it is open or halfopen. the totals are moved by the
+    # difference of a row whenever it changes, so each update is O(1) and reading a total never walks the pool.
+    #
+    # the frame calls update_strategy() wherever it updates the book and update_quote() for every stock it
+    # evaluates, load() sums everything up again from scratch once a day in init().
+
+    def __init__(self, stockcodes, invest_total):
+        self._stockcodes = list(stockcodes)
+        self._invest_total = invest_total
+        self._rows = {}
+        self._prices = {}
+        self._qtys = {}
+        self._invest = 0.0
+        self._balance = 0.0
+        # sum of nowstocks * price of the counted strategies
+        self._stocksvalue = 0.0
+        # sum of qty * price of the account over the pool
+        self._qtyvalue = 0.0
+
+    def load(self, strategies, quotes_dict, nowstocks_dict):
+        self._rows.clear()
+        self._prices.clear()
+        self._qtys.clear()
+        self._invest = self._balance = self._stocksvalue = self._qtyvalue = 0.0
+        for stockcode in self._stockcodes:
+            self._prices[stockcode] = quotes_dict.get(stockcode, {}).get('last_price', 0)
+            self._qtys[stockcode] = nowstocks_dict.get(stockcode, {}).get('qty', 0)
+            self._qtyvalue += self._qtys[stockcode] * self._prices[stockcode]
+            self.update_strategy(stockcode, strategies.get(stockcode))
+
+    def update_strategy(self, stockcode, stg):
+        if stockcode not in self._prices:
+            return
+        old = self._rows.get(stockcode)
+        if stg is not None and (stg.is_open() or stg.is_halfopen()):
+            new = [True, stg.get_invest(), stg.get_nowbalance(), stg.get_nowstocks()]
+        else:
+            new = [False, 0, 0, 0]
+        if old == new:
+            return
+        price = self._prices[stockcode]
+        if old is not None and old[0]:
+            self._invest -= old[1]
+            self._balance -= old[2]
+            self._stocksvalue -= old[3] * price
+        if new[0]:
+            self._invest += new[1]
+            self._balance += new[2]
+            self._stocksvalue += new[3] * price
+        self._rows[stockcode] = new
+
+    def update_quote(self, stockcode, lastprice, qty):
+        oldprice = self._prices.get(stockcode)
+        if oldprice is None:
+            return
+        oldqty = self._qtys[stockcode]
+        if lastprice != oldprice:
+            row = self._rows.get(stockcode)
+            if row is not None and row[0]:
+                self._stocksvalue += row[3] * (lastprice - oldprice)
+            self._prices[stockcode] = lastprice
+        if lastprice != oldprice or qty != oldqty:
+            self._qtyvalue += qty * lastprice - oldqty * oldprice
+            self._qtys[stockcode] = qty
+
+    def get_price(self, stockcode):
+        return self._prices.get(stockcode, 0)
+
+    def get_invest_nowvalue(self, stockcode):
+        row = self._rows.get(stockcode)
+        if row is None or not row[0]:
+            return 0
+        return row[2] + row[3] * self._prices[stockcode]
+
+    def get_invest_total_nowvalue(self):
+        # invest_total with the profit of the counted strategies, the value of the others is their invest
+        return self._invest_total + self._balance + self._stocksvalue - self._invest
+
+    def get_nowstocks_nowvalue(self):
+        return self._qtyvalue
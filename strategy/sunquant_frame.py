@@ -13,42 +13,96 @@ import datetime
 import pytz
 import random
 import traceback
-import threading
+import base64
+import json
+import zlib
+import collections
+import asyncio
 from utils.sq_log import *
+from utils.sq_clock import *
 from utils.sq_setting import *
+from utils.sq_quote_estimator import *
+from utils.sq_scheduler import *
+from utils.sq_save_writer import *
 import utils.sq_mail
 from strategy.grid_strategy import *
 from strategy.shannon_strategy import *
+from strategy.strategy_book import *
+from strategy.strategy_portfolio import *
 from strategy.trade_engine_base import *
 
 
 class OrderLimit(object):
-    _stock_buy_orders = {}
-    _stock_sell_orders = {}
+    # the orders of the last 24 hours per stock and side, oldest first, with their amounts summed up, so an
+    # expired order leaves from the left and a check costs no rescan. the windows are saved to the savedata
+    # directory of the market and survive the nightly re-init and restarts.
+    _windows = {}
+    _sums = {}
+    _filepath = None
+    _dirty = False
 
     @classmethod
-    def reach_limit(cls, stockcode, isbuy, amount, max_amount_in_24hours, max_times_in_24hours=10):
-        if not cls._stock_buy_orders.get(stockcode):
-            cls._stock_buy_orders[stockcode] = []
-        if not cls._stock_sell_orders.get(stockcode):
-            cls._stock_sell_orders[stockcode] = []
-        buy_orders = cls._stock_buy_orders[stockcode]
-        sell_orders = cls._stock_sell_orders[stockcode]
-
-        now = time.time()
-        buy_amount_total = 0
-        sell_amount_total = 0
-        for i in range(len(buy_orders)-1, -1, -1):
-            if now - buy_orders[i][0] > 86400:
-                buy_orders.pop(i)
-            else:
-                buy_amount_total += buy_orders[i][1]
-        for i in range(len(sell_orders)-1, -1, -1):
-            if now - sell_orders[i][0] > 86400:
-                sell_orders.pop(i)
-            else:
-                sell_amount_total += sell_orders[i][1]
+    def __window(cls, stockcode):
+        if stockcode not in cls._windows:
+            cls._windows[stockcode] = [collections.deque(), collections.deque()]
+            cls._sums[stockcode] = [0.0, 0.0]
+        return cls._windows[stockcode], cls._sums[stockcode]
+
+    @classmethod
+    def __expire(cls, stockcode, now):
+        window, sums = cls.__window(stockcode)
+        for side in [0, 1]:
+            orders = window[side]
+            while orders and now - orders[0][0] > 86400:
+                sums[side] -= orders.popleft()[1]
+                cls._dirty = True
+            if not orders:
+                sums[side] = 0.0
+        return window, sums
+
+    @classmethod
+    def load(cls, marketname):
+        if cls._filepath is not None:
+            return False
+        cls._filepath = os.path.join(SQSetting.get_savedata_dir(marketname), "orderlimit.json")
+        if not os.path.exists(cls._filepath):
+            return False
+        try:
+            with open(cls._filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            SQLog.warn("OrderLimit.load,failed,filepath=", cls._filepath, "e=", e)
+            return False
+        for stockcode, sides in data.items():
+            window, sums = cls.__window(stockcode)
+            for side, name in enumerate(['buy', 'sell']):
+                for t, amount in sides.get(name, []):
+                    window[side].append([t, amount])
+                    sums[side] += amount
+        SQLog.info("OrderLimit.load,filepath=", cls._filepath, "stockcodes=", len(data))
+        return True
+
+    @classmethod
+    def save(cls):
+        if cls._filepath is None or not cls._dirty:
+            return False
+        data = {}
+        for stockcode, window in cls._windows.items():
+            if window[0] or window[1]:
+                data[stockcode] = {'buy': list(window[0]), 'sell': list(window[1])}
+        tmppath = cls._filepath + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmppath, cls._filepath)
+        cls._dirty = False
+        return True
 
+    @classmethod
+    def reach_limit(cls, stockcode, isbuy, amount, max_amount_in_24hours, max_times_in_24hours=10):
+        now = SQClock.time()
+        window, sums = cls.__expire(stockcode, now)
+        buy_orders, sell_orders = window
+        buy_amount_total, sell_amount_total = sums
 
         if abs(len(buy_orders) - len(sell_orders)) > max_times_in_24hours:
             SQLog.warn("OrderLimit.reach_limit,times limit,ret=True,stockcode=", stockcode,
@@ -74,10 +128,10 @@ class OrderLimit(object):
                    "max_amount_in_24hours=", max_amount_in_24hours,
                    "buy_orders_count=", len(buy_orders), "sell_orders_count=", len(sell_orders),
                    "buy_amount_total=", buy_amount_total, "sell_amount_total=", sell_amount_total)
-        if isbuy:
-            buy_orders.append([now, amount])
-        else:
-            sell_orders.append([now, amount])
+        side = 0 if isbuy else 1
+        window[side].append([now, amount])
+        sums[side] += amount
+        cls._dirty = True
         return False
 
 
@@ -92,6 +146,17 @@ class SunquantFrame(object):
         self.MailSender = None
         self.MailPassword = None
         self.MaxAmountMultiplier = 10
+        self.ClockType = None
+        self.ClockSpeed = 60.0
+        self.ClockStartTime = None
+        self.WarmRestart = 1
+        self.AveVolaEwma = 1
+        self.AveVolaPeriod = 5
+        self.AveVolaMinDays = 3
+        self.AveVolaSaveSecs = 3600
+        self.AsyncDriver = 0
+        self.ParallelOrders = 1
+        self.SaveIntervalSecs = 10
 
         self._trade_engine = trade_engine
         self.PricePrecision = 2
@@ -101,23 +166,44 @@ class SunquantFrame(object):
         self._lasttime_sendmail = 0
 
         self._strategies = {}
-
-        self._orders_event = threading.Event()
+        self._book = None
+        self._portfolio = None
+        self._estimator = None
+        self._estimator_savetime = 0
+
+        self._scheduler = SQScheduler()
+        # [stockcode, func, args] of the orders to place and cancel, collected while run() or run_async evaluates
+        # the strategies and dispatched together, None calls them at once
+        self._calls = None
+        # stockcode -> saved asset entry, rebuilt only for the stockcodes in _save_dirty
+        self._save_entries = {}
+        self._save_dirty = set()
 
         SQSetting.fill_dict_from_settings(self.__dict__, 'sunquant_frame')
         SQLog.info("__init__,marketname=", marketname, "strategyname=", strategyname, "self.__dict__=", self.__dict__)
         if self._strategyname not in ['grid', 'shannon']:
             raise Exception("SunquantFrame,failed, this strategyname not supportted, strategyname=", strategyname)
+        if self.ClockType:
+            SQClock.init_default(SQClock.create(self.ClockType, self.ClockSpeed, self.ClockStartTime))
+            SQLog.info("__init__,ClockType=", self.ClockType, "ClockSpeed=", self.ClockSpeed,
+                       "ClockStartTime=", self.ClockStartTime, "now=", SQClock.now())
+        if self.AveVolaEwma:
+            self._estimator = SQQuoteEstimator(self.AveVolaPeriod, self.AveVolaMinDays)
+        self._save_writer = SQSaveWriter(self._marketname, self._strategyname, self.SaveIntervalSecs)
 
     def connection_closed(self):
-        self._orders_event.set()
+        self._scheduler.notify_orders()
 
     def order_handler(self, orderid, stockcode, isclose, isbuy, dealt_avg_price, dealt_qty, qty, price, issettled):
         if isclose and not issettled:
             SQLog.info("order_handler,order closed and not settled,stockcode=", stockcode, "orderid=", orderid)
-            self._orders_event.set()
+            self._scheduler.notify_orders()
+
+    def quote_handler(self, stockcode, lastprice):
+        self._scheduler.notify_quote(stockcode, lastprice)
 
     def __load_strategy_assets(self):
+        # the assets of the strategies as saved by the last run, before init() opens them
         quotes_dict = self._trade_engine.get_quotes_dict()
         nowstocks_dict = self._trade_engine.get_nowstocks_dict()
         invest_total = self._trade_engine.get_invest_total()
@@ -131,35 +217,30 @@ class SunquantFrame(object):
         invest_nowbalances_dict = {}
         invest_nowstocks_dict = {}
         invest_sdlastprices_dict = {}
-        if self._isinit:
-            for stockcode in self._trade_engine.get_stockcode_pools():
-                stg = self._strategies.get(stockcode)
-                if stg.is_halfopen() or stg.is_open():
-                    lastprice = quotes_dict.get(stockcode, {}).get('last_price', 0)
-                    invest_dict[stockcode] = stg.get_invest()
-                    invest_nowbalances_dict[stockcode] = stg.get_nowbalance()
-                    invest_nowstocks_dict[stockcode] = stg.get_nowstocks()
-                    invest_nowvalue = stg.get_nowbalance() + stg.get_nowstocks() * lastprice
-                    invest_sdlastprices_dict[stockcode] = lastprice
-                    invest_total_nowvalue += invest_nowvalue - stg.get_invest()
-        else:
-            savedata = SQSaveData.load_data(self._marketname, self._strategyname)
-            for stockcode in self._trade_engine.get_stockcode_pools():
-                sd_stock = savedata.get(stockcode)
-                if sd_stock:
-                    lastprice = sd_stock.get('last_price', quotes_dict.get(stockcode, {}).get('last_price', 0))
-                    balance = sd_stock.get('balance', 0)
-                    stocks = sd_stock.get('stocks', 0)
-                    invest_dict[stockcode] = sd_stock.get('invest', 1)
-                    invest_nowbalances_dict[stockcode] = balance
-                    invest_nowstocks_dict[stockcode] = stocks
-                    invest_nowvalue = balance + stocks * lastprice
-                    invest_sdlastprices_dict[stockcode] = lastprice
-                    invest_total_nowvalue += invest_nowvalue - sd_stock.get('invest', 1)
+        savedata = SQSaveData.load_data(self._marketname, self._strategyname)
+        for stockcode in self._trade_engine.get_stockcode_pools():
+            sd_stock = savedata.get(stockcode)
+            if sd_stock:
+                lastprice = sd_stock.get('last_price', quotes_dict.get(stockcode, {}).get('last_price', 0))
+                balance = sd_stock.get('balance', 0)
+                stocks = sd_stock.get('stocks', 0)
+                invest_dict[stockcode] = sd_stock.get('invest', 1)
+                invest_nowbalances_dict[stockcode] = balance
+                invest_nowstocks_dict[stockcode] = stocks
+                invest_nowvalue = balance + stocks * lastprice
+                invest_sdlastprices_dict[stockcode] = lastprice
+                invest_total_nowvalue += invest_nowvalue - sd_stock.get('invest', 1)
 
         return nowstocks_nowvalue, invest_total_nowvalue, invest_dict, invest_nowbalances_dict, invest_nowstocks_dict, invest_sdlastprices_dict
 
+    def __get_portfolio_values(self):
+        # [nowstocks_nowvalue, invest_total_nowvalue], of the running totals after init and of the saved assets before
+        if self._portfolio is None:
+            return self.__load_strategy_assets()[0:2]
+        return [self._portfolio.get_nowstocks_nowvalue(), self._portfolio.get_invest_total_nowvalue()]
+
     def __save_strategy_assets(self):
+        # only the entries of the dirty stockcodes and TOTAL are built again, the writer thread writes the file
         if not self._isinit:
             SQLog.info("__save_strategy_assets,not init")
             return False
@@ -168,37 +249,38 @@ class SunquantFrame(object):
         invest_total = self._trade_engine.get_invest_total()
         balance_total = self._trade_engine.get_nowbalance()
         nowstocks_dict = self._trade_engine.get_nowstocks_dict()
+        nowstocks_nowvalue, invest_total_nowvalue = self.__get_portfolio_values()
 
-        nowstocks_nowvalue = 0
-        for sc in self._trade_engine.get_stockcode_pools():
-            nowstocks_nowvalue += nowstocks_dict.get(sc, {}).get('qty', 0) * quotes_dict.get(sc, {}).get('last_price', 0)
-
-        invest_total_nowvalue = invest_total
-        save_dict = {}
-        for stockcode in self._trade_engine.get_stockcode_pools():
+        dirty = [sc for sc in self._trade_engine.get_stockcode_pools() if sc in self._save_dirty]
+        for stockcode in dirty:
             stg = self._strategies.get(stockcode)
+            self._save_entries.pop(stockcode, None)
             if stg.is_halfopen() or stg.is_open():
                 lastprice = stg.get_nowprice()
                 costprice = 0
                 if nowstocks_dict.get(stockcode, {}).get('cost_price_valid', False):
                     costprice = nowstocks_dict.get(stockcode, {}).get('cost_price', 0)
                 invest_nowvalue = stg.get_nowbalance() + stg.get_nowstocks() * lastprice
-                invest_total_nowvalue += invest_nowvalue - stg.get_invest()
                 stg_profit = invest_nowvalue / stg.get_invest()
                 stg_profit_benchmark = (lastprice/stg.get_startprice() - 1.0) * 0.5 + 1.0
-                save_dict[stockcode] = {'stocks_nowvalue': round(stg.get_nowstocks() * lastprice, self.PricePrecision),
-                                        'balance': round(stg.get_nowbalance(), self.PricePrecision),
-                                        'stocks': stg.get_nowstocks(),
-                                        'last_price': lastprice,
-                                        'cost_price': round(costprice, self.PricePrecision),
-                                        'start_price': stg.get_startprice(),
-                                        'invest_ratio': stg.get_investratio(),
-                                        'invest': round(stg.get_invest(), self.PricePrecision),
-                                        'invest_nowvalue': round(invest_nowvalue, self.PricePrecision),
-                                        'profit': round(stg_profit, 4),
-                                        'profit_benchmark': round(stg_profit_benchmark, 4)}
-
-        if len(save_dict) == len(self._trade_engine.get_stockcode_pools()):
+                entry = {'stocks_nowvalue': round(stg.get_nowstocks() * lastprice, self.PricePrecision),
+                         'balance': round(stg.get_nowbalance(), self.PricePrecision),
+                         'stocks': stg.get_nowstocks(),
+                         'last_price': lastprice,
+                         'cost_price': round(costprice, self.PricePrecision),
+                         'start_price': stg.get_startprice(),
+                         'invest_ratio': stg.get_investratio(),
+                         'invest': round(stg.get_invest(), self.PricePrecision),
+                         'invest_nowvalue': round(invest_nowvalue, self.PricePrecision),
+                         'profit': round(stg_profit, 4),
+                         'profit_benchmark': round(stg_profit_benchmark, 4)}
+                if stg.is_open():
+                    entry['state'] = base64.b64encode(stg.snapshot()).decode('ascii')
+                    entry['state_settings'] = self.__state_settings(stockcode)
+                self._save_entries[stockcode] = entry
+        self._save_dirty.clear()
+
+        if len(self._save_entries) == len(self._trade_engine.get_stockcode_pools()):
             ds_code = self._trade_engine.get_default_stock()
             ds_autorun = self._trade_engine.get_default_stock_autorun()
             ds_startprice = self._trade_engine.get_default_stock_startprice()
@@ -215,54 +297,157 @@ class SunquantFrame(object):
             profit_total = nowasserts_total_minus_extra / invest_total
             profit_benchmark = ds_lastprice / ds_startprice
 
-            save_dict['TOTAL'] = {'profit_total': round(profit_total, 4),
-                                  'profit_benchmark': round(profit_benchmark, 4),
-                                  'invest_total': invest_total,
-                                  'nowasserts_total_minus_extra': round(nowasserts_total_minus_extra, self.PricePrecision),
-                                  'nowasserts_total_from_engine': round(nowasserts_total, self.PricePrecision),
-                                  'balance_total-nowpower': round(balance_total, self.PricePrecision),
-                                  'nowstocks_nowvalue': round(nowstocks_nowvalue, self.PricePrecision),
-                                  'invest_total_nowvalue': round(invest_total_nowvalue, self.PricePrecision),
-                                  'strategy_stocks_profit': round(invest_total_nowvalue / invest_total, 4),
-                                  'balance_extra': round(self._trade_engine.get_balance_extra()),
-                                  'others_profit': round(others_profit, self.PricePrecision),
-                                  'default_stock_code': ds_code,
-                                  'default_stock_autorun': ds_autorun,
-                                  'default_stock_qty': ds_qty,
-                                  'default_stock_lastprice': ds_lastprice,
-                                  'default_stock_costprice': round(ds_costprice, self.PricePrecision),
-                                  'default_stock_startprice': ds_startprice,
-                                  'default_stock_nowvalue': round(ds_nowvalue, self.PricePrecision),
-                                  'default_stock_profit': round(ds_profit, self.PricePrecision)}
-
-            SQSaveData.save_data(self._marketname, self._strategyname, save_dict)
-            SQLog.info("__save_strategy_assets:save_dict=", save_dict)
+            total = {'profit_total': round(profit_total, 4),
+                     'profit_benchmark': round(profit_benchmark, 4),
+                     'invest_total': invest_total,
+                     'nowasserts_total_minus_extra': round(nowasserts_total_minus_extra, self.PricePrecision),
+                     'nowasserts_total_from_engine': round(nowasserts_total, self.PricePrecision),
+                     'balance_total-nowpower': round(balance_total, self.PricePrecision),
+                     'nowstocks_nowvalue': round(nowstocks_nowvalue, self.PricePrecision),
+                     'invest_total_nowvalue': round(invest_total_nowvalue, self.PricePrecision),
+                     'strategy_stocks_profit': round(invest_total_nowvalue / invest_total, 4),
+                     'balance_extra': round(self._trade_engine.get_balance_extra()),
+                     'others_profit': round(others_profit, self.PricePrecision),
+                     'default_stock_code': ds_code,
+                     'default_stock_autorun': ds_autorun,
+                     'default_stock_qty': ds_qty,
+                     'default_stock_lastprice': ds_lastprice,
+                     'default_stock_costprice': round(ds_costprice, self.PricePrecision),
+                     'default_stock_startprice': ds_startprice,
+                     'default_stock_nowvalue': round(ds_nowvalue, self.PricePrecision),
+                     'default_stock_profit': round(ds_profit, self.PricePrecision)}
+
+            # a new dict each time, the writer thread serializes the one it got while this thread goes on
+            save_dict = dict(self._save_entries)
+            save_dict['TOTAL'] = total
+            self._save_writer.submit(save_dict)
+            SQLog.info("__save_strategy_assets:dirty=", {sc: self._save_entries.get(sc) for sc in dirty}, "TOTAL=", total)
             return True
         else:
-            SQLog.warn("__save_strategy_assets:save_dict and stockcode_pools not match,maybe halfopen,stockcode_pools=",
-                       self._trade_engine.get_stockcode_pools(), "save_dict=", save_dict)
+            SQLog.warn("__save_strategy_assets:save_entries and stockcode_pools not match,maybe halfopen,stockcode_pools=",
+                       self._trade_engine.get_stockcode_pools(), "save_entries=", list(self._save_entries.keys()))
             return False
 
+    def __state_settings(self, stockcode):
+        # checksum of the settings a snapshot was taken with, a changed setting makes init() open the strategy again
+        parts = [SQSetting.global_settings().get(self._marketname + '_' + self._strategyname),
+                 SQSetting.global_settings().get(self._marketname + '_' + self._strategyname + '_' + stockcode)]
+        return zlib.crc32(json.dumps(parts, sort_keys=True).encode('utf-8'))
+
+    def __load_strategy_states(self):
+        # stockcode -> saved asset entry with a snapshot taken with the current settings
+        if not self.WarmRestart:
+            return {}
+        states = {}
+        savedata = SQSaveData.load_data(self._marketname, self._strategyname)
+        for stockcode in self._trade_engine.get_stockcode_pools():
+            sd_stock = savedata.get(stockcode, {})
+            if not sd_stock.get('state'):
+                continue
+            if sd_stock.get('state_settings') != self.__state_settings(stockcode):
+                SQLog.warn("__load_strategy_states,settings changed,snapshot not used,stockcode=", stockcode)
+                continue
+            states[stockcode] = sd_stock
+        return states
+
+    def __create_strategy(self, stockcode, savequote_data):
+        average = savequote_data.get(stockcode, {}).get('average', 0)
+        volatility = savequote_data.get(stockcode, {}).get('volatility', 0)
+
+        if self._strategyname == 'grid':
+            self._strategies[stockcode] = GridStrategy(stockcode, self._marketname, self._strategyname,
+                                                       self._trade_engine.get_invest_total(), average, volatility)
+        elif self._strategyname == 'shannon':
+            self._strategies[stockcode] = ShannonStrategy(stockcode, self._marketname, self._strategyname,
+                                                          self._trade_engine.get_invest_total(), average, volatility)
+        return self._strategies.get(stockcode)
+
+    def __restore_strategy(self, stockcode, stg, sd_stock):
+        try:
+            stg.restore(base64.b64decode(sd_stock.get('state')))
+        except Exception as e:
+            SQLog.warn("__restore_strategy,snapshot not restored,stockcode=", stockcode, "e=", e)
+            return False
+        return stg.is_open()
+
+    def __update_estimator(self, quotes_dict):
+        # the estimates are fed by every snapshot, the states are loaded from the quote data on the first one
+        if self._estimator is None:
+            return
+        now = SQClock.time()
+        if not self._estimator_savetime:
+            savequote_data = SQSaveData.load_quote_data()
+            self._estimator.load({sc: sd.get('ewma') for sc, sd in savequote_data.items() if isinstance(sd, dict) and sd.get('ewma')})
+            self._estimator_savetime = now
+        self._estimator.update_quotes({sc: quotes_dict.get(sc, {}) for sc in self._trade_engine.get_stockcode_pools()}, now)
+        if now - self._estimator_savetime > self.AveVolaSaveSecs:
+            self.__save_estimator()
+            self.__adapt_strategies(now)
+
+    def __adapt_strategies(self, now):
+        # the open shannon strategies follow the volatility estimated meanwhile with SelfAdaptionT, their virtual
+        # position does not depend on Threshold. MidPrice and the grid band stay until they are opened again
+        if not self._isinit or self._strategyname != 'shannon' or self._trade_engine.get_always_call_avevol():
+            return
+        for stockcode in self._trade_engine.get_stockcode_pools():
+            stg = self._strategies.get(stockcode)
+            if not stg:
+                continue
+            average, volatility = self._estimator.estimate(stockcode, now)
+            if average and stg.adapt_threshold(round(volatility, 6)):
+                self.__update_book(stockcode)
+
+    def __save_estimator(self, savequote_data=None):
+        if self._estimator is None or not self._estimator_savetime:
+            return
+        if savequote_data is None:
+            savequote_data = SQSaveData.load_quote_data()
+        for stockcode in self._trade_engine.get_stockcode_pools():
+            state = self._estimator.get_state(stockcode)
+            if state:
+                savequote_data.setdefault(stockcode, {})['ewma'] = state
+        SQSaveData.save_quote_data(savequote_data)
+        self._estimator_savetime = SQClock.time()
+        SQLog.info("__save_estimator,stockcodes=", self._trade_engine.get_stockcode_pools())
+
     def load_savequote_data(self, stockcodes):
         savequote_data = SQSaveData.load_quote_data()
         always_call = self._trade_engine.get_always_call_avevol()
         SQLog.info("load_savequote_data,stockcodes=", stockcodes, "loadQuoteData:savequote_data=", savequote_data,
                    "AlwaysCallAveVol=", always_call)
 
-        now = round(time.time(), 0)
+        now = round(SQClock.time(), 0)
         for stockcode in stockcodes:
             SQLog.info("load_savequote_data,stockcode=", stockcode, "now=", now,
                        "timestamp=", savequote_data.get(stockcode, {}).get('timestamp', 0))
+            if not savequote_data.get(stockcode):
+                savequote_data[stockcode] = {}
+            # the streaming estimates replace the klines once the stock has been watched for AveVolaMinDays days
+            if self._estimator is not None and not always_call:
+                average, volatility = self._estimator.estimate(stockcode, now)
+                if average:
+                    savequote_data[stockcode]['average'] = round(average, self._trade_engine.precision(stockcode))
+                    savequote_data[stockcode]['volatility'] = round(volatility, 6)
+                    savequote_data[stockcode]['timestamp'] = now
+                    SQLog.info("load_savequote_data,estimated,stockcode=", stockcode,
+                               "average=", savequote_data[stockcode]['average'],
+                               "volatility=", savequote_data[stockcode]['volatility'])
+                    continue
             if always_call or now - savequote_data.get(stockcode, {}).get('timestamp', 0) > 3600 * 12:
                 average, volatility = self._trade_engine.call_get_average_volatility(stockcode)
-                if not savequote_data.get(stockcode):
-                    savequote_data[stockcode] = {}
                 if average:
                     savequote_data[stockcode]['average'] = average
                     savequote_data[stockcode]['timestamp'] = now
                 if volatility:
                     savequote_data[stockcode]['volatility'] = volatility
-        SQSaveData.save_quote_data(savequote_data)
+            average = savequote_data[stockcode].get('average', 0)
+            volatility = savequote_data[stockcode].get('volatility', 0)
+            if self._estimator is not None and average and volatility:
+                self._estimator.seed(stockcode, now, average, volatility)
+        if self._estimator is not None:
+            self.__save_estimator(savequote_data)
+        else:
+            SQSaveData.save_quote_data(savequote_data)
         SQLog.info("load_savequote_data,saveQuoteData:savequote_data=", savequote_data)
 
         return savequote_data
@@ -272,36 +457,35 @@ class SunquantFrame(object):
             SQLog.info("init,already init")
             return False
 
-        accret, balance_total, nowstocks_dict = self._trade_engine.call_get_account()
-        mktret, quotes_dict = self._trade_engine.call_get_market_snapshot(self._trade_engine.get_stockcode_pools_forquotes())
+        accret, balance_total, nowstocks_dict, mktret, quotes_dict = \
+            self._trade_engine.call_get_account_snapshot(self._trade_engine.get_stockcode_pools_forquotes())
         if (not accret) or (not mktret):
             raise Exception("init,call_get_account or call_get_market_snapshot failed!")
+        self.__update_estimator(quotes_dict)
+        OrderLimit.load(self._marketname)
 
         nowstocks_nowvalue, invest_total_nowvalue, invest_dict, invest_nowbalances_dict, invest_nowstocks_dict, invest_sdlastprices_dict = self.__load_strategy_assets()
         changed = False
+        self._save_entries.clear()
+        self._save_dirty = set(self._trade_engine.get_stockcode_pools())
 
+        # the strategies restored from their snapshots keep the derived settings but the Threshold of SelfAdaptionT,
+        # all of them are constructed from the average and volatility refreshed now
+        states = self.__load_strategy_states()
         savequote_data = self.load_savequote_data(self._trade_engine.get_stockcode_pools())
 
         for stockcode in self._trade_engine.get_stockcode_pools():
             issuspension = quotes_dict.get(stockcode, {}).get('suspension', False)
             lastprice = quotes_dict.get(stockcode, {}).get('last_price', 0)
 
-            average = savequote_data.get(stockcode, {}).get('average', 0)
-            volatility = savequote_data.get(stockcode, {}).get('volatility', 0)
-
-            if self._strategyname == 'grid':
-                self._strategies[stockcode] = GridStrategy(stockcode, self._marketname, self._strategyname,
-                                                           self._trade_engine.get_invest_total(), average, volatility)
-            elif self._strategyname == 'shannon':
-                self._strategies[stockcode] = ShannonStrategy(stockcode, self._marketname, self._strategyname,
-                                                              self._trade_engine.get_invest_total(), average, volatility)
-            stg = self._strategies.get(stockcode)
+            stg = self.__create_strategy(stockcode, savequote_data)
 
             invest_nowstocks = invest_nowstocks_dict.get(stockcode, 0)
             invest_nowbalance = invest_nowbalances_dict.get(stockcode, 0)
             invest_sdlastprice = invest_sdlastprices_dict.get(stockcode, lastprice)
             invest_nowvalue = invest_nowbalance + invest_nowstocks * invest_sdlastprice
-            if abs(stg.get_invest() - invest_dict.get(stockcode, 0)) > 1:
+            changed_stock = abs(stg.get_invest() - invest_dict.get(stockcode, 0)) > 1
+            if changed_stock:
                 invest_nowbalance += (stg.get_invest() - invest_dict.get(stockcode, 0))
                 invest_nowvalue += (stg.get_invest() - invest_dict.get(stockcode, 0))
                 changed = True
@@ -311,12 +495,27 @@ class SunquantFrame(object):
             SQLog.info("--------------------init ", stockcode, "lastprice=", lastprice, "invest_nowstocks=", invest_nowstocks,
                        "invest_nowbalance=", invest_nowbalance, "--------------------")
 
+            if stockcode in states and not changed_stock and self.__restore_strategy(stockcode, stg, states[stockcode]):
+                SQLog.info("init,stockcode=", stockcode, "restored,nowbalance=", stg.get_nowbalance(),
+                           "nowstocks=", stg.get_nowstocks(), "issuspension=", issuspension)
+                if stg.SelfAdaptionMP or (self._strategyname == 'grid' and stg.SelfAdaptionT):
+                    SQLog.warn("init,restored with SelfAdaption,MidPrice and grid band kept from the snapshot,stockcode=",
+                               stockcode, "SelfAdaptionMP=", stg.SelfAdaptionMP, "SelfAdaptionT=", stg.SelfAdaptionT)
+                continue
+            if stockcode in states:
+                # not restored after all, it is opened anew without the fields the snapshot may have set
+                stg = self.__create_strategy(stockcode, savequote_data)
+
             wantBalance = stg.open(invest_sdlastprice, invest_nowbalance, invest_nowstocks)
             SQLog.info("init,stockcode=", stockcode, "halfopen=", stg.is_halfopen(),
                        "invest_nowvalue=", invest_nowvalue, "invest_nowstocks=", invest_nowstocks,
                        "invest_nowbalance=", invest_nowbalance,
                        "wantBalance=", wantBalance, "issuspension=", issuspension)
 
+        self._book = StrategyBook(self._strategyname, self._trade_engine.get_stockcode_pools())
+        self._book.load(self._strategies)
+        self._portfolio = StrategyPortfolio(self._trade_engine.get_stockcode_pools(), self._trade_engine.get_invest_total())
+        self._portfolio.load(self._strategies, quotes_dict, nowstocks_dict)
         SQLog.info("init,_strategies.len=", len(self._strategies))
         if changed:
             self.__save_strategy_assets()
@@ -328,7 +527,13 @@ class SunquantFrame(object):
             if cancelallorder and self._trade_engine.is_open():
                 self._trade_engine.call_cancel_all_orders()
             self.__deal_handle(None)
+            # the last prices and states of all the stocks, written before close returns
+            self._save_dirty.update(self._trade_engine.get_stockcode_pools())
             self.__save_strategy_assets()
+            if not self._save_writer.flush():
+                SQLog.warn("close,save_writer flush timeout")
+            self.__save_estimator()
+            OrderLimit.save()
         except Exception as e:
             SQLog.error("close, Exception,e=", e, "traceback=\n", traceback.format_exc())
 
@@ -337,6 +542,8 @@ class SunquantFrame(object):
             if stg and stg.is_open():
                 stg.close()
         self._strategies.clear()
+        self._book = None
+        self._portfolio = None
         self._isinit = False
 
         SQLog.info("close:marketname=", self._marketname, "strategyname=", self._strategyname)
@@ -345,13 +552,15 @@ class SunquantFrame(object):
     def __cancel_overtime_orders(self, overtime_secs):
         SQLog.info("__cancel_overtime_orders,overtime_secs=", overtime_secs)
         canceling = False
-        now = time.time()
+        now = SQClock.time()
         orders = self._trade_engine.get_orders_notclose(self._trade_engine.get_stockcode_pools())
         for orderid, order in orders.items():
             creatime = order.get('creatime')
+            if self.is_ladder_stock(order.get('code')):
+                continue
             if now - creatime > overtime_secs:
                 SQLog.info("__cancel_overtime_orders,timepast=", now-creatime, "order=", order)
-                self._trade_engine.call_cancel_order(orderid)
+                self.__call(order.get('code'), self._trade_engine.call_cancel_order, orderid)
                 canceling = True
         return canceling
 
@@ -378,6 +587,7 @@ class SunquantFrame(object):
                 stg = self._strategies.get(stockcode)
                 if stg:
                     stg.end_transact(lastprice, diffbalance, diffstocks, -1, dealt_avg_price, lotsize)
+                    self.__update_book(stockcode)
                 dealt = True
         else:
             diffstocks = - dealt_qty
@@ -389,11 +599,40 @@ class SunquantFrame(object):
                 stg = self._strategies.get(stockcode)
                 if stg:
                     stg.end_transact(lastprice, diffbalance, diffstocks, 1, dealt_avg_price, lotsize)
+                    self.__update_book(stockcode)
                 dealt = True
 
         self._trade_engine.order_settled(orderid)
         return dealt
 
+    def __update_book(self, stockcode):
+        self._save_dirty.add(stockcode)
+        if self._book:
+            self._book.update(stockcode, self._strategies.get(stockcode))
+        if self._portfolio:
+            self._portfolio.update_strategy(stockcode, self._strategies.get(stockcode))
+
+    def __evaluate_book(self, quotes_dict, nowstocks_dict):
+        # stockcodes which need begin_transact in this loop, all of them without a book
+        if self._book is None:
+            return set(self._trade_engine.get_stockcode_pools())
+        stockcodes = self._book.get_stockcodes()
+        lastprices, bidprices, askprices, spreads, nowstocks = [], [], [], [], []
+        for stockcode in stockcodes:
+            quote = quotes_dict.get(stockcode, {})
+            lastprice = quote.get('last_price', 0)
+            spread = quote.get('price_spread', self._trade_engine.spread(stockcode))
+            bidprice = quote.get('bid_price', lastprice - spread)
+            askprice = quote.get('ask_price', lastprice + spread)
+            lastprices.append(lastprice)
+            bidprices.append(bidprice if bidprice is not None else 0)
+            askprices.append(askprice if askprice is not None else 0)
+            spreads.append(spread)
+            nowstocks.append(nowstocks_dict.get(stockcode, {}).get('qty', 0))
+        needtransact = self._book.evaluate(lastprices, bidprices, askprices, spreads, nowstocks, ShannonStrategy.BeMaker)
+        SQLog.info("__evaluate_book,stockcodes=", len(stockcodes), "needtransact=", len(needtransact))
+        return set(needtransact)
+
     def __deal_handle(self, orders_notsettled):
         if orders_notsettled is None:
             orders_notsettled = self._trade_engine.get_orders_notsettled_idxbycode(self._trade_engine.get_stockcode_pools())
@@ -412,22 +651,114 @@ class SunquantFrame(object):
                     if self.__settle_order(order):
                         dealt = True
 
-            if settled:
+            # the other orders of a ladder stay resting, the next run moves the ladder
+            if settled and not self.__is_ladder(self._strategies.get(stockcode)):
                 for orderother in orderlist:
                     if not orderother.get('isclose'):
                         if self.__settle_order(orderother):
                             dealt = True
-                        self._trade_engine.call_cancel_order(orderother.get('order_id'))
+                        self.__call(stockcode, self._trade_engine.call_cancel_order, orderother.get('order_id'))
         return dealt
 
-    def __waitfor_deal(self, orders_notsettled, forcelurker):
-        if orders_notsettled is None:
-            orders_notsettled = self._trade_engine.get_orders_notsettled_idxbycode(self._trade_engine.get_stockcode_pools())
+    def __call(self, stockcode, func, *args):
+        if self._calls is None:
+            return func(*args)
+        self._calls.append([stockcode, func, args])
+        return None
+
+    def __take_calls(self):
+        # the collected calls grouped by stockcode in the order they were made
+        groups = {}
+        for stockcode, func, args in self._calls:
+            groups.setdefault(stockcode, []).append([func, args])
+        self._calls = []
+        return list(groups.values())
+
+    def __run_calls(self, calls):
+        # the calls of one stock one after the other, an error stops the ones after it
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception as e:
+                SQLog.error("__run_calls,failed,call=", func.__name__, "args=", args, "e=", e)
+                raise
+
+    def __check_results(self, groups, results):
+        errors = [e for e in results if isinstance(e, Exception)]
+        SQLog.info("__check_results,stockcodes=", len(groups), "calls=", sum([len(g) for g in groups]), "errors=", len(errors))
+        if errors:
+            raise errors[0]
+
+    def __dispatch_calls(self):
+        # the stocks on the threads of the engine at once, the first error is raised after all of them returned
+        groups = self.__take_calls()
+        if not groups:
+            return
+        futures = [self._trade_engine.get_executor().submit(self.__run_calls, calls) for calls in groups]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        self.__check_results(groups, results)
+
+    async def __flush_calls(self):
+        # __dispatch_calls on the event loop
+        groups = self.__take_calls()
+        if not groups:
+            return
+        results = await asyncio.gather(*[self._trade_engine.call_async(self.__run_calls, calls) for calls in groups],
+                                       return_exceptions=True)
+        self.__check_results(groups, results)
+
+    def __is_ladder(self, stg):
+        return self._strategyname == 'grid' and stg is not None and stg.get_ladderlevels() > 1
+
+    def is_ladder_stock(self, stockcode):
+        # orders of a ladder rest until the ladder moves away from them or the day ends, they never get overtime
+        return self.__is_ladder(self._strategies.get(stockcode))
+
+    def __run_ladder(self, stockcode, stg, orders, lastprice, assign_balance, nowstocks, bidprice, askprice,
+                     spread, lotsize, invest_nowvalue, iscontinousbidding, isblind):
+        # the resting orders which are still levels of the ladder are kept, so a deal only places the levels
+        # next to it and cancels the ones which fell off the far end
+        for order in orders:
+            if order.get('isclose') or order.get('dealt_qty', 0) > 0:
+                SQLog.info("__run_ladder,order dealing,waiting for settle.stockcode=", stockcode, "order=", order)
+                return False
+        levels = stg.begin_ladder(lastprice, assign_balance, nowstocks, bidprice, askprice,
+                                  spread, lotsize, not iscontinousbidding, isblind)
+        precision = self._trade_engine.precision(stockcode)
+        resting = {}
+        for order in orders:
+            resting[(bool(order.get('isbuy')), round(order.get('price', 0), precision))] = order
+
+        placed = 0
+        for isbuy, price, volume in levels:
+            volume_v, price_v = self._trade_engine.round_order_param(stockcode, volume, price, isbuy, False)
+            if volume_v <= 0 or price_v <= 0:
+                continue
+            if resting.pop((isbuy, round(price_v, precision)), None) is not None:
+                continue
+            if OrderLimit.reach_limit(stockcode, isbuy, price*volume, invest_nowvalue/2):
+                continue
+            if isbuy:
+                self.__call(stockcode, self._trade_engine.buy, stockcode, volume, price)
+            else:
+                self.__call(stockcode, self._trade_engine.sell, stockcode, volume, price)
+            placed += 1
+        for order in resting.values():
+            self.__call(stockcode, self._trade_engine.call_cancel_order, order.get('order_id'))
+        SQLog.info("__run_ladder,stockcode=", stockcode, "levels=", len(levels), "placed=", placed,
+                   "kept=", len(orders) - len(resting), "cancelled=", len(resting))
+        return True
 
-        if len(orders_notsettled) == 0:
-            SQLog.info("__waitfor_deal,notsettled orders is empty,return continue......")
-            return False
+    def get_strategyname(self):
+        return self._strategyname
 
+    def get_maxwaitsecs(self, forcelurker=False):
+        # how long an order may wait for its deal before it is cancelled
         maxwaitsecs = self.MaxWaitsecsForDeal
         if self._strategyname == 'shannon':
             maxwaitsecs = ShannonStrategy.MaxWaitsecsTaker
@@ -435,10 +766,21 @@ class SunquantFrame(object):
                 maxwaitsecs = ShannonStrategy.MaxWaitsecsLurker
             elif ShannonStrategy.BeMaker:
                 maxwaitsecs = ShannonStrategy.MaxWaitsecsMaker
+        return maxwaitsecs
 
+    def __poll_orders(self, forcelurker):
+        # overtime orders are cancelled and the orders listed on every poll, returns the seconds to the next poll,
+        # order events and relevant quotes wake the loop before it
+        orders_notsettled = self._trade_engine.get_orders_notsettled_idxbycode(self._trade_engine.get_stockcode_pools())
+        if len(orders_notsettled) == 0:
+            waitsecs = 60 if forcelurker else round(self.LoopInterval * (0.8 + 0.4*random.random()))
+            SQLog.info("__poll_orders,notsettled orders is empty,waitsecs=", waitsecs)
+            return waitsecs
+
+        maxwaitsecs = self.get_maxwaitsecs(forcelurker)
         self.__cancel_overtime_orders(maxwaitsecs)
 
-        self._trade_engine.call_list_order()
+        self.__call(None, self._trade_engine.call_list_order)
 
         if forcelurker:
             waitsecs = maxwaitsecs
@@ -450,12 +792,27 @@ class SunquantFrame(object):
         elif ShannonStrategy.BeLurker:
             waitsecs = maxwaitsecs
         else:
-            waitsecs = min(self.LoopInterval, maxwaitsecs)
-        SQLog.info("__waitfor_deal,orders=", len(orders_notsettled), "forcelurker=", forcelurker,
-                   "maxwaitsecs=", maxwaitsecs, "waitsecs=", waitsecs, "begin waiting until event set......")
-        self._orders_event.wait(waitsecs)
-        self._orders_event.clear()
-        return self.__deal_handle(None)
+            waitsecs = min(round(self.LoopInterval * (0.8 + 0.4*random.random())), maxwaitsecs)
+        SQLog.info("__poll_orders,orders=", len(orders_notsettled), "forcelurker=", forcelurker,
+                   "maxwaitsecs=", maxwaitsecs, "waitsecs=", waitsecs)
+        return waitsecs
+
+    def __update_bands(self, stockcodes, quotes_dict):
+        # quotes of a stock wake the loop when its strategy may act on them: not while its orders rest, the
+        # order events wake it then, and outside the trigger band of the strategy otherwise
+        orders_notsettled = self._trade_engine.get_orders_notsettled_idxbycode(stockcodes)
+        for stockcode in stockcodes:
+            stg = self._strategies.get(stockcode)
+            if orders_notsettled.get(stockcode) or stg is None or stg.is_halfopen() or not stg.is_open():
+                self._scheduler.set_band(stockcode, *SQScheduler.BAND_ALL)
+                continue
+            low, high = stg.get_trigger_band()
+            spread = quotes_dict.get(stockcode, {}).get('price_spread', self._trade_engine.spread(stockcode))
+            if low <= 0 or high <= 0 or high - low <= 2 * spread:
+                self._scheduler.clear_band(stockcode)
+            else:
+                # the band is of the prices to buy and sell, the last price may be a spread away from them
+                self._scheduler.set_band(stockcode, low + spread, high - spread)
 
     def __run_sellout_otherstocks(self):
         SQLog.info("__run_sellout_otherstocks,sellout_otherstocks=", self._trade_engine.get_sellout_otherstocks())
@@ -516,117 +873,240 @@ class SunquantFrame(object):
                     return diffbalance > 0
         return False
 
+    def __run_pass(self, stockcodes, full):
+        # a full pass refreshes the account and the snapshot of all quotes, the other passes evaluate the stocks
+        # woken by their quotes, on the account kept by order_handler and the snapshot of these stocks.
+        # returns [forcelurked, invest_total_nowvalue, balance_total]
+        if full:
+            accret, balance_total, nowstocks_dict, mktret, quotes_dict = \
+                self._trade_engine.call_get_account_snapshot(self._trade_engine.get_stockcode_pools_forquotes())
+        else:
+            accret, balance_total, nowstocks_dict = True, self._trade_engine.get_nowbalance(), self._trade_engine.get_nowstocks_dict()
+            mktret, quotes_dict = self._trade_engine.call_get_market_snapshot(stockcodes)
+        if (not accret) or (not mktret):
+            raise Exception("run,call_get_account or call_get_market_snapshot failed!")
+        result = self.__transact(stockcodes, balance_total, nowstocks_dict, quotes_dict)
+        if self._calls is not None:
+            self.__dispatch_calls()
+        self.__update_bands(stockcodes, quotes_dict)
+        return result
+
+    async def __run_pass_async(self, stockcodes, full):
+        # __run_pass with the orders of all stocks sent together
+        if full:
+            accret, balance_total, nowstocks_dict, mktret, quotes_dict = \
+                await self._trade_engine.call_get_account_snapshot_async(self._trade_engine.get_stockcode_pools_forquotes())
+        else:
+            accret, balance_total, nowstocks_dict = True, self._trade_engine.get_nowbalance(), self._trade_engine.get_nowstocks_dict()
+            mktret, quotes_dict = await self._trade_engine.call_get_market_snapshot_async(stockcodes)
+        if (not accret) or (not mktret):
+            raise Exception("run_async,call_get_account or call_get_market_snapshot failed!")
+        result = self.__transact(stockcodes, balance_total, nowstocks_dict, quotes_dict)
+        await self.__flush_calls()
+        self.__update_bands(stockcodes, quotes_dict)
+        return result
+
+    def __transact(self, stockcodes, balance_total, nowstocks_dict, quotes_dict):
+        forcelurked = False
+        self.__update_estimator(quotes_dict)
+
+        orders_notsettled = self._trade_engine.get_orders_notsettled_idxbycode(self._trade_engine.get_stockcode_pools())
+        needtransact = self.__evaluate_book(quotes_dict, nowstocks_dict)
+
+        for stockcode in stockcodes:
+            issuspension = quotes_dict.get(stockcode, {}).get('suspension', False)
+            lastprice = quotes_dict.get(stockcode, {}).get('last_price', 0)
+            stg = self._strategies.get(stockcode)
+            self._portfolio.update_quote(stockcode, lastprice, nowstocks_dict.get(stockcode, {}).get('qty', 0))
+            SQLog.info("--------------------run ", stockcode, "lastprice=", lastprice, "suspension=", issuspension,
+                       "halfopen=", stg.is_halfopen(), "--------------------")
+
+            if issuspension or not self._trade_engine.call_isnow_can_placeorder(stockcode):
+                continue
+            iscontinousbidding = self._trade_engine.call_isnow_continuous_bidding(stockcode)
+            isblind = self._trade_engine.call_isnow_blind(stockcode)
+            forcelurked = forcelurked or not iscontinousbidding
+
+            if orders_notsettled.get(stockcode) and not self.__is_ladder(stg):
+                SQLog.info("run,order already exits.stockcode=", stockcode, "orders=", orders_notsettled.get(stockcode))
+                continue
+
+            if lastprice == 0 and iscontinousbidding:
+                self._trade_engine.resolve_quote(stockcode)
+
+            if lastprice > 0:
+                if stg.is_halfopen() and iscontinousbidding:
+                    stg.close()
+                    wantBalance = stg.open(lastprice, stg.get_nowbalance(), stg.get_nowstocks())
+                    SQLog.info("run,halfopen,reopen,stockcode=", stockcode, "nowstocks=", stg.get_nowstocks(),
+                               "nowbalance=", stg.get_nowbalance(), "wantBalance=", wantBalance,
+                               "balance_total=", balance_total, "issuspension=", issuspension)
+                    self.__update_book(stockcode)
+                    needtransact.add(stockcode)
+
+                if not stg.is_halfopen():
+                    nowstocks = nowstocks_dict.get(stockcode, {}).get('qty', 0)
+                    invest_nowvalue = stg.get_nowbalance() + stg.get_nowstocks() * lastprice
+                    assign_balance = stg.get_nowbalance()
+                    if abs(nowstocks - stg.get_nowstocks()) > 0.000001:
+                        assign_balance = invest_nowvalue - nowstocks * lastprice
+
+                    lotsize = quotes_dict.get(stockcode, {}).get('lot_size', 1)
+                    spread = quotes_dict.get(stockcode, {}).get('price_spread', self._trade_engine.spread(stockcode))
+                    bidprice = quotes_dict.get(stockcode, {}).get('bid_price', lastprice - spread)
+                    askprice = quotes_dict.get(stockcode, {}).get('ask_price', lastprice + spread)
+
+                    if self.__is_ladder(stg):
+                        self.__run_ladder(stockcode, stg, orders_notsettled.get(stockcode, []), lastprice,
+                                          assign_balance, nowstocks, bidprice, askprice, spread, lotsize,
+                                          invest_nowvalue, iscontinousbidding, isblind)
+                        self.__update_book(stockcode)
+                        continue
+
+                    # begin_transact would only count the tick, shannon lurkers still place orders inside the band
+                    if stockcode not in needtransact and (self._strategyname == 'grid'
+                                                          or (iscontinousbidding and not ShannonStrategy.BeLurker)):
+                        stg.skip_transact(lastprice)
+                        continue
+
+                    needbuy, buyprice, buyvolume, needsell, sellprice, sellvolume = \
+                        stg.begin_transact(lastprice, assign_balance, nowstocks, bidprice, askprice,
+                                           spread, lotsize, not iscontinousbidding, isblind)
+                    self.__update_book(stockcode)
+                    if needbuy:
+                        volume_v, price_v = self._trade_engine.round_order_param(stockcode, buyvolume, buyprice, True, False)
+                        if volume_v > 0 and price_v > 0 and not OrderLimit.reach_limit(stockcode, True, buyprice*buyvolume, invest_nowvalue/2):
+                            self.__call(stockcode, self._trade_engine.buy, stockcode, buyvolume, buyprice)
+                    if needsell:
+                        volume_v, price_v = self._trade_engine.round_order_param(stockcode, sellvolume, sellprice, False, False)
+                        if volume_v > 0 and price_v > 0 and not OrderLimit.reach_limit(stockcode, False, sellprice*sellvolume, invest_nowvalue/2):
+                            self.__call(stockcode, self._trade_engine.sell, stockcode, sellvolume, sellprice)
+
+        return [forcelurked, self._portfolio.get_invest_total_nowvalue(), balance_total]
+
+    def __is_run_over(self):
+        if not self._trade_engine.call_isnow_can_placeorder():
+            SQLog.info("run: not in deal time, return.")
+            return True
+        now = SQClock.now(pytz.timezone('Etc/GMT+5'))
+        if (now.hour == 23 and not self._trade_engine.is_summer_time(now))\
+                or (now.hour == 22 and self._trade_engine.is_summer_time(now)):
+            SQLog.info("run: mid night, need re init.now=", now)
+            return True
+        return False
+
+    def __run_other_handle(self, runcounter, invest_total_nowvalue, balance_total):
+        SQLog.info("run,runcounter=", runcounter, "profit=", invest_total_nowvalue/self._trade_engine.get_invest_total(),
+                   "=", invest_total_nowvalue, "/", self._trade_engine.get_invest_total(),
+                   "balance_total=", balance_total)
+
+        if runcounter % self.DefaultOtherHandlePeriod == min(2, self.DefaultOtherHandlePeriod-1):
+            did1 = self.__run_sellout_otherstocks()
+            did2 = self.__run_defaultstock()
+            if did1 or did2:
+                self.__save_strategy_assets()
+        OrderLimit.save()
+
     def run(self):
         if not self._isinit:
             raise Exception("run,but not init!")
+        if self.AsyncDriver:
+            return asyncio.run(self.run_async())
 
         runcounter = 0
-        while True:
-            if not self._trade_engine.call_isnow_can_placeorder():
-                SQLog.info("run: not in deal time, return.")
-                return True
-            now = datetime.datetime.now(pytz.timezone('Etc/GMT+5'))
-            if (now.hour == 23 and not self._trade_engine.is_summer_time(now))\
-                    or (now.hour == 22 and self._trade_engine.is_summer_time(now)):
-                SQLog.info("run: mid night, need re init.now=", now)
-                return True
-
-            forcelurked = False
-            accret, balance_total, nowstocks_dict = self._trade_engine.call_get_account()
-            mktret, quotes_dict = self._trade_engine.call_get_market_snapshot(self._trade_engine.get_stockcode_pools_forquotes())
-            if (not accret) or (not mktret):
-                raise Exception("run,call_get_account or call_get_market_snapshot failed!")
-
-            nowstocks_nowvalue, invest_total_nowvalue, invest_dict, invest_nowbalances_dict, invest_nowstocks_dict, invest_sdlastprices_dict = self.__load_strategy_assets()
-
-            orders_notsettled = self._trade_engine.get_orders_notsettled_idxbycode(self._trade_engine.get_stockcode_pools())
-
-            for stockcode in self._trade_engine.get_stockcode_pools():
-                issuspension = quotes_dict.get(stockcode, {}).get('suspension', False)
-                lastprice = quotes_dict.get(stockcode, {}).get('last_price', 0)
-                invest_sdlastprice = invest_sdlastprices_dict.get(stockcode, lastprice)
-                stg = self._strategies.get(stockcode)
-                SQLog.info("--------------------run ", stockcode, "lastprice=", lastprice, "suspension=", issuspension,
-                           "halfopen=", stg.is_halfopen(), "--------------------")
-
-                if issuspension or not self._trade_engine.call_isnow_can_placeorder(stockcode):
+        self._scheduler.reset()
+        self._scheduler.set_timer('poll', 0)
+        # the orders of a pass are dispatched together, the stocks in parallel
+        self._calls = [] if self.ParallelOrders else None
+        try:
+            while True:
+                quotes, ordersevent, due = self._scheduler.wait()
+                if self.__is_run_over():
+                    return True
+
+                if ordersevent:
+                    dealt = self.__deal_handle(None)
+                    if self._calls is not None:
+                        self.__dispatch_calls()
+                    if dealt:
+                        self.__save_strategy_assets()
+
+                if not ordersevent and 'poll' not in due:
+                    stockcodes = [sc for sc in self._trade_engine.get_stockcode_pools() if sc in quotes]
+                    SQLog.info("run,quotes,stockcodes=", stockcodes)
+                    if stockcodes:
+                        self.__run_pass(stockcodes, False)
                     continue
-                iscontinousbidding = self._trade_engine.call_isnow_continuous_bidding(stockcode)
-                isblind = self._trade_engine.call_isnow_blind(stockcode)
-                forcelurked = forcelurked or not iscontinousbidding
 
-                if orders_notsettled.get(stockcode):
-                    SQLog.info("run,order already exits.stockcode=", stockcode, "orders=", orders_notsettled.get(stockcode))
+                forcelurked, invest_total_nowvalue, balance_total = self.__run_pass(self._trade_engine.get_stockcode_pools(), True)
+                runcounter += 1
+                self.__run_other_handle(runcounter, invest_total_nowvalue, balance_total)
+
+                waitsecs = self.__poll_orders(forcelurked)
+                if self._calls is not None:
+                    self.__dispatch_calls()
+                SQLog.info("run,forcelurked=", forcelurked, "next poll in ", waitsecs, " seconds, or on events......")
+                self._scheduler.set_timer('poll', waitsecs)
+        finally:
+            if self._calls:
+                SQLog.warn("run,calls not sent,calls=", len(self._calls))
+            self._calls = None
+
+    async def run_async(self):
+        # run() on an event loop: the strategies are still evaluated one by one on this thread, but the calls to
+        # the engine are in flight together, a slow cancel of one stock holds up no order of the others
+        if not self._isinit:
+            raise Exception("run_async,but not init!")
+
+        loop = asyncio.get_running_loop()
+        runcounter = 0
+        self._scheduler.reset()
+        self._scheduler.set_timer('poll', 0)
+        self._calls = []
+        try:
+            while True:
+                quotes, ordersevent, due = await loop.run_in_executor(None, self._scheduler.wait)
+                if self.__is_run_over():
+                    return True
+
+                if ordersevent:
+                    dealt = self.__deal_handle(None)
+                    await self.__flush_calls()
+                    if dealt:
+                        self.__save_strategy_assets()
+
+                if not ordersevent and 'poll' not in due:
+                    stockcodes = [sc for sc in self._trade_engine.get_stockcode_pools() if sc in quotes]
+                    SQLog.info("run_async,quotes,stockcodes=", stockcodes)
+                    if stockcodes:
+                        await self.__run_pass_async(stockcodes, False)
                     continue
 
-                if lastprice == 0 and iscontinousbidding:
-                    self._trade_engine.resolve_quote(stockcode)
-
-                if lastprice > 0:
-                    if stg.is_halfopen() and iscontinousbidding:
-                        stg.close()
-                        wantBalance = stg.open(invest_sdlastprice, stg.get_nowbalance(), stg.get_nowstocks())
-                        SQLog.info("run,halfopen,reopen,stockcode=", stockcode, "nowstocks=", stg.get_nowstocks(),
-                                   "nowbalance=", stg.get_nowbalance(), "wantBalance=", wantBalance,
-                                   "balance_total=", balance_total, "issuspension=", issuspension)
-
-                    if not stg.is_halfopen():
-                        nowstocks = nowstocks_dict.get(stockcode, {}).get('qty', 0)
-                        invest_nowvalue = stg.get_nowbalance() + stg.get_nowstocks() * lastprice
-                        assign_balance = stg.get_nowbalance()
-                        if abs(nowstocks - stg.get_nowstocks()) > 0.000001:
-                            assign_balance = invest_nowvalue - nowstocks * lastprice
-
-                        lotsize = quotes_dict.get(stockcode, {}).get('lot_size', 1)
-                        spread = quotes_dict.get(stockcode, {}).get('price_spread', self._trade_engine.spread(stockcode))
-                        bidprice = quotes_dict.get(stockcode, {}).get('bid_price', lastprice - spread)
-                        askprice = quotes_dict.get(stockcode, {}).get('ask_price', lastprice + spread)
-
-                        needbuy, buyprice, buyvolume, needsell, sellprice, sellvolume = \
-                            stg.begin_transact(lastprice, assign_balance, nowstocks, bidprice, askprice,
-                                               spread, lotsize, not iscontinousbidding, isblind)
-                        if needbuy:
-                            volume_v, price_v = self._trade_engine.round_order_param(stockcode, buyvolume, buyprice, True, False)
-                            if volume_v > 0 and price_v > 0 and not OrderLimit.reach_limit(stockcode, True, buyprice*buyvolume, invest_nowvalue/2):
-                                self._trade_engine.buy(stockcode, buyvolume, buyprice)
-                        if needsell:
-                            volume_v, price_v = self._trade_engine.round_order_param(stockcode, sellvolume, sellprice, False, False)
-                            if volume_v > 0 and price_v > 0 and not OrderLimit.reach_limit(stockcode, False, sellprice*sellvolume, invest_nowvalue/2):
-                                self._trade_engine.sell(stockcode, sellvolume, sellprice)
-
-            runcounter += 1
-            SQLog.info("run,runcounter=", runcounter, "profit=", invest_total_nowvalue/self._trade_engine.get_invest_total(),
-                       "=", invest_total_nowvalue, "/", self._trade_engine.get_invest_total(),
-                       "balance_total=", balance_total)
-
-            if runcounter % self.DefaultOtherHandlePeriod == min(2, self.DefaultOtherHandlePeriod-1):
-                did1 = self.__run_sellout_otherstocks()
-                did2 = self.__run_defaultstock()
-                if did1 or did2:
-                    self.__save_strategy_assets()
-
-            if not forcelurked:
-                secs_to_wait = round(self.LoopInterval * (0.8 + 0.4*random.random()))
-                SQLog.info("run,not forcelurked,waiting ", secs_to_wait, " seconds......")
-                time.sleep(secs_to_wait)
-
-            if self.__waitfor_deal(None, forcelurked):
-                self.__save_strategy_assets()
-            SQLog.info("run,waiting ", 60, " seconds......")
-            time.sleep(60)
+                forcelurked, invest_total_nowvalue, balance_total = await self.__run_pass_async(
+                    self._trade_engine.get_stockcode_pools(), True)
+                runcounter += 1
+                self.__run_other_handle(runcounter, invest_total_nowvalue, balance_total)
 
+                waitsecs = self.__poll_orders(forcelurked)
+                await self.__flush_calls()
+                SQLog.info("run_async,forcelurked=", forcelurked, "next poll in ", waitsecs, " seconds, or on events......")
+                self._scheduler.set_timer('poll', waitsecs)
+        finally:
+            if self._calls:
+                SQLog.warn("run_async,calls not sent,calls=", len(self._calls))
+            self._calls = None
 
     def send_notice_mail(self):
         try:
-            if time.time() - self._lasttime_sendmail < 3600*17:
-                SQLog.info("send_notice_mail,too frequently,now=", time.time(), "lasttime=", self._lasttime_sendmail)
+            if SQClock.time() - self._lasttime_sendmail < 3600*17:
+                SQLog.info("send_notice_mail,too frequently,now=", SQClock.time(), "lasttime=", self._lasttime_sendmail)
                 return
-            self._lasttime_sendmail = time.time()
+            self._lasttime_sendmail = SQClock.time()
 
             if self._trade_engine.is_open():
                 self._trade_engine.call_resolve_dealtsum()
 
-            nowstocks_nowvalue, invest_total_nowvalue, invest_dict, invest_nowbalances_dict, invest_nowstocks_dict, invest_sdlastprices_dict = self.__load_strategy_assets()
+            nowstocks_nowvalue, invest_total_nowvalue = self.__get_portfolio_values()
 
             quotes_dict = self._trade_engine.get_quotes_dict()
             nowstocks_dict = self._trade_engine.get_nowstocks_dict()
@@ -724,7 +1204,7 @@ class SunquantFrame(object):
 
             SQLog.info("send_notice_mail,receivers=", self._trade_engine.get_mail_receivers(), "content=", content)
             if self._trade_engine.get_mail_receivers():
-                time.sleep(round(60 * random.random()))
+                SQClock.sleep(round(60 * random.random()))
                 receivers = self._trade_engine.get_mail_receivers().split(',')
                 subject = "Sunquant 日报 " + self._marketname
                 SQLog.info("sending mail,receivers=", receivers, ",subject=", subject)
@@ -746,7 +1226,7 @@ class SunquantFrame(object):
                 if hasException:
                     hasException = False
                     SQLog.info("monitor_run, exception, waiting 900 seconds......")
-                    time.sleep(900)
+                    SQClock.sleep(900)
                     if self._trade_engine.secs_toopen() > 0:
                         self.send_notice_mail()
                     self.close()
@@ -758,7 +1238,7 @@ class SunquantFrame(object):
                 else:
                     waitsecs = waitsecs + 1 if waitsecs > 0 else 3 * random.random()
                 SQLog.info("monitor_run, waiting for open, sleeping for ", waitsecs, " seconds......")
-                time.sleep(waitsecs)
+                SQClock.sleep(waitsecs)
 
                 self._trade_engine.open_api()
                 if self._trade_engine.call_isnow_can_placeorder():
@@ -768,7 +1248,7 @@ class SunquantFrame(object):
                     self.close(True)
                 self._trade_engine.close_api()
                 SQLog.info("monitor_run, day closed, waiting 1800 seconds......")
-                time.sleep(1800)
+                SQClock.sleep(1800)
             except SystemExit:
                 self.close()
                 self._trade_engine.close_api()
@@ -6,10 +6,16 @@ import time
 import datetime
 import pytz
 import threading
+import asyncio
+import concurrent.futures
 from abc import abstractmethod
 from utils.sq_lock import *
+from utils.sq_clock import *
 from utils.sq_log import *
 from utils.sq_setting import *
+from utils.sq_kline_store import *
+from utils.sq_token_bucket import *
+from utils.sq_session_calendar import *
 
 
 class TradeEngineBase(object):
@@ -30,6 +36,14 @@ class TradeEngineBase(object):
         self.SmartAmountSegment = 10000.0
         self.MailReceivers = ""
         self.AlwaysCallAveVol = 0
+        self.KlineRefreshSecs = 3600
+        # threads of the coroutine versions of the call_* methods, 1 for engines whose calls must not overlap
+        self.AsyncWorkers = 4
+        # call_get_account_snapshot fetches the account on a thread of its own while the snapshot is fetched
+        self.ConcurrentFetch = 1
+        # orders placed and cancelled per second by all threads together, 0 for no limit of this engine
+        self.OrderRateLimit = 0
+        self.OrderRateBurst = 1
 
         # variables which NOT start with '_' are shared with subclasses
         self.stockcode_pools = []
@@ -47,10 +61,75 @@ class TradeEngineBase(object):
         self.orders_dict_lock = SQLock()
 
         self._marketname = marketname
+        self._kline_store = None
+        self._executor = None
+        self._fetch_executor = None
+        self._order_budget = None
 
         self.load_setting()
         SQLog.info("__init__,marketname=", marketname, "self.__dict__=", self.__dict__)
 
+    def get_kline_store(self):
+        if self._kline_store is None:
+            self._kline_store = SQKlineStore(self._marketname)
+        return self._kline_store
+
+    def get_klines(self, stockcode, fetch_klines, maxbars):
+        # the last maxbars daily klines of the store, fetch_klines(starttime) returns
+        # [times, opens, highs, lows, closes, volumes] of the bars from starttime on, or of its default
+        # history for starttime None. nothing is fetched if the store was updated within KlineRefreshSecs.
+        store = self.get_kline_store()
+        updated = store.updated_secs(stockcode)
+        if updated is None or updated >= self.KlineRefreshSecs:
+            for i in range(2):
+                klines = fetch_klines(store.overlap_time(stockcode))
+                if klines is None or store.append(stockcode, *klines) >= 0:
+                    break
+                store.clear(stockcode)
+        return store.read(stockcode)[-maxbars:]
+
+    def get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max(1, int(self.AsyncWorkers)),
+                                                                   'sq_' + self._marketname)
+        return self._executor
+
+    def shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._fetch_executor is not None:
+            self._fetch_executor.shutdown(wait=False)
+            self._fetch_executor = None
+
+    def wait_order_budget(self):
+        # the engines call it right before every request which places or cancels an order
+        if self._order_budget is None:
+            self._order_budget = SQTokenBucket(self.OrderRateLimit, self.OrderRateBurst)
+        gap = self._order_budget.acquire()
+        if gap > 0:
+            SQLog.info("wait_order_budget,gap=", gap)
+        return gap
+
+    def reserve_power(self, stockcode, volume, price, isbuy, ismarketorder):
+        # round_order_param with the amount of a buy taken from nowpower in the same step under the account lock,
+        # so buys placed at once cannot spend the same power. returns [volume_v, price_v, reserved], the caller
+        # gives reserved back with release_power() if the order is not placed
+        with self.account_lock:
+            volume_v, price_v = self.round_order_param(stockcode, volume, price, isbuy, ismarketorder)
+            reserved = self.MaxFees * price_v * volume_v if isbuy and volume_v > 0 else 0
+            self.nowpower -= reserved
+        return [volume_v, price_v, reserved]
+
+    def release_power(self, reserved):
+        if reserved:
+            with self.account_lock:
+                self.nowpower += reserved
+
+    async def call_async(self, func, *args):
+        # a blocking call of this engine as a coroutine, on the threads of get_executor()
+        return await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, *args)
+
     def set_frame(self, frame):
         self._frame = frame
 
@@ -80,6 +159,11 @@ class TradeEngineBase(object):
         if self._frame:
             self._frame.connection_closed()
 
+    def quote_handler(self, stockcode, lastprice):
+        # engines with pushed quotes call it for every new price, the frame decides whether it is relevant
+        if self._frame:
+            self._frame.quote_handler(stockcode, lastprice)
+
     def order_handler(self, orderid, stockcode, isclose, isbuy, dealt_avg_price, dealt_qty, qty, price):
         SQLog.info("order_handler,orderid=", orderid, "code=", stockcode, "isclose=", isclose, "isbuy=", isbuy,
                    "dealt_avg_price=", dealt_avg_price, "dealt_qty=", dealt_qty, "qty=", qty, "price=", price)
@@ -94,7 +178,7 @@ class TradeEngineBase(object):
         isbalance_addback = False
         with self.orders_dict_lock:
             if orderid not in self.orders_dict:
-                self.orders_dict[orderid] = {'order_id': orderid, 'creatime': round(time.time(), 3)}
+                self.orders_dict[orderid] = {'order_id': orderid, 'creatime': round(SQClock.time(), 3)}
             o = self.orders_dict[orderid]
 
             if stockcode is None:
@@ -152,7 +236,7 @@ class TradeEngineBase(object):
     def order_settled(self, orderid):
         with self.orders_dict_lock:
             if orderid not in self.orders_dict:
-                self.orders_dict[orderid] = {'order_id': orderid, 'creatime': round(time.time(), 3)}
+                self.orders_dict[orderid] = {'order_id': orderid, 'creatime': round(SQClock.time(), 3)}
             o = self.orders_dict[orderid]
             o['issettled'] = True
             o['isclose'] = True
@@ -293,193 +377,56 @@ class TradeEngineBase(object):
 
     @classmethod
     def is_summer_time(cls, dt):
-        #从2007年开始每年3月的第二个星期日开始夏令时，结束日期为11月的第一个星期日
-        tz = pytz.timezone('Etc/GMT+5')
-        is_summer_time = (dt.month > 3 and dt.month < 11)
-        if dt.month == 3:
-            march8th = datetime.datetime(year=dt.year, month=dt.month, day=8, hour=6, tzinfo=tz)
-            if dt.day >= 8 + 6 - march8th.weekday():
-                is_summer_time = True
-        if dt.month == 11:
-            nov1st = datetime.datetime(year=dt.year, month=dt.month, day=1, hour=6, tzinfo=tz)
-            if dt.day < 1 + 6 - nov1st.weekday():
-                is_summer_time = True
-        return is_summer_time
+        # daylight saving time of new york on the date of dt, from the date of the transition on
+        return SQSessionCalendar.get('US').is_summer_time(dt.date())
 
     @classmethod
     def secs_toopen_hk(cls):
-        tz = pytz.timezone('Etc/GMT-8')
-        now = datetime.datetime.now(tz)
-        opentime = datetime.datetime(year=now.year, month=now.month, day=now.day, hour=9, minute=30, second=0, tzinfo=tz)
-        if now.hour >= 16:
-            opentime = opentime + datetime.timedelta(days=1)
-
-        if opentime.weekday() == 5:
-            opentime = opentime + datetime.timedelta(days=2)
-        elif opentime.weekday() == 6:
-            opentime = opentime + datetime.timedelta(days=1)
-
-        secs = (opentime - now).total_seconds()
-        return secs if secs > 0 else 0
+        return SQSessionCalendar.get('HK').secs_to_open(SQClock.time())
 
     @classmethod
     def secs_toclose_hk(cls):
-        tz = pytz.timezone('Etc/GMT-8')
-        now = datetime.datetime.now(tz)
-        signtime = datetime.datetime(year=now.year, month=now.month, day=now.day, hour=16, minute=00, second=0, tzinfo=tz)
-
-        if signtime.weekday() == 5 or signtime.weekday() == 6:
-            return 0
-
-        secs = (signtime - now).total_seconds()
-        return secs if secs > 0 else 0
+        return SQSessionCalendar.get('HK').secs_to(SQClock.time(), SQSessionCalendar.CLOSE)
 
     @classmethod
     def secs_toopen_fx(cls):
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-
-        is_summer_now = cls.is_summer_time(now)
-        hour_begin = 14 if is_summer_now else 15
-        hour_end = 14 if is_summer_now else 15
-
-        if now.weekday() >= 0 and now.weekday() <= 3:
-            return 0
-        if now.weekday() == 4 and now.hour < hour_end:
-            return 0
-        if now.weekday() == 6 and now.hour >= hour_begin:
-            return 0
-
-        opentime = datetime.datetime(year=now.year, month=now.month, day=now.day, hour=hour_begin, minute=0, second=0, tzinfo=tz)
-        if opentime.weekday() == 4:
-            opentime = opentime + datetime.timedelta(days=2)
-        elif opentime.weekday() == 5:
-            opentime = opentime + datetime.timedelta(days=1)
-
-        is_summer_opentime = cls.is_summer_time(opentime)
-        if is_summer_now and not is_summer_opentime:
-            opentime = opentime + datetime.timedelta(hours=1)
-        elif (not is_summer_now) and is_summer_opentime:
-            opentime = opentime - datetime.timedelta(hours=1)
-
-        secs = (opentime - now).total_seconds()
-        return secs if secs > 0 else 0
+        return SQSessionCalendar.get('FX').secs_to_open(SQClock.time())
 
     @classmethod
     def secs_toopen_us(cls):
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-
-        is_summer_now = cls.is_summer_time(now)
-        hour_begin = 3 if is_summer_now else 4
-        hour_end = 15 if is_summer_now else 16
-        # if including after_hours: hour_end = 19 if is_summer_now else 20
-        opentime = datetime.datetime(year=now.year, month=now.month, day=now.day, hour=hour_begin, minute=0, second=0, tzinfo=tz)
-        if (now.hour == hour_end and now.minute >= 0) or (now.hour > hour_end):
-            opentime = opentime + datetime.timedelta(days=1)
-
-        if opentime.weekday() == 5:
-            opentime = opentime + datetime.timedelta(days=2)
-        elif opentime.weekday() == 6:
-            opentime = opentime + datetime.timedelta(days=1)
-
-        is_summer_opentime = cls.is_summer_time(opentime)
-        if is_summer_now and not is_summer_opentime:
-            opentime = opentime + datetime.timedelta(hours=1)
-        elif (not is_summer_now) and is_summer_opentime:
-            opentime = opentime - datetime.timedelta(hours=1)
-
-        secs = (opentime - now).total_seconds()
-        return secs if secs > 0 else 0
+        # to the pre market of the next trading day once the regular session is over
+        return SQSessionCalendar.get('US').secs_to_open(SQClock.time())
 
     @classmethod
     def secs_to_preopen_end_us(cls):
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-
-        is_summer_now = cls.is_summer_time(now)
-        hour_begin = 8 if is_summer_now else 9
-        signtime = datetime.datetime(year=now.year, month=now.month, day=now.day, hour=hour_begin, minute=30, second=0, tzinfo=tz)
-
-        if signtime.weekday() == 5 or signtime.weekday() == 6:
-            return 0
-
-        secs = (signtime - now).total_seconds()
-        return secs if secs > 0 else 0
+        return SQSessionCalendar.get('US').secs_to(SQClock.time(), SQSessionCalendar.CONTINUOUS)
 
     @classmethod
     def secs_to_afterhours_end_us(cls):
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-
-        is_summer_now = cls.is_summer_time(now)
-        hour_end = 19 if is_summer_now else 20
-        signtime = datetime.datetime(year=now.year, month=now.month, day=now.day, hour=hour_end, minute=0, second=0, tzinfo=tz)
-
-        if signtime.weekday() == 5 or signtime.weekday() == 6:
-            return 0
-
-        secs = (signtime - now).total_seconds()
-        return secs if secs > 0 else 0
+        return SQSessionCalendar.get('US').secs_to(SQClock.time(), SQSessionCalendar.AFTERHOURS)
 
     @classmethod
     def isnow_continuous_bidding_usstk(cls):
-        ret = False
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-        is_summer_now = cls.is_summer_time(now)
-        if now.weekday() < 5:
-            if is_summer_now:
-                ret = (now.hour >= 9 and now.hour < 15) or (now.hour == 8 and now.minute >= 30)
-            else:
-                ret = (now.hour >= 10 and now.hour < 16) or (now.hour == 9 and now.minute >= 30)
+        ret = SQSessionCalendar.get('US').is_open(SQClock.time(), SQSessionCalendar.CONTINUOUS, SQSessionCalendar.CLOSE)
         SQLog.info("isnow_continuous_bidding_usstk,ret=", ret)
         return ret
 
     @abstractmethod
     def isnow_can_placeorder_usstk(self):
-        ret = False
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-        is_summer_now = self.is_summer_time(now)
-        if now.weekday() < 5:
-            if is_summer_now:
-                ret = now.hour >= 3 and now.hour < 19
-            else:
-                ret = now.hour >= 4 and now.hour < 20
+        # pre market, regular session and after hours
+        ret = SQSessionCalendar.get('US').is_open(SQClock.time(), SQSessionCalendar.OPEN, SQSessionCalendar.AFTERHOURS)
         SQLog.info("isnow_can_placeorder_usstk,ret=", ret)
         return ret
 
     @classmethod
     def isnow_can_placeorder_hkstk(cls):
-        ret = False
-        tz = pytz.timezone('Etc/GMT-8')
-        now = datetime.datetime.now(tz)
-        if now.weekday() < 5:
-            ret = (now.hour == 9 and now.minute >= 30) or (now.hour > 9 and now.hour < 16)
+        ret = SQSessionCalendar.get('HK').is_open(SQClock.time())
         SQLog.info("isnow_can_placeorder_hkstk,ret=", ret)
         return ret
 
     @classmethod
     def isnow_can_placeorder_forex(cls):
-        ret = False
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-        is_summer_now = cls.is_summer_time(now)
-        if now.weekday() >= 0 and now.weekday() <= 3:
-            ret = True
-        elif now.weekday() == 4:
-            if is_summer_now:
-                ret = now.hour < 14
-            else:
-                ret = now.hour < 15
-        elif now.weekday() == 5:
-            ret = False
-        elif now.weekday() == 6:
-            if is_summer_now:
-                ret = now.hour >= 14
-            else:
-                ret = now.hour >= 15
+        ret = SQSessionCalendar.get('FX').is_open(SQClock.time())
         SQLog.info("isnow_can_placeorder_forex,ret=", ret)
         return ret
 
@@ -567,7 +514,7 @@ class TradeEngineBase(object):
             SQLog.info("smart_marketorder_waitfordeal,stockcode=", stockcode, "volume=", volume, "isbuy=", isbuy,
                        "vol_now=", vol_now, "vol_segment=", vol_segment, "vol_deal_sum=", vol_deal_sum,
                        "orderid=", orderid, "waitsecs=", waitsecs, "waiting......")
-            time.sleep(waitsecs)
+            SQClock.sleep(waitsecs)
 
             order = self.call_get_order(orderid)
             if order is None or not order.get('isclose'):
@@ -616,6 +563,12 @@ class TradeEngineBase(object):
                 volume = nowstocks - lotsize
         return self.call_place_order(stockcode, volume, price, False, False)
 
+    async def buy_async(self, stockcode, volume, price):
+        return await self.call_async(self.buy, stockcode, volume, price)
+
+    async def sell_async(self, stockcode, volume, price, leftone=True):
+        return await self.call_async(self.sell, stockcode, volume, price, leftone)
+
     def buy_waitfordeal(self, stockcode, volume):
         return self.smart_marketorder_waitfordeal(stockcode, volume, True)
 
@@ -636,6 +589,7 @@ class TradeEngineBase(object):
     @abstractmethod
     def close_api(self):
         self.clear_order_cache()
+        self.shutdown_executor()
         return True
 
     @abstractmethod
@@ -740,6 +694,25 @@ class TradeEngineBase(object):
     def call_get_account(self):
         return [False, self.nowbalance, self.nowstocks_dict]
 
+    def call_get_account_snapshot(self, stockcodes):
+        # call_get_account and call_get_market_snapshot together, a broker which answers them on separate
+        # requests takes the time of the slower one. both have returned before the results are read, so the
+        # account and the quotes are of the same moment. returns [accret, balance_total, nowstocks_dict,
+        # mktret, quotes_dict], an exception of either call is raised after both returned
+        if not self.ConcurrentFetch:
+            accret, balance_total, nowstocks_dict = self.call_get_account()
+            mktret, quotes_dict = self.call_get_market_snapshot(stockcodes)
+            return [accret, balance_total, nowstocks_dict, mktret, quotes_dict]
+        if self._fetch_executor is None:
+            self._fetch_executor = concurrent.futures.ThreadPoolExecutor(1, 'sq_fetch_' + self._marketname)
+        future = self._fetch_executor.submit(self.call_get_account)
+        try:
+            mktret, quotes_dict = self.call_get_market_snapshot(stockcodes)
+        finally:
+            accret, balance_total, nowstocks_dict = future.result()
+        SQLog.info("call_get_account_snapshot,accret=", accret, "mktret=", mktret, "stockcodes=", len(stockcodes))
+        return [accret, balance_total, nowstocks_dict, mktret, quotes_dict]
+
     @abstractmethod
     def call_resolve_dealtsum(self):
         return True
@@ -772,3 +745,36 @@ class TradeEngineBase(object):
     def call_cancel_all_orders(self):
         return False
 
+    # coroutine versions of the call_* methods, an engine with an asyncio api may override them,
+    # the others run the blocking calls on the threads of get_executor()
+
+    async def call_get_account_async(self):
+        return await self.call_async(self.call_get_account)
+
+    async def call_get_account_snapshot_async(self, stockcodes):
+        return await self.call_async(self.call_get_account_snapshot, stockcodes)
+
+    async def call_resolve_dealtsum_async(self):
+        return await self.call_async(self.call_resolve_dealtsum)
+
+    async def call_get_market_snapshot_async(self, stockcodes):
+        return await self.call_async(self.call_get_market_snapshot, stockcodes)
+
+    async def call_get_average_volatility_async(self, stockcode):
+        return await self.call_async(self.call_get_average_volatility, stockcode)
+
+    async def call_place_order_async(self, stockcode, volume, price, isbuy, ismarketorder):
+        return await self.call_async(self.call_place_order, stockcode, volume, price, isbuy, ismarketorder)
+
+    async def call_get_order_async(self, orderid):
+        return await self.call_async(self.call_get_order, orderid)
+
+    async def call_list_order_async(self):
+        return await self.call_async(self.call_list_order)
+
+    async def call_cancel_order_async(self, orderid):
+        return await self.call_async(self.call_cancel_order, orderid)
+
+    async def call_cancel_all_orders_async(self):
+        return await self.call_async(self.call_cancel_all_orders)
+
@@ -0,0 +1,158 @@
+# encoding: UTF-8
+# local matching of resting limit orders for backtests: queue position, partial fills and expiry.
+# author email: szy@tsinghua.org.cn
+
+import heapq
+
+
+class SimBook(object):
+    # resting orders of one stock: buys and sells in price-time priority, expiry in time order.
+    # entries of cancelled or closed orders stay in the heaps and are dropped when they reach the top.
+
+    def __init__(self):
+        self.buys = []
+        self.sells = []
+        self.expiry = []
+
+    def is_empty(self):
+        return not (self.buys or self.sells or self.expiry)
+
+
+class SimExchange(object):
+    # handler is TradeEngineBase.order_handler, called as the real engines do: dealt_qty is cumulative,
+    # isclose is False for a partial fill and True once the order is fully dealt, cancelled or expired.
+    #
+    # an order resting at a price which the bar goes through by one spread or more is fully dealt.
+    # when the bar only touches the price, touchratio of the bar volume is traded there, it first
+    # consumes the volume queued ahead of the order (queueratio of the bar volume before the order
+    # was placed) and then fills the order partially. without volume data a touch fills the order.
+
+    def __init__(self, handler, pricespread=0.01, queueratio=0.5, touchratio=0.2):
+        self._handler = handler
+        self._pricespread = pricespread
+        self._queueratio = queueratio
+        self._touchratio = touchratio
+        self._orders = {}
+        self._books = {}
+        self._seq = 0
+        self.times_deal = 0
+        self.times_fill = 0
+        self.times_expire = 0
+
+    def get_orders(self):
+        return self._orders
+
+    def reserved_balance(self, maxfees):
+        reserved = 0
+        for order in self._orders.values():
+            if order['isbuy']:
+                reserved += (order['qty'] - order['dealt_qty']) * order['price'] * maxfees
+        return reserved
+
+    def place(self, orderid, stockcode, isbuy, qty, price, creatime, expiretime=None, barvolume=None,
+              marketable=False):
+        book = self._books.get(stockcode)
+        if book is None:
+            book = SimBook()
+            self._books[stockcode] = book
+        queueahead = 0 if (marketable or barvolume is None) else barvolume * self._queueratio
+        self._orders[orderid] = {'code': stockcode, 'isbuy': isbuy, 'qty': qty, 'price': price,
+                                 'creatime': creatime, 'expiretime': expiretime, 'queueahead': queueahead,
+                                 'dealt_qty': 0, 'dealt_value': 0}
+        self._seq += 1
+        if isbuy:
+            heapq.heappush(book.buys, (-price, self._seq, orderid))
+        else:
+            heapq.heappush(book.sells, (price, self._seq, orderid))
+        if expiretime is not None:
+            heapq.heappush(book.expiry, (expiretime, self._seq, orderid))
+
+    def cancel(self, orderid):
+        # the removed order or None, the caller reports the close through order_handler
+        order = self._orders.pop(orderid, None)
+        if order is not None and order['dealt_qty'] > 0:
+            self.times_deal += 1
+        return order
+
+    @staticmethod
+    def __avg_price(order):
+        return order['dealt_value'] / order['dealt_qty'] if order['dealt_qty'] > 0 else order['price']
+
+    def __close(self, orderid, order):
+        self._orders.pop(orderid, None)
+        if order['dealt_qty'] > 0:
+            self.times_deal += 1
+        self._handler(orderid, order['code'], True, order['isbuy'], self.__avg_price(order),
+                      order['dealt_qty'], order['qty'], order['price'])
+
+    def __expire_book(self, book, now):
+        expiry = book.expiry
+        while expiry and expiry[0][0] < now:
+            orderid = heapq.heappop(expiry)[2]
+            order = self._orders.get(orderid)
+            if order is not None:
+                self.times_expire += 1
+                self.__close(orderid, order)
+
+    def expire(self, now):
+        # orders whose expiretime is before now, for the stocks without a bar at now
+        for book in self._books.values():
+            if book.expiry:
+                self.__expire_book(book, now)
+
+    def __match_side(self, heap, isbuy, bartime, openprice, extreme, touchvolume):
+        deferred = []
+        while heap:
+            orderid = heap[0][2]
+            order = self._orders.get(orderid)
+            if order is None:
+                heapq.heappop(heap)
+                continue
+            price = order['price']
+            if (extreme > price) if isbuy else (extreme < price):
+                break
+            if order['creatime'] >= bartime:
+                deferred.append(heapq.heappop(heap))
+                continue
+
+            remaining = order['qty'] - order['dealt_qty']
+            if (extreme <= price - self._pricespread) if isbuy else (extreme >= price + self._pricespread):
+                fillqty = remaining
+            elif touchvolume is None:
+                fillqty = remaining
+            else:
+                used = min(order['queueahead'], touchvolume)
+                order['queueahead'] -= used
+                touchvolume -= used
+                fillqty = min(remaining, touchvolume)
+                touchvolume -= fillqty
+
+            if fillqty > 0:
+                dealprice = min(price, openprice) if isbuy else max(price, openprice)
+                order['dealt_qty'] += fillqty
+                order['dealt_value'] += fillqty * dealprice
+                self.times_fill += 1
+            if fillqty >= remaining - 0.00000001:
+                heapq.heappop(heap)
+                self.__close(orderid, order)
+                continue
+            if fillqty > 0:
+                self._handler(orderid, order['code'], False, order['isbuy'], self.__avg_price(order),
+                              order['dealt_qty'], order['qty'], order['price'])
+            # the volume at the touched price is used up, orders behind it can not be dealt in this bar
+            break
+        for item in deferred:
+            heapq.heappush(heap, item)
+
+    def match_bar(self, stockcode, bartime, openprice, high, low, volume=None):
+        # orders placed before bartime against the bar [open, high, low], volume None for unlimited
+        book = self._books.get(stockcode)
+        if book is None or book.is_empty():
+            return
+        if book.expiry:
+            self.__expire_book(book, bartime)
+        touchvolume = None if volume is None else volume * self._touchratio
+        if book.buys:
+            self.__match_side(book.buys, True, bartime, openprice, low, touchvolume)
+        if book.sells:
+            self.__match_side(book.sells, False, bartime, openprice, high, touchvolume)
@@ -0,0 +1,394 @@
+# encoding: UTF-8
+# offline backtest engine, replays local bars or ticks with a simulated clock.
+# author email: szy@tsinghua.org.cn
+
+import platform
+import os
+import sys
+import numpy
+import pandas
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from strategy.trade_engine_base import *
+from strategy.sunquant_frame import *
+from tradeengine.sim_exchange import *
+
+
+class TradeEngineBacktest(TradeEngineBase):
+
+    def __init__(self, marketname):
+        super().__init__(marketname)
+
+        # variables which start with uppercase letter may have configuration in setting.json
+        self.DataPath = None
+        self.DataTimeZone = 'UTC'
+        self.InitBalance = None
+        self.LotSize = 1
+        self.PriceSpread = 0.01
+        self.StartTime = None
+        self.EndTime = None
+        self.ClockStep = 60
+        # fill model of the resting orders, see SimExchange; ExpireOrders cancels an order after the
+        # MaxWaitsecsTaker/Maker/Lurker or MaxWaitsecsForDeal of the frame
+        self.QueueAheadRatio = 0.5
+        self.TouchVolumeRatio = 0.2
+        self.ExpireOrders = True
+        # marketname of a live engine whose kline store provides the daily klines before the simulated day,
+        # None for daily klines aggregated from the bars into the store of this market
+        self.KlineMarket = None
+        # a run starts without the strategy assets and quote data of the previous run
+        self.ResetSaveData = True
+        # the calls run one by one in the order they are made, so a run is repeatable
+        self.AsyncWorkers = 1
+        self.ConcurrentFetch = 0
+
+        self.load_setting()
+
+        # stockcode -> [times, opens, highs, lows, closes, bids, asks, volumes], volumes is None without volume data
+        self._bars = {}
+        self._bars_cursor = {}
+        # stockcode -> [utc day, high, low] of the bars replayed, the high_price and low_price of the snapshot
+        self._day_range = {}
+        self._starttime = 0
+        self._endtime = 0
+        self._exchange = SimExchange(self.order_handler, self.PriceSpread, self.QueueAheadRatio, self.TouchVolumeRatio)
+        self._orderid_counter = 0
+        self._isopen = False
+        self._equity_peak = 0
+        self._max_drawdown = 0
+        self._kline_store = SQKlineStore(self.KlineMarket if self.KlineMarket else marketname)
+
+        self._clock = SQSimClock(0, self.ClockStep)
+        self._clock.add_listener(self.__replay_until)
+
+        SQLog.info("__init__,marketname=", marketname, "self.__dict__=", self.__dict__)
+
+    def __to_timestamp(self, value):
+        if value is None:
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        ts = pandas.Timestamp(value)
+        if ts.tzinfo is None:
+            ts = ts.tz_localize(self.DataTimeZone)
+        return ts.timestamp()
+
+    def __load_bars(self, stockcode):
+        filepath = os.path.join(self.DataPath, stockcode + ".csv")
+        if not os.path.exists(filepath):
+            raise Exception("__load_bars failed,no data file,stockcode=" + stockcode + ",filepath=" + filepath)
+        df = pandas.read_csv(filepath)
+        timecol = df.columns[0]
+        if pandas.api.types.is_numeric_dtype(df[timecol]):
+            times = df[timecol].astype('float64')
+        else:
+            dt = pandas.to_datetime(df[timecol])
+            if dt.dt.tz is None:
+                dt = dt.dt.tz_localize(self.DataTimeZone)
+            times = (dt - pandas.Timestamp(0, tz='UTC')) / pandas.Timedelta(seconds=1)
+        # prices on the tick of a live engine, without bid and ask the quote is a spread around the close,
+        # as the frame assumes for a quote without them, so a taker order crosses the spread
+        precision = self.precision(stockcode)
+        closes = (df['close'] if 'close' in df.columns else df['price']).round(precision)
+        opens = df['open'].round(precision) if 'open' in df.columns else closes
+        highs = df['high'].round(precision) if 'high' in df.columns else closes
+        lows = df['low'].round(precision) if 'low' in df.columns else closes
+        bids = df['bid'].round(precision) if 'bid' in df.columns else (closes - self.PriceSpread).round(precision)
+        asks = df['ask'].round(precision) if 'ask' in df.columns else (closes + self.PriceSpread).round(precision)
+        bars = pandas.DataFrame({'time': times, 'open': opens, 'high': highs, 'low': lows,
+                                 'close': closes, 'bid': bids, 'ask': asks})
+        if 'volume' in df.columns:
+            bars['volume'] = df['volume'].astype('float64')
+        bars = bars.sort_values('time')
+
+        starttime = self.__to_timestamp(self.StartTime)
+        endtime = self.__to_timestamp(self.EndTime)
+        if starttime is not None:
+            bars = bars[bars['time'] >= starttime]
+        if endtime is not None:
+            bars = bars[bars['time'] <= endtime]
+        SQLog.info("__load_bars,stockcode=", stockcode, "filepath=", filepath, "bars=", len(bars))
+        volumes = bars['volume'].values if 'volume' in bars.columns else None
+        return [bars[c].values for c in ['time', 'open', 'high', 'low', 'close', 'bid', 'ask']] + [volumes]
+
+    def __replay_until(self, now):
+        if not self._isopen:
+            return
+        exchange = self._exchange
+        for stockcode, bars in self._bars.items():
+            times, opens, highs, lows, closes, bids, asks, volumes = bars
+            i = self._bars_cursor[stockcode]
+            while i < len(times) and times[i] <= now:
+                exchange.match_bar(stockcode, times[i], opens[i], highs[i], lows[i],
+                                   None if volumes is None else volumes[i])
+                r = self._day_range.get(stockcode)
+                if r is None or r[0] != int(times[i] // 86400):
+                    self._day_range[stockcode] = [int(times[i] // 86400), highs[i], lows[i]]
+                else:
+                    r[1] = max(r[1], highs[i])
+                    r[2] = min(r[2], lows[i])
+                i += 1
+            advanced = i > self._bars_cursor[stockcode]
+            self._bars_cursor[stockcode] = i
+            if i > 0:
+                q = self.quotes_dict.get(stockcode)
+                q['last_price'] = closes[i-1]
+                q['bid_price'] = bids[i-1]
+                q['ask_price'] = asks[i-1]
+                q['high_price'] = self._day_range[stockcode][1]
+                q['low_price'] = self._day_range[stockcode][2]
+                if advanced:
+                    self.quote_handler(stockcode, q['last_price'])
+        exchange.expire(now)
+
+        equity = self.nowbalance
+        for stockcode, stock in self.nowstocks_dict.items():
+            equity += stock.get('qty', 0) * self.quotes_dict.get(stockcode, {}).get('last_price', 0)
+        self.nowasserts_total = equity
+        self._equity_peak = max(self._equity_peak, equity)
+        if self._equity_peak > 0:
+            self._max_drawdown = max(self._max_drawdown, 1 - equity / self._equity_peak)
+
+    def is_finished(self):
+        return self._clock.time() >= self._endtime
+
+    def get_backtest_result(self):
+        invest_total = self.get_invest_total()
+        return {'starttime': datetime.datetime.fromtimestamp(self._starttime, pytz.utc).isoformat(),
+                'endtime': self._clock.now(pytz.utc).isoformat(),
+                'nowasserts_total': round(float(self.nowasserts_total), 2),
+                'profit_total': round(float(self.nowasserts_total) / invest_total, 4) if invest_total else 0,
+                'max_drawdown': round(float(self._max_drawdown), 4),
+                'times_deal': self._exchange.times_deal,
+                'times_fill': self._exchange.times_fill,
+                'times_expire': self._exchange.times_expire}
+
+    def __reset_savedata(self):
+        # quote data is kept in the savedata directory of this market, apart from the stkquote.json of live engines
+        sd_path = SQSetting.get_savedata_dir(self._marketname)
+        SQSaveData.set_quote_filepath(os.path.join(sd_path, "stkquote.json"))
+        if self.ResetSaveData:
+            filepaths = [os.path.join(sd_path, "stkquote.json"), os.path.join(sd_path, "orderlimit.json")]
+            if self._frame:
+                filepaths.append(os.path.join(sd_path, self._frame.get_strategyname() + ".json"))
+            for filepath in filepaths:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                    SQLog.info("__reset_savedata,removed,filepath=", filepath)
+
+    def open_api(self):
+        SQLog.info("open_api,already open=", self.is_open())
+        if self._isopen:
+            return True
+        SQClock.init_default(self._clock)
+        if not self._bars:
+            self.__reset_savedata()
+            starttime = None
+            stockcodes = self.get_stockcode_pools().copy()
+            if self.DefaultStock and os.path.exists(os.path.join(self.DataPath, self.DefaultStock + ".csv")):
+                stockcodes.append(self.DefaultStock)
+            for stockcode in stockcodes:
+                self._bars[stockcode] = self.__load_bars(stockcode)
+                self._bars_cursor[stockcode] = 0
+                if not self.KlineMarket:
+                    self._kline_store.clear(stockcode)
+                self.quotes_dict[stockcode] = {'lot_size': self.LotSize, 'price_spread': self.PriceSpread,
+                                               'suspension': False, 'stock_name': stockcode}
+                times = self._bars[stockcode][0]
+                if len(times) > 0:
+                    starttime = times[0] if starttime is None else min(starttime, times[0])
+                    self._endtime = max(self._endtime, times[-1])
+            if starttime is None:
+                raise Exception("open_api failed,no bars loaded,DataPath=" + str(self.DataPath))
+            self.nowbalance = self.InitBalance if self.InitBalance is not None else self.get_invest_total()
+            self.nowpower = self.nowbalance
+            self._starttime = starttime
+            self._clock.advance_to(starttime)
+        self._isopen = True
+        self._clock.advance_to(self._clock.time())
+        super().open_api()
+        return True
+
+    def close_api(self):
+        self._isopen = False
+        super().close_api()
+        SQLog.info("close_api")
+        return True
+
+    def is_open(self):
+        return self._isopen
+
+    def resolve_quote(self, stockcode):
+        return True
+
+    def secs_toopen(self):
+        return 0
+
+    def secs_to_preopen_end(self):
+        return 0
+
+    def secs_to_afterhours_end(self):
+        return 0
+
+    def has_preopen(self):
+        return False
+
+    def call_isnow_can_placeorder(self, stockcode=None):
+        return not self.is_finished()
+
+    def call_isnow_continuous_bidding(self, stockcode=None):
+        return True
+
+    def call_isnow_blind(self, stockcode=None):
+        return False
+
+    def call_get_account(self):
+        with self.account_lock:
+            self.nowpower = self.nowbalance - self._exchange.reserved_balance(self.MaxFees)
+        SQLog.info("call_get_account,nowbalance=", self.nowbalance, "nowpower=", self.nowpower,
+                   "nowasserts_total=", self.nowasserts_total, "nowstocks_dict=", self.nowstocks_dict)
+        return [True, self.nowbalance, self.nowstocks_dict]
+
+    def call_get_market_snapshot(self, stockcodes):
+        SQLog.info("call_get_market_snapshot,now=", self._clock.time(), "quotes_dict=", self.quotes_dict)
+        return [True, self.quotes_dict]
+
+    @staticmethod
+    def __aggregate_days(bars, i0, i1):
+        # [times, opens, highs, lows, closes, volumes] of the daily klines of bars[i0:i1]
+        times, opens, highs, lows, closes, bids, asks, volumes = bars
+        days = times[i0:i1] // 86400
+        starts = numpy.flatnonzero(numpy.r_[True, days[1:] != days[:-1]])
+        ends = numpy.r_[starts[1:], len(days)] - 1
+        return [days[starts] * 86400, opens[i0:i1][starts], numpy.maximum.reduceat(highs[i0:i1], starts),
+                numpy.minimum.reduceat(lows[i0:i1], starts), closes[i0:i1][ends],
+                None if volumes is None else numpy.add.reduceat(volumes[i0:i1], starts)]
+
+    def __daily_klines(self, stockcode):
+        # [closes, highs, lows] of the days until the simulated time, the completed days are read from the
+        # kline store, which is appended with the days completed since the last call
+        store = self.get_kline_store()
+        today = self._clock.time() // 86400 * 86400
+        if self.KlineMarket:
+            days = store.read(stockcode, endtime=today)
+            return [days['close'], days['high'], days['low']]
+
+        bars = self._bars.get(stockcode)
+        times = bars[0]
+        i = self._bars_cursor[stockcode]
+        last = store.last_time(stockcode)
+        i0 = 0 if last is None else int(numpy.searchsorted(times, last + 86400, 'left'))
+        i1 = int(numpy.searchsorted(times[:i], today, 'left'))
+        if i1 > i0:
+            store.append(stockcode, *self.__aggregate_days(bars, i0, i1))
+        days = store.read(stockcode, endtime=today)
+        closes, highs, lows = days['close'], days['high'], days['low']
+        if i > i1:
+            forming = self.__aggregate_days(bars, i1, i)
+            closes = numpy.append(closes, forming[4])
+            highs = numpy.append(highs, forming[2])
+            lows = numpy.append(lows, forming[3])
+        return [closes, highs, lows]
+
+    def call_get_average_volatility(self, stockcode):
+        if stockcode not in self._bars:
+            return [0, 0]
+        closes, highs, lows = self.__daily_klines(stockcode)
+
+        period = 5
+        if len(closes) >= max(period, 6):
+
+            average = round(sum(closes[-period:]) / period, self.precision(stockcode))
+
+            sumv = 0.0
+            for i in range(-1, -6, -1):
+                sumv += abs(highs[i] / lows[i] - 1) if lows[i] > 0 else 0
+                sumv += abs(closes[i] / closes[i-1] - 1) if closes[i-1] > 0 else 0
+            volatility = round(sumv / 10, 6)
+            SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=", average, "volatility=", volatility)
+            return [average, volatility]
+        else:
+            SQLog.info("call_get_average_volatility,days too small,stockcode=", stockcode, "days=", len(closes))
+            return [0, 0]
+
+    def call_place_order(self, stockcode, volume, price, isbuy, ismarketorder):
+        volume_v, price_v, reserved = self.reserve_power(stockcode, volume, price, isbuy, ismarketorder)
+        if volume_v <= 0:
+            SQLog.info("call_place_order failed,volume_v<=0,stockcode=", stockcode,
+                       "volume=", volume, "volume_v=", volume_v, "price=", price, "price_v=", price_v,
+                       "isbuy=", isbuy, "ismarketorder=", ismarketorder)
+            return None
+        if 0 == price_v:
+            SQLog.info("call_place_order failed,price==0,stockcode=", stockcode, "volume=", volume, "price=", price,
+                       "isbuy=", isbuy, "ismarketorder=", ismarketorder)
+            return None
+
+        self._orderid_counter += 1
+        orderid = 'BT' + str(self._orderid_counter)
+        now = self._clock.time()
+        q = self.quotes_dict.get(stockcode, {})
+        marketable = price_v >= q.get('ask_price', price_v) if isbuy else price_v <= q.get('bid_price', price_v)
+        barvolume = None
+        bars = self._bars.get(stockcode)
+        if bars is not None and bars[7] is not None and self._bars_cursor[stockcode] > 0:
+            barvolume = bars[7][self._bars_cursor[stockcode] - 1]
+        expiretime = None
+        if self.ExpireOrders and self._frame and not self._frame.is_ladder_stock(stockcode):
+            expiretime = now + self._frame.get_maxwaitsecs()
+        self._exchange.place(orderid, stockcode, isbuy, volume_v, price_v, now, expiretime, barvolume, marketable)
+        self.order_handler(orderid, stockcode, False, isbuy, None, 0, volume_v, price_v)
+        SQLog.info("call_place_order,stockcode=", stockcode, "volume=", volume, "volume_v=", volume_v,
+                   "price=", price, "price_v=", price_v,
+                   "isbuy=", isbuy, "ismarketorder=", ismarketorder, "orderid=", orderid)
+        SQLog.info("--------------------PlaceOrderOK--------------------", stockcode, "--------------------",
+                   'BUY' if isbuy else 'SELL', volume_v, '@ ', price_v, "--------------------", orderid)
+        return orderid
+
+    def call_get_order(self, orderid):
+        order = self.get_order_from_cache(orderid)
+        SQLog.info("call_get_order,orderid=", orderid, "order=", order)
+        return order
+
+    def call_list_order(self):
+        SQLog.info("call_list_order,resting orders=", self._exchange.get_orders())
+        return True
+
+    def call_cancel_order(self, orderid):
+        if orderid is None or self._exchange.cancel(orderid) is None:
+            SQLog.info("call_cancel_order,orderid=", orderid, "return False")
+            return False
+        self.order_handler(orderid, None, True, None, None, None, None, None)
+        SQLog.info("call_cancel_order,orderid=", orderid, "result=True")
+        return True
+
+    def call_cancel_all_orders(self):
+        for orderid in list(self._exchange.get_orders().keys()):
+            self.call_cancel_order(orderid)
+        SQLog.info("call_cancel_all_orders")
+        return True
+
+    def backtest_run(self):
+        frame = self._frame
+        self.open_api()
+        while not self.is_finished():
+            frame.init()
+            frame.run()
+            frame.close(True)
+            if not self.is_finished():
+                # run() returns at mid night to re init, skip that hour as monitor_run does in live trading
+                self._clock.sleep(3600)
+        result = self.get_backtest_result()
+        SQLog.info("backtest_run,finish,result=", result)
+        self.close_api()
+        return result
+
+
+if __name__ == '__main__':
+    args = SunquantFrame.getargs('backtest-sun', 'shannon')
+
+    SQLog.init_default(args.market, args.strategy, 'warn', 'info', 1, 1)
+
+    engine = TradeEngineBacktest(args.market)
+    frame = SunquantFrame(engine, args.market, args.strategy)
+    engine.set_frame(frame)
+    print("backtest result:", engine.backtest_run(), flush=True)
+    exit(0)
@@ -100,32 +100,45 @@ class TradeEngineBinance(TradeEngineBase):
         SQLog.info("call_get_market_snapshot,nowasserts_total=", self.nowasserts_total, "quotes_dict=", self.quotes_dict)
         return [True, self.quotes_dict]
 
-    def call_get_average_volatility(self, stockcode):
+    def __fetch_klines(self, stockcode, starttime):
         cc_coin = stockcode.split('.')
-        result = self.client_api.get_klines(symbol=cc_coin[1].upper()+'USDT',
-                                            interval=Client.KLINE_INTERVAL_1DAY,
-                                            limit=50)
+        if starttime is None:
+            result = self.client_api.get_klines(symbol=cc_coin[1].upper()+'USDT',
+                                                interval=Client.KLINE_INTERVAL_1DAY,
+                                                limit=50)
+        else:
+            result = self.client_api.get_klines(symbol=cc_coin[1].upper()+'USDT',
+                                                interval=Client.KLINE_INTERVAL_1DAY,
+                                                startTime=int(starttime * 1000))
+        return [[float(r[0]) / 1000 for r in result], [float(r[1]) for r in result], [float(r[2]) for r in result],
+                [float(r[3]) for r in result], [float(r[4]) for r in result], [float(r[5]) for r in result]]
+
+    def call_get_average_volatility(self, stockcode):
+        result = self.get_klines(stockcode, lambda starttime: self.__fetch_klines(stockcode, starttime), 50)
+        closes = result['close']
+        highs = result['high']
+        lows = result['low']
         #period = 7
         period = 3
         if len(result) >= max(period, 6):
             sumcloses = 0.0
             for j in range(-1, -1-period, -1):
-                sumcloses += float(result[j][4])
+                sumcloses += float(closes[j])
             average = round(sumcloses / period, self.precision(stockcode))
 
             sumv = 0.0
             for i in range(-1, -6, -1):
-                sumv += abs(float(result[i][2]) / float(result[i][3]) - 1) if float(result[i][3]) > 0 else 0
-                sumv += abs(float(result[i][4]) / float(result[i-1][4]) - 1) if float(result[i-1][4]) > 0 else 0
+                sumv += abs(float(highs[i]) / float(lows[i]) - 1) if float(lows[i]) > 0 else 0
+                sumv += abs(float(closes[i]) / float(closes[i-1]) - 1) if float(closes[i-1]) > 0 else 0
             volatility = round(sumv / 10, 6)
             SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=", average, "volatility=", volatility)
             return [average, volatility]
         else:
-            SQLog.warn("call_get_average_volatility,result too small,stockcode=", stockcode, "result=", result)
+            SQLog.warn("call_get_average_volatility,result too small,stockcode=", stockcode, "result=", len(result))
             return [0, 0]
 
     def call_place_order(self, stockcode, volume, price, isbuy, ismarketorder):
-        volume_v, price_v = self.round_order_param(stockcode, volume, price, isbuy, ismarketorder)
+        volume_v, price_v, reserved = self.reserve_power(stockcode, volume, price, isbuy, ismarketorder)
         if volume_v <= 0:
             SQLog.info("call_place_order failed,volume_v<=0,stockcode=", stockcode,
                        "volume=", volume, "volume_v=", volume_v, "price=", price, "price_v=", price_v,
@@ -139,16 +152,19 @@ class TradeEngineBinance(TradeEngineBase):
         cc_coin = stockcode.split('.')
         instrument_id = cc_coin[1].upper() + 'USDT'
 
-        if isbuy:
-            result = self.client_api.order_limit_buy(symbol=instrument_id, quantity=round(volume_v, self.VolumePrecision),
-                                                     price=str(round(price_v, self.PricePrecision)), recvWindow=self.RecvWindow)
-        else:
-            result = self.client_api.order_limit_sell(symbol=instrument_id, quantity=round(volume_v, self.VolumePrecision),
-                                                      price=str(round(price_v,self.PricePrecision)), recvWindow=self.RecvWindow)
+        try:
+            self.wait_order_budget()
+            if isbuy:
+                result = self.client_api.order_limit_buy(symbol=instrument_id, quantity=round(volume_v, self.VolumePrecision),
+                                                         price=str(round(price_v, self.PricePrecision)), recvWindow=self.RecvWindow)
+            else:
+                result = self.client_api.order_limit_sell(symbol=instrument_id, quantity=round(volume_v, self.VolumePrecision),
+                                                          price=str(round(price_v,self.PricePrecision)), recvWindow=self.RecvWindow)
+        except Exception:
+            self.release_power(reserved)
+            raise
         if result.get('status') in [ORDER_STATUS_NEW, ORDER_STATUS_PARTIALLY_FILLED, ORDER_STATUS_FILLED]:
             ret_oid = stockcode + '.' + str(result.get('orderId'))
-            if isbuy:
-                self.nowpower -= (volume_v * price_v * self.MaxFees)
             self.order_handler(ret_oid, stockcode, None, isbuy, None, None, volume_v, price_v)
             SQLog.info("call_place_order,stockcode=", stockcode,
                        "volume=", volume, "volume_v=", volume_v, "price=", price, "price_v=", price_v,
@@ -157,6 +173,7 @@ class TradeEngineBinance(TradeEngineBase):
                        'BUY' if isbuy else 'SELL', volume_v, '@ ', price_v, "--------------------", ret_oid)
             return stockcode + '.' + str(result.get('orderId'))
         else:
+            self.release_power(reserved)
             raise Exception("call_place_order failed,timeout,stockcode=" + stockcode + ",volume=" + str(volume)
                             + ",price=" + str(price) + ",isbuy=" + str(isbuy) + ",ismarketorder=" + str(ismarketorder))
 
@@ -198,6 +215,7 @@ class TradeEngineBinance(TradeEngineBase):
         coin = cco[1]
         oid = cco[2]
         try:
+            self.wait_order_budget()
             result = self.client_api.cancel_order(symbol=coin.upper()+'USDT', orderId=int(oid), recvWindow=self.RecvWindow)
             SQLog.info("call_cancel_order,orderid=", orderid, ",result=", result)
             return True
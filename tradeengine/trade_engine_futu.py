@@ -6,6 +6,7 @@ import platform
 import os
 import sys
 import time
+import threading
 import futu
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from strategy.trade_engine_base import *
@@ -41,6 +42,25 @@ class TradeOrderHanbler(futu.TradeOrderHandlerBase):
         return ret, data
 
 
+class StockQuoteHandler(futu.StockQuoteHandlerBase):
+
+    def __init__(self, engine):
+        super().__init__()
+        self._trade_engine = engine
+
+    def on_recv_rsp(self, rsp_pb):
+        ret, data = super().on_recv_rsp(rsp_pb)
+        SQLog.debug("StockQuoteHandler,ret=", ret, "data=\n", data)
+
+        if futu.RET_OK == ret:
+            quotes_dict = self._trade_engine.get_quotes_dict()
+            for _, row in data.iterrows():
+                if row['code'] in quotes_dict and row['last_price'] > 0:
+                    quotes_dict[row['code']]['last_price'] = row['last_price']
+                    self._trade_engine.quote_handler(row['code'], row['last_price'])
+        return ret, data
+
+
 class TradeDealHandler(futu.TradeDealHandlerBase):
     def on_recv_rsp(self, rsp_pb):
         ret, data = super().on_recv_rsp(rsp_pb)
@@ -52,6 +72,8 @@ class CallLimit(object):
     _placeorder = []
     _modifyorder = []
     _historykline = []
+    # the calls of the executor threads reserve their slots under the lock and sleep outside it
+    _lock = threading.Lock()
 
     @classmethod
     def wait_placeorder(cls):
@@ -59,18 +81,19 @@ class CallLimit(object):
         times_1 = 2
         times_30 = 7
 
-        now = time.time()
-        gap = 0
-        if len(cls._placeorder) >= times_1:
-            gap = max(gap, cls._placeorder[-times_1] + 2 - now)
-        if len(cls._placeorder) >= times_30:
-            gap = max(gap, cls._placeorder[-times_30] + 32 - now)
+        with cls._lock:
+            now = time.time()
+            gap = 0
+            if len(cls._placeorder) >= times_1:
+                gap = max(gap, cls._placeorder[-times_1] + 2 - now)
+            if len(cls._placeorder) >= times_30:
+                gap = max(gap, cls._placeorder[-times_30] + 32 - now)
+            cls._placeorder.append(round(now + gap, 2))
+            if len(cls._placeorder) > times_30 + 5:
+                cls._placeorder.pop(0)
 
         SQLog.info("wait_placeorder,gap=", gap, "_placeorder=", cls._placeorder)
         time.sleep(gap)
-        cls._placeorder.append(round(time.time(), 2))
-        if len(cls._placeorder) > times_30 + 5:
-            cls._placeorder.pop(0)
 
     @classmethod
     def wait_modifyorder(cls):
@@ -78,18 +101,19 @@ class CallLimit(object):
         times_1 = 2
         times_30 = 10
 
-        now = time.time()
-        gap = 0
-        if len(cls._modifyorder) >= times_1:
-            gap = max(gap, cls._modifyorder[-times_1] + 2 - now)
-        if len(cls._modifyorder) >= times_30:
-            gap = max(gap, cls._modifyorder[-times_30] + 32 - now)
+        with cls._lock:
+            now = time.time()
+            gap = 0
+            if len(cls._modifyorder) >= times_1:
+                gap = max(gap, cls._modifyorder[-times_1] + 2 - now)
+            if len(cls._modifyorder) >= times_30:
+                gap = max(gap, cls._modifyorder[-times_30] + 32 - now)
+            cls._modifyorder.append(round(now + gap, 2))
+            while len(cls._modifyorder) > times_30 + 5:
+                cls._modifyorder.pop(0)
 
         SQLog.info("wait_modifyorder,gap=", gap, "__modifyorder=", cls._modifyorder)
         time.sleep(gap)
-        cls._modifyorder.append(round(time.time(), 2))
-        while len(cls._modifyorder) > times_30 + 5:
-            cls._modifyorder.pop(0)
 
     @classmethod
     def wait_historykline(cls):
@@ -97,18 +121,19 @@ class CallLimit(object):
         times_1 = 1
         times_30 = 5
 
-        now = time.time()
-        gap = 0
-        if len(cls._historykline) >= times_1:
-            gap = max(gap, cls._historykline[-times_1] + 2 - now)
-        if len(cls._historykline) >= times_30:
-            gap = max(gap, cls._historykline[-times_30] + 32 - now)
+        with cls._lock:
+            now = time.time()
+            gap = 0
+            if len(cls._historykline) >= times_1:
+                gap = max(gap, cls._historykline[-times_1] + 2 - now)
+            if len(cls._historykline) >= times_30:
+                gap = max(gap, cls._historykline[-times_30] + 32 - now)
+            cls._historykline.append(round(now + gap, 2))
+            while len(cls._historykline) > times_30 + 5:
+                cls._historykline.pop(0)
 
         SQLog.info("wait_historykline,gap=", gap, "_historykline=", cls._historykline)
         time.sleep(gap)
-        cls._historykline.append(round(time.time(), 2))
-        while len(cls._historykline) > times_30 + 5:
-            cls._historykline.pop(0)
 
 
 class TradeEngineFutu(TradeEngineBase):
@@ -132,6 +157,7 @@ class TradeEngineFutu(TradeEngineBase):
         self.TradePassword = None
         self.TradePasswordMd5 = None
         self.AveVolaStockCodes = None
+        self.SubscribeQuotes = 1
 
         self._quote_ctx = None
         self._trade_ctx = None
@@ -145,6 +171,12 @@ class TradeEngineFutu(TradeEngineBase):
 
         if self._quote_ctx is None:
             self._quote_ctx = futu.OpenQuoteContext(self.ApiIP, self.ApiPort)
+            # pushed quotes wake the frame between its polls, the snapshots stay the source of bid and ask
+            if self.SubscribeQuotes and (self.Market == futu.Market.HK or self.HasUSQuote):
+                self._quote_ctx.set_handler(StockQuoteHandler(self))
+                ret, data = self._quote_ctx.subscribe(self.get_stockcode_pools(), [futu.SubType.QUOTE])
+                if futu.RET_OK != ret:
+                    SQLog.warn("open_api,subscribe quotes failed,ret=", ret, "data=", data)
 
         if self._trade_ctx is None:
             if self.Market == futu.Market.HK:
@@ -322,6 +354,8 @@ class TradeEngineFutu(TradeEngineBase):
                         q['price_spread'] = row['price_spread']
                         q['suspension'] = row['suspension']
                         q['last_price'] = row['last_price']
+                        q['high_price'] = row['high_price']
+                        q['low_price'] = row['low_price']
                         q['ask_price'] = row['ask_price']
                         q['bid_price'] = row['bid_price']
                         q['ask_vol'] = row['ask_vol']
@@ -340,24 +374,37 @@ class TradeEngineFutu(TradeEngineBase):
             raise Exception("call_get_market_snapshot failed,try 3 times no result,stockcodes=" + str(stockcodes))
         return [futu.RET_OK == mktret, self.quotes_dict]
 
+    def __fetch_klines(self, stockcode, starttime):
+        # daily klines from starttime on, the default history of request_history_kline for None
+        start = None if starttime is None else datetime.datetime.fromtimestamp(starttime, pytz.utc).strftime('%Y-%m-%d')
+        CallLimit.wait_historykline()
+        ret, prices, page_req_key = self._quote_ctx.request_history_kline(stockcode, start=start,
+                                                                          fields=[futu.KL_FIELD.DATE_TIME,
+                                                                                  futu.KL_FIELD.OPEN,
+                                                                                  futu.KL_FIELD.CLOSE,
+                                                                                  futu.KL_FIELD.HIGH,
+                                                                                  futu.KL_FIELD.LOW,
+                                                                                  futu.KL_FIELD.TRADE_VOL])
+        if ret != futu.RET_OK:
+            SQLog.warn("call_get_average_volatility,request_history_kline fail,stockcode=", stockcode, "ret=", ret, "prices=\n", prices)
+            raise Exception("call_get_average_volatility failed,stockcode="+stockcode+",ret="+str(ret))
+        times = [datetime.datetime.strptime(t[0:10], '%Y-%m-%d').replace(tzinfo=pytz.utc).timestamp() for t in prices['time_key']]
+        return [times, prices['open'].values, prices['high'].values, prices['low'].values, prices['close'].values,
+                prices['volume'].values]
+
     def call_get_average_volatility(self, stockcode):
         if self.Market == futu.Market.US and not self.HasUSQuote:
             SQLog.info("call_get_average_volatility,no us quotes,stockcode=", stockcode, "average=0")
             return [0, 0]
 
-        CallLimit.wait_historykline()
-        ret, prices, page_req_key = self._quote_ctx.request_history_kline(stockcode,
-                                                                          fields=[futu.KL_FIELD.CLOSE,futu.KL_FIELD.HIGH,futu.KL_FIELD.LOW])
-        if ret != futu.RET_OK:
-            SQLog.warn("call_get_average_volatility,request_history_kline fail,stockcode=", stockcode, "ret=", ret, "prices=\n", prices)
-            raise Exception("call_get_average_volatility failed,stockcode="+stockcode+",ret="+str(ret))
+        prices = self.get_klines(stockcode, lambda starttime: self.__fetch_klines(stockcode, starttime), 365)
 
         #period = 20
         period = 5
         if len(prices) >= max(period, 6):
-            closes = prices['close'].values
-            highs = prices['high'].values
-            lows = prices['low'].values
+            closes = prices['close']
+            highs = prices['high']
+            lows = prices['low']
 
             average = round(sum(closes[-period:]) / period, self.precision(stockcode))
 
@@ -369,7 +416,7 @@ class TradeEngineFutu(TradeEngineBase):
             SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=", average, "volatility=", volatility)
             return [average, volatility]
         else:
-            SQLog.warn("call_get_average_volatility,request_history_kline fail,stockcode=", stockcode, "ret=", ret, "prices=\n", prices)
+            SQLog.warn("call_get_average_volatility,klines too small,stockcode=", stockcode, "klines=", len(prices))
             return [0, 0]
 
 
@@ -386,7 +433,7 @@ class TradeEngineFutu(TradeEngineBase):
         if ismarketorder and self.Market == futu.Market.US and self.EnvType == futu.TrdEnv.REAL and iscontinuousbidding:
             ot = futu.OrderType.MARKET
 
-        volume_v, price_v = self.round_order_param(stockcode, volume, price, isbuy, ismarketorder)
+        volume_v, price_v, reserved = self.reserve_power(stockcode, volume, price, isbuy, ismarketorder)
         if volume_v <= 0:
             SQLog.info("call_place_order failed,volume_v<=0,stockcode=", stockcode, "volume=", volume, "volume_v=", volume_v,
                        "price=", price, "price_v=", price_v, "isbuy=", isbuy, "ismarketorder=", ismarketorder)
@@ -400,13 +447,19 @@ class TradeEngineFutu(TradeEngineBase):
             return None
 
         if self.EnvType == futu.TrdEnv.SIMULATE and self.Market == futu.Market.US and not self.isnow_continuous_bidding_usstk():
+            self.release_power(reserved)
             return None
         
-        CallLimit.wait_placeorder()
-        ret, data = self._trade_ctx.place_order(price=price_v, qty=volume_v, code=stockcode, trd_side=ts,
-                                                order_type=ot, adjust_limit=al, trd_env=self.EnvType,
-                                                time_in_force=futu.TimeInForce.DAY,
-                                                fill_outside_rth=self.EnvType == futu.TrdEnv.REAL and not ot == futu.OrderType.MARKET)
+        try:
+            CallLimit.wait_placeorder()
+            self.wait_order_budget()
+            ret, data = self._trade_ctx.place_order(price=price_v, qty=volume_v, code=stockcode, trd_side=ts,
+                                                    order_type=ot, adjust_limit=al, trd_env=self.EnvType,
+                                                    time_in_force=futu.TimeInForce.DAY,
+                                                    fill_outside_rth=self.EnvType == futu.TrdEnv.REAL and not ot == futu.OrderType.MARKET)
+        except Exception:
+            self.release_power(reserved)
+            raise
         SQLog.debug("call_place_order,place_order ret=", ret, "data=\n", data)
         if futu.RET_OK == ret:
             orderid = data['order_id'][0]
@@ -415,14 +468,14 @@ class TradeEngineFutu(TradeEngineBase):
                        "price=", price, "price_v=", price_v, "isbuy=", isbuy, "ismarketorder=", ismarketorder,
                        "ordertype=", ot, "orderid=", orderid, "orderstatus=", orderstatus)
             if orderstatus in self.ORDER_STATUS_PLACEFAILED:
+                self.release_power(reserved)
                 raise Exception("call_place_order failed,stockcode="+stockcode+",ret="+str(ret)+",data="+str(data))
-            if isbuy:
-                self.nowpower -= (volume_v * price_v * self.MaxFees)
             SQLog.info("--------------------PlaceOrderOK--------------------", stockcode, "--------------------",
                        'BUY' if isbuy else 'SELL', volume_v, '@ ', 'MKT' if ot == futu.OrderType.MARKET else price_v,
                        "--------------------", orderid)
             return orderid
         else:
+            self.release_power(reserved)
             raise Exception("call_place_order failed,stockcode="+stockcode+",ret="+str(ret)+",data="+str(data))
 
     def call_get_order(self, orderid):
@@ -475,6 +528,7 @@ class TradeEngineFutu(TradeEngineBase):
         for i in range(3):
             CallLimit.wait_modifyorder()
             time.sleep(i*30)
+            self.wait_order_budget()
             modret, moddata = self._trade_ctx.modify_order(modify_order_op=futu.ModifyOrderOp.CANCEL,
                                                            order_id=orderid, qty=0, price=0, trd_env=self.EnvType)
             SQLog.debug("call_cancel_order,modify_order orderid=", orderid, "ret=", modret, "data=\n", moddata)
@@ -246,19 +246,19 @@ class IBAgent(IBWrapper, IBClient):
         self.reqMktData_event.wait(self.EventWaitSecs)
         return self.reqMktData_event.is_set()
 
-    def reqHistoricalData_wait(self, stockcode):
+    def reqHistoricalData_wait(self, stockcode, days=30):
+        # daily bars of the last days until now
         if not self.is_ready():
             raise Exception("reqHistoricalData_wait,failed,is_ready return False")
-        SQLog.info("reqHistoricalData_wait,stockcode=", stockcode)
+        SQLog.info("reqHistoricalData_wait,stockcode=", stockcode, "days=", days)
 
         self.historical_bars[stockcode] = []
         self.reqHistoricalData_event.clear()
         reqId = self.nextOrderId()
         self.reqHistoricalData_Id2code[reqId] = stockcode
         contract = self.stockcode_to_contract(stockcode)
-        queryTime = (datetime.datetime.today() - datetime.timedelta(days=30)).strftime("%Y%m%d %H:%M:%S")
-        self.reqHistoricalData(reqId, contract, queryTime,
-                               "1 D", "1 day", "TRADES", 1, 1, False, [])
+        self.reqHistoricalData(reqId, contract, "",
+                               str(int(days)) + " D", "1 day", "TRADES", 1, 1, False, [])
         self.reqHistoricalData_event.wait(self.EventWaitSecs)
         return self.reqHistoricalData_event.is_set()
 
@@ -435,6 +435,11 @@ class IBAgent(IBWrapper, IBClient):
                 d['ask_price'] = price
             if tickType == TickTypeEnum.CLOSE or tickType == TickTypeEnum.DELAYED_CLOSE:
                 d['close_price'] = price
+            if tickType == TickTypeEnum.LAST or tickType == TickTypeEnum.DELAYED_LAST:
+                self._trade_engine.quote_handler(stockcode, price)
+            elif d.get('bid_price', 0) > 0.01 and d.get('ask_price', 0) > 0.01 and tickType in [
+                    TickTypeEnum.BID, TickTypeEnum.DELAYED_BID, TickTypeEnum.ASK, TickTypeEnum.DELAYED_ASK]:
+                self._trade_engine.quote_handler(stockcode, 0.5 * (d['bid_price'] + d['ask_price']))
 
     @iswrapper
     def tickSnapshotEnd(self, reqId: int):
@@ -531,6 +536,8 @@ class TradeEngineIb(TradeEngineBase):
         self.HasHistoricalPermission = 0
         self.UseMargin = 0
         self.MarginLeverage = 0
+        # the agent waits for one request of each kind at a time, so the calls do not overlap
+        self.AsyncWorkers = 1
 
         self._lasttime_dump = 0
 
@@ -592,15 +599,8 @@ class TradeEngineIb(TradeEngineBase):
         return True
 
     def isnow_can_placeorder_usstk(self):
-        ret = False
-        tz = pytz.timezone('Etc/GMT+5')
-        now = datetime.datetime.now(tz)
-        is_summer_now = self.is_summer_time(now)
-        if now.weekday() < 5:
-            if is_summer_now:
-                ret = now.hour >= 3 and now.hour < 15
-            else:
-                ret = now.hour >= 4 and now.hour < 16
+        # pre market and regular session, no after hours
+        ret = SQSessionCalendar.get('US').is_open(SQClock.time(), SQSessionCalendar.OPEN, SQSessionCalendar.CLOSE)
         SQLog.info("TradeEngineIb.isnow_can_placeorder_usstk,ret=", ret)
         return ret
 
@@ -664,37 +664,47 @@ class TradeEngineIb(TradeEngineBase):
         SQLog.info("call_get_market_snapshot,quotes_dict=", self.quotes_dict)
         return [True, self.quotes_dict]
 
+    def __fetch_klines(self, stockcode, starttime):
+        # 30 days of history, or the days since starttime
+        days = 30 if starttime is None else max(1, int((time.time() - starttime) // 86400) + 1)
+        if not self._ib_agent.reqHistoricalData_wait(stockcode, days):
+            SQLog.warn("call_get_average_volatility,reqHistoricalData_wait fail,stockcode=", stockcode)
+            raise Exception("call_get_average_volatility failed,stockcode=" + stockcode)
+        bars = self._ib_agent.historical_bars.get(stockcode, [])
+        times = [datetime.datetime.strptime(bar.date[0:8], '%Y%m%d').replace(tzinfo=pytz.utc).timestamp() for bar in bars]
+        return [times, [bar.open for bar in bars], [bar.high for bar in bars], [bar.low for bar in bars],
+                [bar.close for bar in bars], [bar.volume for bar in bars]]
+
     def call_get_average_volatility(self, stockcode):
         if not self.HasHistoricalPermission:
             SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=0,volatility=0")
             return [0, 0]
 
-        if self._ib_agent.reqHistoricalData_wait(stockcode):
-            bars = self._ib_agent.historical_bars.get(stockcode, [])
-
-            if len(bars) > 5:
-                sumcloses = 0.0
-                for i in range(len(bars)):
-                    sumcloses += bars[i].close
-                average = round(sumcloses / len(bars), self.precision(stockcode))
-
-                #use the latest 5 days data is more prefered
-                sumv = 0
-                for i in range(-1, -len(bars), -1):
-                    sumv += abs(bars[i].high / bars[i].low - 1) if bars[i].low > 0 else 0
-                    sumv += abs(bars[i].close / bars[i-1].close - 1) if bars[i-1].close > 0 else 0
-                volatility = round(sumv / (2*len(bars)), 6)
-                SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=", average, "volatility=", volatility)
-                return [average, volatility]
-            else:
-                SQLog.warn("call_get_average_volatility,bars too small,stockcode=", stockcode, "bars=", bars)
-                return [0, 0]
+        bars = self.get_klines(stockcode, lambda starttime: self.__fetch_klines(stockcode, starttime), 30)
+        closes = bars['close']
+        highs = bars['high']
+        lows = bars['low']
+
+        if len(bars) > 5:
+            sumcloses = 0.0
+            for i in range(len(bars)):
+                sumcloses += closes[i]
+            average = round(sumcloses / len(bars), self.precision(stockcode))
+
+            #use the latest 5 days data is more prefered
+            sumv = 0
+            for i in range(-1, -len(bars), -1):
+                sumv += abs(highs[i] / lows[i] - 1) if lows[i] > 0 else 0
+                sumv += abs(closes[i] / closes[i-1] - 1) if closes[i-1] > 0 else 0
+            volatility = round(sumv / (2*len(bars)), 6)
+            SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=", average, "volatility=", volatility)
+            return [average, volatility]
         else:
-            SQLog.warn("call_get_average_volatility,reqHistoricalData_wait fail,stockcode=", stockcode)
-            raise Exception("call_get_average_volatility failed,stockcode=" + stockcode)
+            SQLog.warn("call_get_average_volatility,bars too small,stockcode=", stockcode, "bars=", len(bars))
+            return [0, 0]
 
     def call_place_order(self, stockcode, volume, price, isbuy, ismarketorder):
-        volume_v, price_v = self.round_order_param(stockcode, volume, price, isbuy, ismarketorder)
+        volume_v, price_v, reserved = self.reserve_power(stockcode, volume, price, isbuy, ismarketorder)
         if volume_v <= 0:
             SQLog.info("call_place_order failed,volume_v<=0,stockcode=", stockcode,
                        "volume=", volume, "volume_v=", volume_v, "price=", price, "price_v=", price_v,
@@ -705,10 +715,13 @@ class TradeEngineIb(TradeEngineBase):
                        "isbuy=", isbuy, "ismarketorder=", ismarketorder)
             return None
 
-        orderId = self._ib_agent.placeOrder_wait(stockcode, volume_v, price_v, isbuy, ismarketorder)
+        try:
+            self.wait_order_budget()
+            orderId = self._ib_agent.placeOrder_wait(stockcode, volume_v, price_v, isbuy, ismarketorder)
+        except Exception:
+            self.release_power(reserved)
+            raise
         if orderId:
-            if isbuy:
-                self.nowpower -= (volume_v * price_v * self.MaxFees)
             SQLog.info("call_place_order,stockcode=", stockcode,
                        "volume=", volume, "volume_v=", volume_v, "price=", price, "price_v=", price_v,
                        "isbuy=", isbuy, "ismarketorder=", ismarketorder, "orderid=", orderId)
@@ -717,6 +730,7 @@ class TradeEngineIb(TradeEngineBase):
                        "--------------------", orderId)
             self.order_handler(orderId, stockcode, None, isbuy, None, None, volume_v, price_v)
         else:
+            self.release_power(reserved)
             raise Exception("call_place_order failed,timeout,stockcode=" + stockcode + ",volume=" + str(volume)
                             + ",price=" + str(price) + ",isbuy=" + str(isbuy) + ",ismarketorder=" + str(ismarketorder))
         return orderId
@@ -747,6 +761,7 @@ class TradeEngineIb(TradeEngineBase):
             SQLog.info("call_cancel_order,orderid=", orderid, "return False")
             return False
 
+        self.wait_order_budget()
         if self._ib_agent.cancelOrder_wait(orderid):
             SQLog.info("call_cancel_order,orderid=", orderid)
             return True
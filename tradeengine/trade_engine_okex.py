@@ -25,6 +25,8 @@ class TradeEngineOKEx(TradeEngineBase):
         self.PriceSpread = 0.1
         self.VolumePrecision = 8
         self.PricePrecision = 1
+        # one order in 5 seconds
+        self.OrderRateLimit = 0.2
 
         self.load_setting()
 
@@ -99,30 +101,44 @@ class TradeEngineOKEx(TradeEngineBase):
         SQLog.info("call_get_market_snapshot,nowasserts_total=", self.nowasserts_total, "quotes_dict=", self.quotes_dict)
         return [True, self.quotes_dict]
 
-    def call_get_average_volatility(self, stockcode):
+    def __fetch_klines(self, stockcode, starttime):
+        # get_kline returns the newest bar first, [time, open, high, low, close, volume]
         cc_coin = stockcode.split('.')
-        result = self.spot_api.get_kline(instrument_id=cc_coin[1].upper()+'-USDT', start=None, end=None, granularity=86400)
+        start = None if starttime is None else \
+            datetime.datetime.fromtimestamp(starttime, pytz.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        result = self.spot_api.get_kline(instrument_id=cc_coin[1].upper()+'-USDT', start=start, end=None, granularity=86400)
+        times = [datetime.datetime.strptime(r[0][0:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=pytz.utc).timestamp()
+                 for r in result]
+        return [times, [float(r[1]) for r in result], [float(r[2]) for r in result], [float(r[3]) for r in result],
+                [float(r[4]) for r in result], [float(r[5]) for r in result]]
+
+    def call_get_average_volatility(self, stockcode):
+        # newest bar first as the get_kline result
+        result = self.get_klines(stockcode, lambda starttime: self.__fetch_klines(stockcode, starttime), 200)[::-1]
+        closes = result['close']
+        highs = result['high']
+        lows = result['low']
 
         period = 30
         if len(result) >= max(period, 6):
             sumcloses = 0.0
             for j in range(period):
-                sumcloses += float(result[j][4])
+                sumcloses += float(closes[j])
             average = round(sumcloses / period, self.precision(stockcode))
 
             sumv = 0.0
             for i in range(5):
-                sumv += abs(float(result[i][2]) / float(result[i][3]) - 1) if float(result[i][3]) > 0 else 0
-                sumv += abs(float(result[i][4]) / float(result[i+1][4]) - 1) if float(result[i+1][4]) > 0 else 0
+                sumv += abs(float(highs[i]) / float(lows[i]) - 1) if float(lows[i]) > 0 else 0
+                sumv += abs(float(closes[i]) / float(closes[i+1]) - 1) if float(closes[i+1]) > 0 else 0
             volatility = round(sumv / 10, 6)
             SQLog.info("call_get_average_volatility,stockcode=", stockcode, "average=", average, "volatility=", volatility)
             return [average, volatility]
         else:
-            SQLog.warn("call_get_average_volatility,result too small,stockcode=", stockcode, "result=", result)
+            SQLog.warn("call_get_average_volatility,result too small,stockcode=", stockcode, "result=", len(result))
             return [0, 0]
 
     def call_place_order(self, stockcode, volume, price, isbuy, ismarketorder):
-        volume_v, price_v = self.round_order_param(stockcode, volume, price, isbuy, ismarketorder)
+        volume_v, price_v, reserved = self.reserve_power(stockcode, volume, price, isbuy, ismarketorder)
         if volume_v <= 0:
             SQLog.info("call_place_order failed,volume_v<=0,stockcode=", stockcode,
                        "volume=", volume, "volume_v=", volume_v, "price=", price, "price_v=", price_v,
@@ -135,17 +151,20 @@ class TradeEngineOKEx(TradeEngineBase):
 
         cc_coin = stockcode.split('.')
         instrument_id = cc_coin[1].upper() + '-USDT'
-        self.orderid_counter += 1
-        oid = 'COID' + str(self.orderid_counter)
+        with self.orders_dict_lock:
+            self.orderid_counter += 1
+            oid = 'COID' + str(self.orderid_counter)
 
-        result = self.spot_api.take_order(otype='limit', side='buy' if isbuy else 'sell', instrument_id=instrument_id,
-                                          size=round(volume_v,self.VolumePrecision), margin_trading=1, client_oid=oid,
-                                          price=round(price_v,self.PricePrecision), funds=price_v*volume_v, order_type='0')
+        try:
+            self.wait_order_budget()
+            result = self.spot_api.take_order(otype='limit', side='buy' if isbuy else 'sell', instrument_id=instrument_id,
+                                              size=round(volume_v,self.VolumePrecision), margin_trading=1, client_oid=oid,
+                                              price=round(price_v,self.PricePrecision), funds=price_v*volume_v, order_type='0')
+        except Exception:
+            self.release_power(reserved)
+            raise
         if True == result.get('result'):
-            time.sleep(5)
             ret_oid = stockcode + '.' + result.get('order_id')
-            if isbuy:
-                self.nowpower -= (volume_v * price_v * self.MaxFees)
             self.order_handler(ret_oid, stockcode, None, isbuy, None, None, volume_v, price_v)
             SQLog.info("call_place_order,stockcode=", stockcode, "volume=", volume, "volume_v=", volume_v,
                        "price=", price, "price_v=", price_v,
@@ -154,6 +173,7 @@ class TradeEngineOKEx(TradeEngineBase):
                        'BUY' if isbuy else 'SELL', volume_v, '@ ', price_v, "--------------------", ret_oid)
             return ret_oid
         else:
+            self.release_power(reserved)
             raise Exception("call_place_order failed,timeout,stockcode=" + stockcode + ",volume=" + str(volume)
                             + ",price=" + str(price) + ",isbuy=" + str(isbuy) + ",ismarketorder=" + str(ismarketorder))
 
@@ -192,6 +212,7 @@ class TradeEngineOKEx(TradeEngineBase):
         coin = cco[1]
         oid = cco[2]
         try:
+            self.wait_order_budget()
             result = self.spot_api.revoke_order(oid=oid, instrument_id=coin.upper()+'-USDT')
             SQLog.info("call_cancel_order,orderid=", orderid, ",result=", result.get('result'))
             return True
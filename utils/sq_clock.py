@@ -0,0 +1,123 @@
+# encoding: UTF-8
+# author email: szy@tsinghua.org.cn
+
+import time
+import datetime
+
+
+class SQRealClock(object):
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, secs):
+        if secs > 0:
+            time.sleep(secs)
+
+    def now(self, tz=None):
+        return datetime.datetime.now(tz)
+
+    def wait(self, event, secs):
+        return event.wait(secs)
+
+
+class SQSimClock(SQRealClock):
+    # simulated time, sleep() and wait() advance the clock instead of blocking,
+    # listeners are called with the new timestamp after each advance, e.g. to replay quotes and fill orders.
+
+    def __init__(self, starttime=0, step=60):
+        self._now = starttime
+        self._step = step
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def time(self):
+        return self._now
+
+    def sleep(self, secs):
+        if secs > 0:
+            self.advance_to(self._now + secs)
+
+    def now(self, tz=None):
+        return datetime.datetime.fromtimestamp(self._now, tz)
+
+    def wait(self, event, secs):
+        deadline = self._now + secs
+        while not event.is_set() and self._now < deadline:
+            self.advance_to(min(deadline, self._now + self._step))
+        return event.is_set()
+
+    def advance_to(self, timestamp):
+        if timestamp > self._now:
+            self._now = timestamp
+        for listener in self._listeners:
+            listener(self._now)
+
+
+class SQAccelClock(SQRealClock):
+    # faster than real time, every real second counts as 'speed' seconds, starting from 'starttime'
+
+    def __init__(self, speed=60.0, starttime=None):
+        self._speed = speed if speed and speed > 0 else 1.0
+        self._realstart = time.time()
+        self._starttime = starttime if starttime is not None else self._realstart
+
+    def time(self):
+        return self._starttime + (time.time() - self._realstart) * self._speed
+
+    def sleep(self, secs):
+        if secs > 0:
+            time.sleep(secs / self._speed)
+
+    def now(self, tz=None):
+        return datetime.datetime.fromtimestamp(self.time(), tz)
+
+    def wait(self, event, secs):
+        return event.wait(secs / self._speed)
+
+
+class SQClock(object):
+    CLOCK_REAL = 'Real'
+    CLOCK_ACCEL = 'Accel'
+    CLOCK_SIM = 'Sim'
+    CLOCK_TYPES = [CLOCK_REAL, CLOCK_ACCEL, CLOCK_SIM]
+
+    _default_instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._default_instance is None:
+            cls._default_instance = SQRealClock()
+        return cls._default_instance
+
+    @classmethod
+    def init_default(cls, clock):
+        cls._default_instance = clock
+
+    @classmethod
+    def create(cls, clocktype, speed=60.0, starttime=None, step=60):
+        if clocktype == cls.CLOCK_ACCEL:
+            return SQAccelClock(speed, starttime)
+        elif clocktype == cls.CLOCK_SIM:
+            return SQSimClock(starttime if starttime is not None else time.time(), step)
+        elif clocktype == cls.CLOCK_REAL:
+            return SQRealClock()
+        raise Exception("SQClock.create,clocktype not supported,clocktype=" + str(clocktype))
+
+    @classmethod
+    def time(cls):
+        return cls.instance().time()
+
+    @classmethod
+    def sleep(cls, secs):
+        cls.instance().sleep(secs)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.instance().now(tz)
+
+    @classmethod
+    def wait(cls, event, secs):
+        return cls.instance().wait(event, secs)
@@ -0,0 +1,111 @@
+# encoding: UTF-8
+# per-stock kline files of fixed size records, read through numpy.memmap and appended incrementally.
+# author email: szy@tsinghua.org.cn
+
+import os
+import time
+import numpy
+from utils.sq_log import *
+from utils.sq_setting import *
+
+KLINE_DTYPE = numpy.dtype([('time', '<f8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                           ('volume', '<f8')])
+
+
+class SQKlineStore(object):
+    # <savedata dir of marketname>/klines_<ktype>/<stockcode>.bin, records ordered by time, which is the start
+    # of the bar in epoch seconds (00:00 UTC of the date for daily bars). the last stored bar may still have
+    # been forming when it was written, so the bars fetched again from overlap_time() replace the stored ones.
+    # a file is never changed in place, append() writes a new one and renames it over the old, so a reader
+    # in another process keeps a whole map of the old file until it reads again.
+
+    def __init__(self, marketname, ktype='day', dirpath=None):
+        self._dirpath = dirpath if dirpath else os.path.join(SQSetting.get_savedata_dir(marketname), 'klines_' + ktype)
+        # stockcode -> [[inode, size, mtime] of the mapped file, memmap]
+        self._maps = {}
+
+    def filepath(self, stockcode):
+        return os.path.join(self._dirpath, stockcode + '.bin')
+
+    def read(self, stockcode, starttime=None, endtime=None):
+        # read only records with starttime <= time < endtime
+        filepath = self.filepath(stockcode)
+        st = os.stat(filepath) if os.path.exists(filepath) else None
+        count = st.st_size // KLINE_DTYPE.itemsize if st else 0
+        if count == 0:
+            self._maps.pop(stockcode, None)
+            return numpy.zeros(0, KLINE_DTYPE)
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        cached = self._maps.get(stockcode)
+        if cached is None or cached[0] != key:
+            cached = [key, numpy.memmap(filepath, KLINE_DTYPE, 'r', shape=(count,))]
+            self._maps[stockcode] = cached
+        klines = cached[1]
+        i0 = 0 if starttime is None else int(numpy.searchsorted(klines['time'], starttime, 'left'))
+        i1 = count if endtime is None else int(numpy.searchsorted(klines['time'], endtime, 'left'))
+        return klines[i0:i1]
+
+    def last_time(self, stockcode):
+        klines = self.read(stockcode)
+        return float(klines['time'][-1]) if len(klines) > 0 else None
+
+    def overlap_time(self, stockcode):
+        # bars are fetched again from the one before the last, the last may have been forming and the one
+        # before it shows whether the history was adjusted since; None for an empty store
+        klines = self.read(stockcode)
+        if len(klines) == 0:
+            return None
+        return float(klines['time'][-2]) if len(klines) > 1 else float(klines['time'][-1])
+
+    def updated_secs(self, stockcode):
+        # real seconds since the last append, None if never
+        filepath = self.filepath(stockcode)
+        if not os.path.exists(filepath):
+            return None
+        return time.time() - os.path.getmtime(filepath)
+
+    def append(self, stockcode, times, opens, highs, lows, closes, volumes=None, reltol=0.0001):
+        # returns the number of records written, the stored records from the first given time on are
+        # replaced. returns -1 and writes nothing if a completed stored bar differs from the given one,
+        # e.g. prices adjusted after a split, the caller clears the store and fetches the whole history.
+        records = numpy.zeros(len(times), KLINE_DTYPE)
+        records['time'] = times
+        records['open'] = opens
+        records['high'] = highs
+        records['low'] = lows
+        records['close'] = closes
+        if volumes is not None:
+            records['volume'] = volumes
+        records = records[numpy.argsort(records['time'], kind='stable')]
+
+        stored = self.read(stockcode)
+        keep = len(stored)
+        if len(records) > 0 and keep > 0:
+            keep = int(numpy.searchsorted(stored['time'], records['time'][0], 'left'))
+            completed = stored[keep:-1]
+            common, si, ri = numpy.intersect1d(completed['time'], records['time'], return_indices=True)
+            if len(common) > 0 and not numpy.allclose(completed['close'][si], records['close'][ri], rtol=reltol, atol=0):
+                SQLog.warn("append,stored bars differ,stockcode=", stockcode, "times=", common.tolist())
+                return -1
+        kept = numpy.array(stored[:keep])
+        del stored
+        self._maps.pop(stockcode, None)
+
+        if not os.path.exists(self._dirpath):
+            os.makedirs(self._dirpath)
+        filepath = self.filepath(stockcode)
+        tmppath = filepath + '.' + str(os.getpid()) + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(kept.tobytes())
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, filepath)
+        SQLog.info("append,stockcode=", stockcode, "kept=", keep, "written=", len(records))
+        return len(records)
+
+    def clear(self, stockcode):
+        self._maps.pop(stockcode, None)
+        filepath = self.filepath(stockcode)
+        if os.path.exists(filepath):
+            os.remove(filepath)
@@ -0,0 +1,119 @@
+# encoding: UTF-8
+# streaming estimates of the average price and the daily volatility of stocks, updated from every market snapshot.
+# author email: szy@tsinghua.org.cn
+
+import math
+
+
+class SQQuoteEstimator(object):
+    # the same measures as call_get_average_volatility of the engines, as exponential moving averages over
+    # the days instead of fixed kline windows: average of the closes, volatility of the mean of |high/low-1|
+    # and |close/prevclose-1| of each day. days are utc days, a day is folded in when the first price of a
+    # later day arrives, so every update is O(1) and needs nothing but the state of its stock.
+    #
+    # the forming day is blended in with the weight of one day, it may only raise the volatility, its range
+    # is still growing. the state of a stock is a dict of numbers which is saved with the quote data.
+    #
+    # the sampled prices miss the extremes between the snapshots, so the high and low of the trading day are
+    # folded in when the snapshot has them. a snapshot keeps those of the last session until the next one opens,
+    # a pair still equal to the one of the day before, or not around the price, is left out.
+
+    def __init__(self, period=5, mindays=3, staledays=10):
+        # weight of one day, the span convention of an ewma, period 5 has about the age of a 5 days mean
+        self._alpha = 2.0 / (period + 1)
+        self._period = period
+        self._mindays = mindays
+        self._staledays = staledays
+        self._states = {}
+
+    def load(self, states):
+        for stockcode, state in states.items():
+            if isinstance(state, dict) and 'day' in state:
+                self._states[stockcode] = dict(state)
+
+    def dump(self):
+        return {stockcode: dict(state) for stockcode, state in self._states.items()}
+
+    def get_state(self, stockcode):
+        return self._states.get(stockcode)
+
+    def __new_state(self, day, price):
+        return {'day': day, 'high': price, 'low': price, 'close': price, 'prevclose': 0,
+                'average': 0, 'volatility': 0, 'days': 0, 'voladays': 0, 'time': 0,
+                'qhigh': 0, 'qlow': 0, 'stalehigh': 0, 'stalelow': 0}
+
+    def __day_volatility(self, state):
+        sumv = abs(state['high'] / state['low'] - 1) if state['low'] > 0 else 0
+        sumv += abs(state['close'] / state['prevclose'] - 1) if state['prevclose'] > 0 else 0
+        return sumv / 2
+
+    def __fold_day(self, state):
+        a = self._alpha
+        state['average'] = state['close'] if state['days'] == 0 else (1 - a) * state['average'] + a * state['close']
+        state['days'] += 1
+        if state['prevclose'] > 0:
+            sample = self.__day_volatility(state)
+            state['volatility'] = sample if state['voladays'] == 0 else (1 - a) * state['volatility'] + a * sample
+            state['voladays'] += 1
+        state['prevclose'] = state['close']
+
+    def update(self, stockcode, now, price, high=0, low=0):
+        if not price or price <= 0:
+            return False
+        day = int(now // 86400)
+        state = self._states.get(stockcode)
+        if state is None or day - state['day'] > self._staledays:
+            state = self.__new_state(day, price)
+            self._states[stockcode] = state
+        elif day > state['day']:
+            self.__fold_day(state)
+            state['day'] = day
+            state['high'] = state['low'] = state['close'] = price
+            state['stalehigh'] = state.get('qhigh', 0)
+            state['stalelow'] = state.get('qlow', 0)
+        elif day == state['day']:
+            state['high'] = max(state['high'], price)
+            state['low'] = min(state['low'], price)
+            state['close'] = price
+        else:
+            return False
+        if high and low:
+            if 0 < low <= price <= high and (high != state.get('stalehigh') or low != state.get('stalelow')):
+                state['high'] = max(state['high'], high)
+                state['low'] = min(state['low'], low)
+            state['qhigh'] = high
+            state['qlow'] = low
+        state['time'] = now
+        return True
+
+    def update_quotes(self, quotes_dict, now):
+        for stockcode, q in quotes_dict.items():
+            if not q.get('suspension', False):
+                self.update(stockcode, now, q.get('last_price', 0), q.get('high_price', 0), q.get('low_price', 0))
+
+    def seed(self, stockcode, now, average, volatility):
+        # the values of call_get_average_volatility for a stock without enough days, they count as period days
+        state = self._states.get(stockcode)
+        if state is None or int(now // 86400) - state['day'] > self._staledays:
+            state = self.__new_state(int(now // 86400), average)
+            self._states[stockcode] = state
+        state['average'] = average
+        state['volatility'] = volatility
+        state['days'] = max(state['days'], self._period)
+        state['voladays'] = max(state['voladays'], self._period)
+
+    def estimate(self, stockcode, now):
+        # [average, volatility] including the forming day, [0, 0] while the stock has less than mindays days
+        state = self._states.get(stockcode)
+        if state is None or int(now // 86400) - state['day'] > self._staledays:
+            return [0, 0]
+        if state['days'] < self._mindays or state['voladays'] < self._mindays - 1:
+            return [0, 0]
+        a = self._alpha
+        average = (1 - a) * state['average'] + a * state['close']
+        volatility = state['volatility']
+        if state['prevclose'] > 0:
+            volatility = max(volatility, (1 - a) * volatility + a * self.__day_volatility(state))
+        if math.isnan(average) or math.isnan(volatility):
+            return [0, 0]
+        return [average, volatility]
@@ -0,0 +1,65 @@
+# encoding: UTF-8
+# writes the strategy assets of the frame on a thread of its own, a burst of saves becomes one write per interval.
+# author email: szy@tsinghua.org.cn
+
+import time
+import threading
+from utils.sq_log import *
+from utils.sq_setting import *
+
+
+class SQSaveWriter(object):
+    # submit() only keeps the data as the pending one, a newer submit replaces it, the thread writes the pending
+    # data with SQSaveData.save_data at most once per interval. the data must not be changed after submit.
+    # a failed write is logged and tried again with the next pending data. flush() waits until nothing is pending.
+    # the interval is of real time, not of SQClock, it paces the disk.
+
+    def __init__(self, marketname, strategyname, interval=10):
+        self._marketname = marketname
+        self._strategyname = strategyname
+        self._interval = interval
+        self._cond = threading.Condition()
+        self._pending = None
+        self._writing = False
+        self._lastwrite = 0
+        self._thread = None
+
+    def submit(self, data):
+        with self._cond:
+            self._pending = data
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.__run, name='sq_save_' + self._marketname, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self, timeout=30):
+        # True when the last submitted data is written
+        with self._cond:
+            self._lastwrite = 0
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._pending is None and not self._writing, timeout)
+
+    def __run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                gap = self._lastwrite + self._interval - time.time()
+                if gap > 0:
+                    # a flush sets _lastwrite to 0 and notifies, which ends the wait early
+                    self._cond.wait(gap)
+                    if self._lastwrite + self._interval > time.time():
+                        continue
+                data = self._pending
+                self._pending = None
+                self._writing = True
+            try:
+                SQSaveData.save_data(self._marketname, self._strategyname, data)
+            except Exception as e:
+                SQLog.error("SQSaveWriter,save_data failed,e=", e)
+                with self._cond:
+                    if self._pending is None:
+                        self._pending = data
+            with self._cond:
+                self._writing = False
+                self._lastwrite = time.time()
+                self._cond.notify_all()
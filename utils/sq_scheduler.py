@@ -0,0 +1,87 @@
+# encoding: UTF-8
+# wakes the frame loop on quote and order events and on timers, on the time of SQClock.
+# author email: szy@tsinghua.org.cn
+
+import threading
+from utils.sq_clock import *
+
+
+class SQScheduler(object):
+    # the engines call notify_quote and notify_orders from their callback threads, the frame loop blocks in
+    # wait() until one of them or a timer is due and gets everything pending at once.
+    #
+    # a stock may have a band of prices which are not relevant to it, e.g. prices at which its strategy would
+    # place no order or prices while its orders rest, quotes inside the band are dropped without the lock.
+    # a stock without a band is woken by every quote.
+
+    BAND_ALL = [float('-inf'), float('inf')]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        # stockcode -> [low, high], prices with low < price < high do not wake
+        self._bands = {}
+        self._quotes = set()
+        self._orders = False
+        # name -> deadline of SQClock.time()
+        self._timers = {}
+
+    def set_band(self, stockcode, low, high):
+        self._bands[stockcode] = [low, high]
+
+    def clear_band(self, stockcode):
+        self._bands.pop(stockcode, None)
+
+    def get_band(self, stockcode):
+        return self._bands.get(stockcode)
+
+    def notify_quote(self, stockcode, price):
+        band = self._bands.get(stockcode)
+        if band is not None and band[0] < price < band[1]:
+            return False
+        with self._lock:
+            self._quotes.add(stockcode)
+        self._event.set()
+        return True
+
+    def notify_orders(self):
+        with self._lock:
+            self._orders = True
+        self._event.set()
+
+    def set_timer(self, name, secs):
+        with self._lock:
+            self._timers[name] = SQClock.time() + secs
+        self._event.set()
+
+    def cancel_timer(self, name):
+        with self._lock:
+            self._timers.pop(name, None)
+
+    def reset(self):
+        with self._lock:
+            self._bands.clear()
+            self._quotes.clear()
+            self._orders = False
+            self._timers.clear()
+
+    def wait(self, maxsecs=3600):
+        # [stockcodes of the quotes, whether an order event came, names of the due timers], the due timers
+        # are removed. blocks at most maxsecs when nothing is pending and no timer is set
+        while True:
+            with self._lock:
+                now = SQClock.time()
+                due = [name for name, deadline in self._timers.items() if deadline <= now + 0.000001]
+                if self._quotes or self._orders or due:
+                    for name in due:
+                        self._timers.pop(name)
+                    result = [self._quotes, self._orders, due]
+                    self._quotes = set()
+                    self._orders = False
+                    self._event.clear()
+                    return result
+                # a notify after this clear sets the event again, the wait below returns at once
+                self._event.clear()
+                secs = min(self._timers.values()) - now if self._timers else maxsecs
+            if not SQClock.wait(self._event, secs) and not self._timers:
+                return [set(), False, []]
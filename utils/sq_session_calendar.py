@@ -0,0 +1,164 @@
+# encoding: UTF-8
+# trading sessions of the us, hk and forex markets, a year at a time as epoch timestamps, looked up by bisect.
+# author email: szy@tsinghua.org.cn
+
+import os
+import json
+import bisect
+import datetime
+import threading
+import pytz
+from utils.sq_log import *
+from utils.sq_setting import *
+
+
+class SQSessionCalendar(object):
+    # one row per trading day, sorted: the epoch timestamps of [DAY, OPEN, CONTINUOUS, CLOSE, AFTERHOURS, DAYEND],
+    # DAY and DAYEND are the local midnights around the day. the rows come from the local times of the market
+    # in its timezone, so the daylight saving transitions are those of the timezone database, weekends and the
+    # holidays of <savedata dir>/holidays.json have no row, e.g.
+    #   {"US": ["2024-07-04", "2024-11-29 13:00"], "HK": ["2024-02-12"], "FX": ["2024-12-25"]}
+    # a date with a time closes early at that time, the after hours move with it. a forex day is the session
+    # which ends at 15:00 of new york on that date and began at 15:00 of the day before, monday to friday.
+    # the rows of a year are built when a lookup first needs them, together with the years around it.
+
+    DAY, OPEN, CONTINUOUS, CLOSE, AFTERHOURS, DAYEND = range(6)
+
+    # timezone, [open, continuous, close, afterhours] as local [hour, minute]
+    MARKETS = {'US': ['America/New_York', [[4, 0], [9, 30], [16, 0], [20, 0]]],
+               'HK': ['Asia/Hong_Kong', [[9, 30], [9, 30], [16, 0], [16, 0]]],
+               'FX': ['America/New_York', [[15, 0], [15, 0], [15, 0], [15, 0]]]}
+
+    _calendars = {}
+    _holidays = None
+    _lock = threading.Lock()
+
+    def __init__(self, market, holidays=None):
+        if market not in self.MARKETS:
+            raise Exception("SQSessionCalendar,market not supported,market=" + str(market))
+        self._market = market
+        self._tz = pytz.timezone(self.MARKETS[market][0])
+        self._times = self.MARKETS[market][1]
+        # date -> None for closed, or [hour, minute] of an early close
+        self._holidays = holidays if holidays is not None else {}
+        self._years = set()
+        # [starts, rows], replaced as a whole when years are added, starts are the DAY of the rows
+        self._table = [[], []]
+        # year -> [whether new year's day is in summer time, sorted ordinals of the dates whose local noon has
+        # another utc offset than the day before]
+        self._transitions = {}
+
+    @classmethod
+    def get(cls, market):
+        calendar = cls._calendars.get(market)
+        if calendar is None:
+            with cls._lock:
+                if cls._holidays is None:
+                    cls._holidays = cls.load_holidays()
+                calendar = cls._calendars.get(market)
+                if calendar is None:
+                    calendar = SQSessionCalendar(market, cls._holidays.get(market, {}))
+                    cls._calendars[market] = calendar
+        return calendar
+
+    @classmethod
+    def load_holidays(cls, filepath=None):
+        # market -> {date: None or [hour, minute]}, empty without the file
+        if filepath is None:
+            filepath = os.path.join(SQSetting.get_savedata_dir(None), "holidays.json")
+        holidays = {}
+        if not os.path.exists(filepath):
+            SQLog.info("SQSessionCalendar.load_holidays,no file,filepath=", filepath)
+            return holidays
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for market, days in data.items():
+                holidays[market] = {}
+                for day in days:
+                    parts = day.split()
+                    date = datetime.datetime.strptime(parts[0], "%Y-%m-%d").date()
+                    holidays[market][date] = [int(x) for x in parts[1].split(':')] if len(parts) > 1 else None
+        except Exception as e:
+            SQLog.warn("SQSessionCalendar.load_holidays,failed,filepath=", filepath, "e=", e)
+            return {}
+        SQLog.info("SQSessionCalendar.load_holidays,filepath=", filepath,
+                   "days=", {market: len(days) for market, days in holidays.items()})
+        return holidays
+
+    def __epoch(self, date, hour, minute):
+        return self._tz.localize(datetime.datetime(date.year, date.month, date.day, hour, minute)).timestamp()
+
+    def __build_year(self, year):
+        rows = []
+        transitions = []
+        date = datetime.date(year, 1, 1)
+        lastoffset = self._tz.localize(datetime.datetime(year, 1, 1, 12)).utcoffset()
+        summer = self._tz.localize(datetime.datetime(year, 1, 1, 12)).dst() != datetime.timedelta(0)
+        while date.year == year:
+            offset = self._tz.localize(datetime.datetime(date.year, date.month, date.day, 12)).utcoffset()
+            if offset != lastoffset:
+                transitions.append(date.toordinal())
+                lastoffset = offset
+            if date.weekday() < 5 and (date not in self._holidays or self._holidays[date] is not None):
+                t = [self.__epoch(date, h, m) for h, m in self._times]
+                nextdate = date + datetime.timedelta(days=1)
+                if self._market == 'FX':
+                    prevdate = date - datetime.timedelta(days=1)
+                    t[0] = t[1] = self.__epoch(prevdate, *self._times[0])
+                    row = [t[0]] + t + [t[3]]
+                else:
+                    row = [self.__epoch(date, 0, 0)] + t + [self.__epoch(nextdate, 0, 0)]
+                early = self._holidays.get(date)
+                if early is not None:
+                    close = self.__epoch(date, *early)
+                    row[self.AFTERHOURS] = min(row[self.AFTERHOURS] - row[self.CLOSE] + close, row[self.DAYEND])
+                    row[self.CLOSE] = close
+                rows.append(row)
+            date = date + datetime.timedelta(days=1)
+        self._transitions[year] = [summer, transitions]
+        return rows
+
+    def __ensure(self, year):
+        if year in self._years and year-1 in self._years and year+1 in self._years:
+            return
+        with self._lock:
+            rows = list(self._table[1])
+            for y in [year-1, year, year+1]:
+                if y not in self._years:
+                    rows.extend(self.__build_year(y))
+                    self._years.add(y)
+            rows.sort()
+            self._table = [[row[self.DAY] for row in rows], rows]
+            SQLog.info("SQSessionCalendar.__ensure,market=", self._market, "years=", sorted(self._years), "rows=", len(rows))
+
+    def __locate(self, t):
+        # [index of the last row which begins at or before t, rows]
+        self.__ensure(datetime.datetime.fromtimestamp(t, self._tz).year)
+        starts, rows = self._table
+        return [bisect.bisect_right(starts, t) - 1, rows]
+
+    def is_open(self, t, begin=OPEN, end=AFTERHOURS):
+        i, rows = self.__locate(t)
+        return i >= 0 and rows[i][begin] <= t < rows[i][end]
+
+    def secs_to_open(self, t, begin=OPEN, end=CLOSE):
+        # 0 within begin and end of a trading day, else the seconds to the next begin
+        i, rows = self.__locate(t)
+        if i >= 0 and t < rows[i][end]:
+            return max(0, rows[i][begin] - t)
+        # the year after the one of t is built as well, it has trading days
+        return rows[i+1][begin] - t
+
+    def secs_to(self, t, boundary):
+        # seconds to the boundary of the trading day t is in, 0 if it is past or t is in no trading day
+        i, rows = self.__locate(t)
+        if i >= 0 and t < rows[i][self.DAYEND]:
+            return max(0, rows[i][boundary] - t)
+        return 0
+
+    def is_summer_time(self, date):
+        # whether daylight saving time is in effect on the local date, counted from the date of the transition
+        self.__ensure(date.year)
+        summer, transitions = self._transitions[date.year]
+        return summer != (bisect.bisect_right(transitions, date.toordinal()) % 2 == 1)
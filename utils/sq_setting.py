@@ -114,11 +114,15 @@ class SQSaveData(object):
 
     @classmethod
     def save_data(cls, marketname, strategyname, data):
+        # written to a temporary file and renamed, the assets and the strategy snapshots in it change together
         filepath = cls.__get_savedata_filepath(marketname, strategyname)
-        with open(filepath, 'w', encoding='utf-8') as f:
+        tmppath = filepath + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=4, ensure_ascii=False)
-            f.close()
-            return True
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, filepath)
+        return True
 
     @classmethod
     def __get_quote_filepath(cls):
@@ -132,6 +136,10 @@ class SQSaveData(object):
             cls._quote_filepath = filepath
         return cls._quote_filepath
 
+    @classmethod
+    def set_quote_filepath(cls, filepath):
+        cls._quote_filepath = filepath
+
     @classmethod
     def load_quote_data(cls):
         filepath = cls.__get_quote_filepath()
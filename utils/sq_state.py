@@ -0,0 +1,49 @@
+# encoding: UTF-8
+# fixed layout binary records of object state, tagged and versioned so that a foreign or old record is refused.
+# author email: szy@tsinghua.org.cn
+
+import math
+import operator
+import struct
+
+
+class SQStateLayout(object):
+    # fields are [name, code] with the struct codes 'd' (float, None is stored as nan), 'q' (int) and '?' (bool).
+    # a record is the 4 bytes magic, the version and the fields in order, little endian, so all records of
+    # one layout have the same size and a list of them can be sliced without parsing.
+
+    def __init__(self, magic, version, fields):
+        self._magic = magic
+        self._version = version
+        self._names = [field[0] for field in fields]
+        self._floats = [field[1] == 'd' for field in fields]
+        self._struct = struct.Struct('<4sH' + ''.join([field[1] for field in fields]))
+        self._getter = operator.attrgetter(*self._names)
+
+    def get_version(self):
+        return self._version
+
+    def get_names(self):
+        return self._names
+
+    def size(self):
+        return self._struct.size
+
+    def pack(self, obj):
+        values = self._getter(obj)
+        if None in values:
+            values = [math.nan if (isfloat and value is None) else value for isfloat, value in zip(self._floats, values)]
+        return self._struct.pack(self._magic, self._version, *values)
+
+    def unpack(self, obj, data):
+        if len(data) < 6 or data[:4] != self._magic:
+            raise Exception("unpack,not a state record of " + self._magic.decode() + ",size=" + str(len(data)))
+        version = struct.unpack_from('<H', data, 4)[0]
+        if version != self._version:
+            raise Exception("unpack,state version not supported,magic=" + self._magic.decode()
+                            + ",version=" + str(version) + ",supported=" + str(self._version))
+        if len(data) != self._struct.size:
+            raise Exception("unpack,state record truncated,size=" + str(len(data)) + ",expected=" + str(self._struct.size))
+        for name, isfloat, value in zip(self._names, self._floats, self._struct.unpack(data)[2:]):
+            setattr(obj, name, None if (isfloat and math.isnan(value)) else value)
+        return True
@@ -0,0 +1,34 @@
+# encoding: UTF-8
+# a token bucket shared by the threads which call one broker, keeps its order calls within the rate the broker allows.
+# author email: szy@tsinghua.org.cn
+
+import time
+import threading
+
+
+class SQTokenBucket(object):
+    # rate tokens per second, at most burst of them saved up, a rate of 0 or less never waits.
+    # acquire() takes a token under the lock and sleeps outside it, a caller which finds the bucket empty
+    # takes the token it waits for in advance, so the callers after it queue behind it in order.
+    # broker limits are of real time, the bucket runs on time.time() and not on SQClock.
+
+    def __init__(self, rate=0, burst=1):
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = self._burst
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # seconds waited
+        if self._rate <= 0:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens + (now - self._time) * self._rate)
+            self._time = now
+            self._tokens -= 1
+            gap = -self._tokens / self._rate if self._tokens < 0 else 0
+        if gap > 0:
+            time.sleep(gap)
+        return gap